@@ -0,0 +1,377 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import threading
+import numpy as np
+import torch
+from hyperpyyaml import load_hyperpyyaml
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+from cosyvoice.cli.model import CosyVoice2Model
+from cosyvoice.utils.file_utils import logging, load_wav
+from cosyvoice.utils.metrics import metrics
+from cosyvoice.utils.memory import MemoryPolicy
+
+# NOTE randomly initialized CosyVoice2 with tiny width/depth, used to catch regressions on cpu without model download
+TINY_CONFIG = '''
+sample_rate: 24000
+qwen_pretrain_path: ''
+llm: !new:cosyvoice.llm.llm.Qwen2LM
+    llm_input_size: 128
+    llm_output_size: 128
+    speech_token_size: 6561
+    llm: !new:cosyvoice.llm.llm.Qwen2Encoder
+        pretrain_path: !ref <qwen_pretrain_path>
+    sampling: !name:cosyvoice.utils.common.ras_sampling
+        top_p: 0.8
+        top_k: 25
+        win_size: 10
+        tau_r: 0.1
+flow: !new:cosyvoice.flow.flow.CausalMaskedDiffWithXvec
+    input_size: 128
+    output_size: 80
+    spk_embed_dim: 192
+    output_type: 'mel'
+    vocab_size: 6561
+    input_frame_rate: 25
+    only_mask_loss: True
+    token_mel_ratio: 2
+    pre_lookahead_len: 3
+    encoder: !new:cosyvoice.transformer.upsample_encoder.UpsampleConformerEncoder
+        output_size: 128
+        attention_heads: 2
+        linear_units: 256
+        num_blocks: 2
+        dropout_rate: 0.1
+        positional_dropout_rate: 0.1
+        attention_dropout_rate: 0.1
+        normalize_before: True
+        input_layer: 'linear'
+        pos_enc_layer_type: 'rel_pos_espnet'
+        selfattention_layer_type: 'rel_selfattn'
+        input_size: 128
+        use_cnn_module: False
+        macaron_style: False
+        static_chunk_size: 25
+    decoder: !new:cosyvoice.flow.flow_matching.CausalConditionalCFM
+        in_channels: 240
+        n_spks: 1
+        spk_emb_dim: 80
+        cfm_params: !new:omegaconf.DictConfig
+            content:
+                sigma_min: 1e-06
+                solver: 'euler'
+                t_scheduler: 'cosine'
+                training_cfg_rate: 0.2
+                inference_cfg_rate: 0.7
+                reg_loss_type: 'l1'
+        estimator: !new:cosyvoice.flow.decoder.CausalConditionalDecoder
+            in_channels: 320
+            out_channels: 80
+            channels: [64]
+            dropout: 0.0
+            attention_head_dim: 32
+            n_blocks: 1
+            num_mid_blocks: 2
+            num_heads: 2
+            act_fn: 'gelu'
+            static_chunk_size: 50
+            num_decoding_left_chunks: -1
+hift: !new:cosyvoice.hifigan.generator.HiFTGenerator
+    in_channels: 80
+    base_channels: 64
+    nb_harmonics: 8
+    sampling_rate: !ref <sample_rate>
+    nsf_alpha: 0.1
+    nsf_sigma: 0.003
+    nsf_voiced_threshold: 10
+    upsample_rates: [8, 5, 3]
+    upsample_kernel_sizes: [16, 11, 7]
+    istft_params:
+        n_fft: 16
+        hop_len: 4
+    resblock_kernel_sizes: [3, 7, 11]
+    resblock_dilation_sizes: [[1, 3, 5], [1, 3, 5], [1, 3, 5]]
+    source_resblock_kernel_sizes: [7, 7, 11]
+    source_resblock_dilation_sizes: [[1, 3, 5], [1, 3, 5], [1, 3, 5]]
+    lrelu_slope: 0.1
+    audio_limit: 0.99
+    f0_predictor: !new:cosyvoice.hifigan.f0_predictor.ConvRNNF0Predictor
+        num_class: 1
+        in_channels: 80
+        cond_channels: 64
+'''
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark latency and throughput of cosyvoice inference')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--tiny',
+                        action='store_true',
+                        default=False,
+                        help='use a tiny randomly initialized CosyVoice2 instead of model_dir')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--instruct_text',
+                        type=str,
+                        default='用四川话说这句话')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='{}/../../asset/zero_shot_prompt.wav'.format(ROOT_DIR))
+    parser.add_argument('--source_wav',
+                        type=str,
+                        default='{}/../../asset/cross_lingual_prompt.wav'.format(ROOT_DIR),
+                        help='source speech of vc mode')
+    parser.add_argument('--modes',
+                        type=str,
+                        default='sft,zero_shot,instruct2,vc',
+                        help='comma separated inference modes')
+    parser.add_argument('--stream',
+                        type=str,
+                        default='both',
+                        choices=['on', 'off', 'both'])
+    parser.add_argument('--concurrency',
+                        type=str,
+                        default='1',
+                        help='comma separated number of concurrent requests')
+    parser.add_argument('--num_requests',
+                        type=int,
+                        default=10,
+                        help='number of requests per concurrent worker')
+    parser.add_argument('--warmup',
+                        type=int,
+                        default=2,
+                        help='number of warmup requests')
+    parser.add_argument('--empty_cache',
+                        type=str,
+                        default='threshold',
+                        choices=['always', 'never', 'threshold', 'periodic'],
+                        help='when to empty cuda cache after a session, always is the legacy behaviour')
+    parser.add_argument('--session_stream',
+                        action='store_true',
+                        default=False,
+                        help='run every session on its own cuda stream')
+    parser.add_argument('--memory_budget_mb',
+                        type=int,
+                        default=0)
+    parser.add_argument('--static_shape',
+                        action='store_true',
+                        default=False,
+                        help='bucket flow mel length, cuda graph on gpu and torch.compile on cpu, CosyVoice2 only')
+    parser.add_argument('--streaming_hift',
+                        action='store_true',
+                        default=False,
+                        help='stateful streaming hift instead of mel overlap and speech fade in out, CosyVoice2 only')
+    parser.add_argument('--sentence_lookahead',
+                        type=int,
+                        default=0,
+                        help='start llm decoding of this many following sentences ahead, ignored by --tiny')
+    parser.add_argument('--trace_dir',
+                        type=str,
+                        default='',
+                        help='dump one torch profiler chrome trace per setting into this dir')
+    parser.add_argument('--output',
+                        type=str,
+                        default='',
+                        help='also dump json result to this file')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+class TinyCosyVoice2:
+    """Randomly initialized tiny model, requests are built from random tokens so no frontend resource is needed."""
+
+    def __init__(self, text_len=10, prompt_token_len=25):
+        torch.manual_seed(0)
+        from transformers import Qwen2Config, Qwen2ForCausalLM
+        qwen_dir = tempfile.mkdtemp()
+        Qwen2ForCausalLM(Qwen2Config(vocab_size=1024, hidden_size=128, intermediate_size=256, num_hidden_layers=2,
+                                     num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=4096)).save_pretrained(qwen_dir)
+        configs = load_hyperpyyaml(TINY_CONFIG, overrides={'qwen_pretrain_path': qwen_dir})
+        self.sample_rate = configs['sample_rate']
+        self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'])
+        for module in [self.model.llm, self.model.flow, self.model.hift]:
+            module.to(self.model.device).eval()
+        self.text_len, self.prompt_token_len = text_len, prompt_token_len
+
+    def model_input(self, mode):
+        text = torch.randint(0, 1024, (1, self.text_len), dtype=torch.int32)
+        prompt_text = torch.randint(0, 1024, (1, self.text_len), dtype=torch.int32)
+        prompt_token = torch.randint(0, 6561, (1, self.prompt_token_len), dtype=torch.int32)
+        prompt_feat = torch.randn(1, 2 * self.prompt_token_len, 80)
+        embedding = torch.randn(1, 192)
+        if mode == 'sft':
+            return {'text': text, 'llm_embedding': embedding, 'flow_embedding': embedding}
+        if mode == 'zero_shot':
+            return {'text': text, 'prompt_text': prompt_text, 'llm_prompt_speech_token': prompt_token, 'flow_prompt_speech_token': prompt_token,
+                    'prompt_speech_feat': prompt_feat, 'llm_embedding': embedding, 'flow_embedding': embedding}
+        if mode == 'instruct2':
+            return {'text': text, 'prompt_text': prompt_text, 'flow_prompt_speech_token': prompt_token,
+                    'prompt_speech_feat': prompt_feat, 'llm_embedding': embedding, 'flow_embedding': embedding}
+        if mode == 'vc':
+            return {'source_speech_token': torch.randint(0, 6561, (1, 10 * self.text_len), dtype=torch.int32), 'flow_prompt_speech_token': prompt_token,
+                    'prompt_speech_feat': prompt_feat, 'flow_embedding': embedding}
+        raise ValueError('unknown mode {}'.format(mode))
+
+
+def get_request_fn(cosyvoice, mode, stream, args):
+    if isinstance(cosyvoice, TinyCosyVoice2):
+        return lambda: cosyvoice.model.tts(**cosyvoice.model_input(mode), stream=stream)
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+    if mode == 'sft':
+        spks = cosyvoice.list_available_spks()
+        if len(spks) == 0:
+            return None
+        return lambda: cosyvoice.inference_sft(args.tts_text, spks[0], stream=stream)
+    if mode == 'zero_shot':
+        return lambda: cosyvoice.inference_zero_shot(args.tts_text, args.prompt_text, prompt_speech_16k, stream=stream)
+    if mode == 'instruct2':
+        if not isinstance(cosyvoice, CosyVoice2):
+            return None
+        return lambda: cosyvoice.inference_instruct2(args.tts_text, args.instruct_text, prompt_speech_16k, stream=stream)
+    if mode == 'vc':
+        source_speech_16k = load_wav(args.source_wav, 16000)
+        return lambda: cosyvoice.inference_vc(source_speech_16k, prompt_speech_16k, stream=stream)
+    raise ValueError('unknown mode {}'.format(mode))
+
+
+def run_request(request_fn, sample_rate, token_rate):
+    start_time = time.time()
+    last_time, latencies, speech_len = start_time, [], 0
+    for model_output in request_fn():
+        now = time.time()
+        latencies.append(now - last_time)
+        last_time = now
+        speech_len += model_output['tts_speech'].shape[1] / sample_rate
+    total_time = time.time() - start_time
+    return {'ttfa': latencies[0], 'latencies': latencies, 'total': total_time, 'rtf': total_time / speech_len, 'tokens': speech_len * token_rate}
+
+
+def run_setting(request_fn, sample_rate, token_rate, concurrency, args):
+    for _ in range(args.warmup):
+        run_request(request_fn, sample_rate, token_rate)
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+    results, results_lock = [], threading.Lock()
+
+    def worker():
+        for _ in range(args.num_requests):
+            result = run_request(request_fn, sample_rate, token_rate)
+            with results_lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start_time = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall_time = time.time() - start_time
+
+    ttfa = np.array([i['ttfa'] for i in results])
+    latencies = np.array([j for i in results for j in i['latencies']])
+    rtf = np.array([i['rtf'] for i in results])
+    return {'concurrency': concurrency,
+            'num_requests': len(results),
+            'ttfa_mean': float(ttfa.mean()),
+            'ttfa_p50': float(np.percentile(ttfa, 50)),
+            'ttfa_p95': float(np.percentile(ttfa, 95)),
+            'ttfa_p99': float(np.percentile(ttfa, 99)),
+            'chunk_latency_p50': float(np.percentile(latencies, 50)),
+            'chunk_latency_p95': float(np.percentile(latencies, 95)),
+            'chunk_latency_p99': float(np.percentile(latencies, 99)),
+            'rtf_mean': float(rtf.mean()),
+            'tokens_per_s': float(sum(i['tokens'] for i in results) / wall_time),
+            # NOTE ru_maxrss is in KB on linux and is the peak of the whole process so far
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_gpu_mb': torch.cuda.max_memory_allocated() / 1024 / 1024 if torch.cuda.is_available() else 0}
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.tiny is True:
+        cosyvoice = TinyCosyVoice2()
+    else:
+        try:
+            cosyvoice = CosyVoice(args.model_dir)
+        except Exception:
+            try:
+                cosyvoice = CosyVoice2(args.model_dir)
+            except Exception:
+                raise TypeError('no valid model_type!')
+    cosyvoice.model.load_memory_policy(MemoryPolicy(empty_cache=args.empty_cache, memory_budget_mb=args.memory_budget_mb, session_stream=args.session_stream))
+    if args.static_shape is True:
+        cosyvoice.model.load_static_shape()
+    if args.streaming_hift is True:
+        cosyvoice.model.load_streaming_hift()
+    if not isinstance(cosyvoice, TinyCosyVoice2):
+        cosyvoice.sentence_lookahead = args.sentence_lookahead
+    token_rate = cosyvoice.model.flow.input_frame_rate
+    if args.trace_dir != '':
+        # NOTE stage annotations in trace come from the metrics wrappers
+        metrics.enable(cuda_sync=True)
+
+    results = []
+    streams = {'on': [True], 'off': [False], 'both': [False, True]}[args.stream]
+    for mode in args.modes.split(','):
+        for stream in streams:
+            request_fn = get_request_fn(cosyvoice, mode, stream, args)
+            if request_fn is None:
+                logging.warning('mode {} is not supported by {}, skip'.format(mode, args.model_dir))
+                continue
+            for concurrency in [int(i) for i in args.concurrency.split(',')]:
+                if args.trace_dir != '':
+                    os.makedirs(args.trace_dir, exist_ok=True)
+                    with metrics.trace('{}/{}_{}_{}.json'.format(args.trace_dir, mode, 'stream' if stream else 'offline', concurrency)):
+                        result = run_setting(request_fn, cosyvoice.sample_rate, token_rate, concurrency, args)
+                else:
+                    result = run_setting(request_fn, cosyvoice.sample_rate, token_rate, concurrency, args)
+                result.update({'mode': mode, 'stream': stream, 'empty_cache': args.empty_cache, 'session_stream': args.session_stream,
+                               'static_shape': args.static_shape, 'streaming_hift': args.streaming_hift,
+                               'sentence_lookahead': args.sentence_lookahead})
+                logging.warning('finish {}'.format(result))
+                results.append(result)
+    print(json.dumps(results, indent=2))
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
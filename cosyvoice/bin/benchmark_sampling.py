@@ -0,0 +1,152 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import json
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+from cosyvoice.utils.common import ras_sampling, random_sampling, nucleus_prob, TokenRingBuffer
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='microbenchmark of speech token sampling')
+    parser.add_argument('--vocab_size',
+                        type=int,
+                        default=6564,
+                        help='speech token size of CosyVoice2 llm_decoder')
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=16)
+    parser.add_argument('--num_steps',
+                        type=int,
+                        default=500)
+    parser.add_argument('--check_vocab_size',
+                        type=int,
+                        default=64,
+                        help='small vocab for the fallback distribution check, so that few samples estimate it well')
+    parser.add_argument('--num_check_samples',
+                        type=int,
+                        default=20000)
+    parser.add_argument('--device',
+                        type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+# legacy python loop implementation, kept here as baseline
+def legacy_nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
+    prob, indices = [], []
+    cum_prob = 0.0
+    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
+    for i in range(len(sorted_idx)):
+        if cum_prob < top_p and len(prob) < top_k:
+            cum_prob += sorted_value[i]
+            prob.append(sorted_value[i])
+            indices.append(sorted_idx[i])
+        else:
+            break
+    prob = torch.tensor(prob).to(weighted_scores)
+    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
+    top_ids = indices[prob.multinomial(1, replacement=True)]
+    return top_ids
+
+
+def legacy_ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
+    top_ids = legacy_nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
+    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
+    if rep_num >= win_size * tau_r:
+        top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
+    return top_ids
+
+
+def synchronize(device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def main():
+    args = get_args()
+    logits = torch.randn(args.num_steps, args.batch_size, args.vocab_size, device=args.device) * 5
+    result = {}
+
+    # 1. legacy, one row at a time with python list window
+    decoded_tokens = [[] for _ in range(args.batch_size)]
+    synchronize(args.device)
+    start_time = time.time()
+    for i in range(args.num_steps):
+        for j in range(args.batch_size):
+            decoded_tokens[j].append(legacy_ras_sampling(logits[i, j], decoded_tokens[j], 25).item())
+    synchronize(args.device)
+    result['legacy_ms_per_token'] = (time.time() - start_time) * 1000 / args.num_steps / args.batch_size
+
+    # 2. vectorized, one row at a time with device ring buffer
+    decoded_tokens = [TokenRingBuffer(device=args.device) for _ in range(args.batch_size)]
+    synchronize(args.device)
+    start_time = time.time()
+    for i in range(args.num_steps):
+        for j in range(args.batch_size):
+            decoded_tokens[j].append(ras_sampling(logits[i, j], decoded_tokens[j], 25))
+    synchronize(args.device)
+    result['vectorized_ms_per_token'] = (time.time() - start_time) * 1000 / args.num_steps / args.batch_size
+
+    # 3. vectorized, whole batch in one call
+    decoded_tokens = TokenRingBuffer(batch_size=args.batch_size, device=args.device)
+    synchronize(args.device)
+    start_time = time.time()
+    for i in range(args.num_steps):
+        decoded_tokens.append(ras_sampling(logits[i], decoded_tokens, 25))
+    synchronize(args.device)
+    result['batched_ms_per_token'] = (time.time() - start_time) * 1000 / args.num_steps / args.batch_size
+
+    # 4. check both implementations keep the same candidate set
+    torch.manual_seed(0)
+    for i in range(10):
+        legacy = {legacy_nucleus_sampling(logits[i, 0]).item() for _ in range(200)}
+        vectorized = {ras_sampling(logits[i, 0], [], 25).item() for _ in range(200)}
+        assert vectorized.issubset(set(logits[i, 0].softmax(dim=0).sort(descending=True, stable=True)[1][:25].tolist()))
+        result.setdefault('candidate_overlap', []).append(len(legacy & vectorized) / len(legacy | vectorized))
+    result['candidate_overlap'] = sum(result['candidate_overlap']) / len(result['candidate_overlap'])
+
+    # 5. check the output distribution when the window only repeats the top token, a nucleus draw of the top token falls back
+    # to random_sampling over the full vocab, so the exact distribution is nucleus[top] * full + nucleus without the top token
+    scores = torch.randn(args.check_vocab_size, device=args.device) * 3
+    full = scores.softmax(dim=0)
+    sorted_value, sorted_idx = full.sort(descending=True, stable=True)
+    nucleus = torch.zeros_like(full).scatter_(0, sorted_idx[:25], nucleus_prob(sorted_value, 0.8, 25))
+    nucleus = nucleus / nucleus.sum()
+    top = sorted_idx[0].item()
+    expected = nucleus[top] * full + nucleus
+    expected[top] -= nucleus[top]
+    legacy = torch.stack([legacy_ras_sampling(scores, [top] * 10, 25).reshape(()) for _ in range(args.num_check_samples)])
+    decoded_tokens = TokenRingBuffer(batch_size=args.num_check_samples, device=args.device)
+    for _ in range(10):
+        decoded_tokens.append(top)
+    vectorized = ras_sampling(scores.expand(args.num_check_samples, -1), decoded_tokens, 25)
+    for name, samples in [('legacy', legacy), ('vectorized', vectorized)]:
+        empirical = torch.bincount(samples.flatten(), minlength=args.check_vocab_size).float() / args.num_check_samples
+        result['{}_fallback_tv'.format(name)] = 0.5 * (empirical - expected).abs().sum().item()
+    assert result['vectorized_fallback_tv'] < 0.05, 'ras_sampling fallback distribution differs from random_sampling'
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
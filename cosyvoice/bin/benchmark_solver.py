@@ -0,0 +1,166 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import json
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.bin.benchmark import TinyCosyVoice2
+from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+from cosyvoice.cli.model import CosyVoice2Model
+from cosyvoice.flow.flow_matching import SOLVERS
+from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.file_utils import logging, load_wav
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='quality versus speed of flow matching ode solvers, compared with 10 step euler')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path or modelscope repo id')
+    parser.add_argument('--tiny',
+                        action='store_true',
+                        default=False,
+                        help='use a randomly initialized tiny CosyVoice2 on random tokens, no model_dir needed')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='asset/zero_shot_prompt.wav')
+    parser.add_argument('--source_wav',
+                        type=str,
+                        default='asset/cross_lingual_prompt.wav',
+                        help='its speech tokens are used as flow input, so no llm sampling noise is involved')
+    parser.add_argument('--solvers',
+                        type=str,
+                        default=','.join(SOLVERS))
+    parser.add_argument('--steps',
+                        type=str,
+                        default='2,4,6,8,10')
+    parser.add_argument('--cfg',
+                        type=str,
+                        default='default:1,default:2,0:1',
+                        help='comma separated cfg_rate:cfg_interval pairs, default means inference_cfg_rate of the model')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=5)
+    parser.add_argument('--output',
+                        type=str,
+                        default='',
+                        help='also dump json result to this file')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def get_flow_inputs(cosyvoice, args):
+    if isinstance(cosyvoice, TinyCosyVoice2):
+        model_input = cosyvoice.model_input('vc')
+    else:
+        model_input = cosyvoice.frontend.frontend_vc(load_wav(args.source_wav, 16000), load_wav(args.prompt_wav, 16000), cosyvoice.sample_rate)
+    return model_input['source_speech_token'], model_input['flow_prompt_speech_token'], model_input['prompt_speech_feat'], model_input['flow_embedding']
+
+
+def run_flow(model, token, prompt_token, prompt_feat, embedding, n_timesteps, solver, cfg_rate=None, cfg_interval=1, streaming=False):
+    # NOTE CosyVoice flow draws fresh noise in every call, fix the seed so that all settings share the same noise
+    set_all_random_seed(0)
+    kwargs = {'token': token.to(model.device),
+              'token_len': torch.tensor([token.shape[1]], dtype=torch.int32).to(model.device),
+              'prompt_token': prompt_token.to(model.device),
+              'prompt_token_len': torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(model.device),
+              'prompt_feat': prompt_feat.to(model.device),
+              'prompt_feat_len': torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(model.device),
+              'embedding': embedding.to(model.device),
+              'n_timesteps': n_timesteps,
+              'solver': solver,
+              'cfg_rate': cfg_rate,
+              'cfg_interval': cfg_interval}
+    if isinstance(model, CosyVoice2Model):
+        kwargs.update({'streaming': streaming, 'finalize': streaming is False})
+    else:
+        kwargs['flow_cache'] = torch.zeros(1, 80, 0, 2)
+    with torch.cuda.amp.autocast(model.fp16):
+        tts_mel, _ = model.flow.inference(**kwargs)
+    return tts_mel
+
+
+def measure(model, inputs, n_timesteps, solver, cfg_rate, cfg_interval, streaming, num_runs):
+    run_flow(model, *inputs, n_timesteps, solver, cfg_rate, cfg_interval, streaming)
+    start_time = time.time()
+    for _ in range(num_runs):
+        tts_mel = run_flow(model, *inputs, n_timesteps, solver, cfg_rate, cfg_interval, streaming)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return tts_mel, (time.time() - start_time) / num_runs
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.tiny is True:
+        cosyvoice = TinyCosyVoice2()
+    else:
+        try:
+            cosyvoice = CosyVoice(args.model_dir)
+        except Exception:
+            try:
+                cosyvoice = CosyVoice2(args.model_dir)
+            except Exception:
+                raise TypeError('no valid model_type!')
+    model = cosyvoice.model
+    token, prompt_token, prompt_feat, embedding = get_flow_inputs(cosyvoice, args)
+    settings = [('offline', False, token)]
+    if isinstance(model, CosyVoice2Model):
+        # first streaming chunk dominates time to first audio
+        first_chunk_len = model.token_hop_len + model.flow.pre_lookahead_len
+        settings.append(('first_chunk', True, token[:, :first_chunk_len]))
+    cfgs = []
+    for i in args.cfg.split(','):
+        cfg_rate, cfg_interval = i.split(':')
+        cfgs.append((None if cfg_rate == 'default' else float(cfg_rate), int(cfg_interval)))
+
+    results = []
+    for name, streaming, this_token in settings:
+        inputs = (this_token, prompt_token, prompt_feat, embedding)
+        ref_mel, ref_time = measure(model, inputs, 10, 'euler', None, 1, streaming, args.num_runs)
+        for solver in args.solvers.split(','):
+            for n_timesteps in [int(i) for i in args.steps.split(',')]:
+                for cfg_rate, cfg_interval in cfgs:
+                    tts_mel, flow_time = measure(model, inputs, n_timesteps, solver, cfg_rate, cfg_interval, streaming, args.num_runs)
+                    result = {'setting': name, 'solver': solver, 'n_timesteps': n_timesteps, 'cfg_rate': cfg_rate, 'cfg_interval': cfg_interval,
+                              'nfe': n_timesteps * (2 if solver in ['midpoint', 'heun'] else 1),
+                              'flow_ms': flow_time * 1000,
+                              'speedup': ref_time / flow_time,
+                              'mel_l1': (tts_mel - ref_mel).abs().mean().item(),
+                              'mel_rel_l2': ((tts_mel - ref_mel).norm() / ref_mel.norm()).item()}
+                    logging.warning('finish {}'.format(result))
+                    results.append(result)
+    print(json.dumps(results, indent=2))
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
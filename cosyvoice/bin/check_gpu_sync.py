@@ -0,0 +1,107 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import json
+import warnings
+from collections import Counter
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.bin.benchmark import TinyCosyVoice2
+from cosyvoice.utils.common import fade_in_out
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='check that crossfade and a full streaming request on the tiny model do not synchronize the gpu')
+    parser.add_argument('--mode',
+                        type=str,
+                        default='vc',
+                        choices=['vc', 'sft', 'zero_shot', 'instruct2'],
+                        help='vc has no llm, other modes also count the host decisions of llm sampling')
+    parser.add_argument('--max_syncs',
+                        type=int,
+                        default=-1,
+                        help='also fail when the streaming request synchronizes more often than this in total, -1 for no limit')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+# NOTE syncs a streaming request still has by design, every other sync site fails the check:
+# cosyvoice/cli/model.py, host to device copies of the chunk tokens, prompt and their lengths in token2wav, once per chunk,
+#   and source_speech_token.tolist() in vc_job, once per request
+# cosyvoice/llm/llm.py, top_ids.item() of the eos decision in inference, once per generated token, not in vc mode
+KNOWN_SYNC_FILES = ['cosyvoice/cli/model.py', 'cosyvoice/llm/llm.py']
+
+
+def count_syncs(fn):
+    # NOTE sync debug mode reports every synchronizing cuda call as a warning pointing at the python line that issued it
+    with warnings.catch_warnings(record=True) as records:
+        warnings.simplefilter('always')
+        torch.cuda.set_sync_debug_mode('warn')
+        try:
+            fn()
+        finally:
+            torch.cuda.set_sync_debug_mode('default')
+    return Counter('{}:{}'.format(os.path.relpath(i.filename, '{}/../..'.format(ROOT_DIR)), i.lineno) for i in records if 'synchroniz' in str(i.message))
+
+
+def run_fade(device):
+    fade_in = torch.randn(4, 80, 200, device=device)
+    fade_out = torch.randn(4, 80, 200, device=device)
+    for _ in range(10):
+        fade_in_out(fade_in, fade_out, 68)
+        fade_in_out(fade_in[:1], fade_out[:1], 68)
+        fade_in_out(fade_in[:, 0, :], fade_out[:, 0, :], 2 * 480)
+
+
+def main():
+    args = get_args()
+    if not torch.cuda.is_available():
+        print('cuda is not available, skip')
+        return
+    result = {}
+    # 1. crossfade alone, hamming windows are cached on device after the first call
+    run_fade('cuda')
+    syncs = count_syncs(lambda: run_fade('cuda'))
+    result['fade_in_out_syncs'] = dict(syncs)
+    assert len(syncs) == 0, 'fade_in_out synchronizes the gpu at {}'.format(dict(syncs))
+
+    # 2. one full streaming request, speech stays on device so the consumer does not copy it to host
+    cosyvoice = TinyCosyVoice2()
+    cosyvoice.model.load_speech_on_device()
+
+    def request():
+        for _ in cosyvoice.model.tts(**cosyvoice.model_input(args.mode), stream=True):
+            pass
+    request()
+    torch.cuda.synchronize()
+    syncs = count_syncs(request)
+    torch.cuda.synchronize()
+    result['request_syncs'] = dict(syncs)
+    result['request_num_syncs'] = sum(syncs.values())
+    unexpected = {k: v for k, v in syncs.items() if k.split(':')[0] not in KNOWN_SYNC_FILES}
+    print(json.dumps(result, indent=2))
+    assert len(unexpected) == 0, 'streaming {} request synchronizes the gpu at {}'.format(args.mode, unexpected)
+    assert args.max_syncs < 0 or result['request_num_syncs'] <= args.max_syncs, 'streaming request synchronizes the gpu {} times'.format(result['request_num_syncs'])
+
+
+if __name__ == "__main__":
+    main()
@@ -47,6 +47,9 @@ def get_args():
                         type=str,
                         default='pretrained_models/CosyVoice-300M',
                         help='local path')
+    parser.add_argument('--dynamic_batch',
+                        action='store_true',
+                        help='export estimator with dynamic batch axis for batched token2wav')
     args = parser.parse_args()
     print(args)
     return args
@@ -74,22 +77,35 @@ def main():
     batch_size, seq_len = 2, 256
     out_channels = model.model.flow.decoder.estimator.out_channels
     x, mask, mu, t, spks, cond = get_dummy_input(batch_size, seq_len, out_channels, device)
+    suffix = '.dynamic_batch' if args.dynamic_batch else ''
+    if args.dynamic_batch:
+        dynamic_axes = {
+            'x': {0: 'batch_size', 2: 'seq_len'},
+            'mask': {0: 'batch_size', 2: 'seq_len'},
+            'mu': {0: 'batch_size', 2: 'seq_len'},
+            't': {0: 'batch_size'},
+            'spks': {0: 'batch_size'},
+            'cond': {0: 'batch_size', 2: 'seq_len'},
+            'estimator_out': {0: 'batch_size', 2: 'seq_len'},
+        }
+    else:
+        dynamic_axes = {
+            'x': {2: 'seq_len'},
+            'mask': {2: 'seq_len'},
+            'mu': {2: 'seq_len'},
+            'cond': {2: 'seq_len'},
+            'estimator_out': {2: 'seq_len'},
+        }
     torch.onnx.export(
         estimator,
         (x, mask, mu, t, spks, cond),
-        '{}/flow.decoder.estimator.fp32.onnx'.format(args.model_dir),
+        '{}/flow.decoder.estimator.fp32{}.onnx'.format(args.model_dir, suffix),
         export_params=True,
         opset_version=18,
         do_constant_folding=True,
         input_names=['x', 'mask', 'mu', 't', 'spks', 'cond'],
         output_names=['estimator_out'],
-        dynamic_axes={
-            'x': {2: 'seq_len'},
-            'mask': {2: 'seq_len'},
-            'mu': {2: 'seq_len'},
-            'cond': {2: 'seq_len'},
-            'estimator_out': {2: 'seq_len'},
-        }
+        dynamic_axes=dynamic_axes
     )
 
     # 2. test computation consistency
@@ -97,11 +113,12 @@ def main():
     option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
     option.intra_op_num_threads = 1
     providers = ['CUDAExecutionProvider' if torch.cuda.is_available() else 'CPUExecutionProvider']
-    estimator_onnx = onnxruntime.InferenceSession('{}/flow.decoder.estimator.fp32.onnx'.format(args.model_dir),
+    estimator_onnx = onnxruntime.InferenceSession('{}/flow.decoder.estimator.fp32{}.onnx'.format(args.model_dir, suffix),
                                                   sess_options=option, providers=providers)
 
     for _ in tqdm(range(10)):
-        x, mask, mu, t, spks, cond = get_dummy_input(batch_size, random.randint(16, 512), out_channels, device)
+        this_batch_size = random.randint(1, 8) * 2 if args.dynamic_batch else batch_size
+        x, mask, mu, t, spks, cond = get_dummy_input(this_batch_size, random.randint(16, 512), out_channels, device)
         output_pytorch = estimator(x, mask, mu, t, spks, cond)
         ort_inputs = {
             'x': x.cpu().numpy(),
@@ -0,0 +1,150 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import AsyncGenerator, Callable
+from cosyvoice.utils.audio_output import speech_to_pcm
+from cosyvoice.utils.file_utils import logging
+
+_END = object()
+
+
+class AsyncCosyVoice:
+    """Asyncio facade over CosyVoice/CosyVoice2.
+
+    Every request iterates the synchronous inference generator in a dedicated executor thread and hands
+    the outputs to the event loop through an asyncio queue, so the loop is never blocked by synthesis.
+    At most max_queue_size outputs are buffered per request before the worker waits for the consumer.
+    Breaking out of the async for, closing the generator (e.g. client disconnect) or hitting the timeout
+    stops the worker at the next output.
+    With output_pcm=True every output also carries tts_pcm, the host int16 samples converted in the worker thread,
+    so that a transport never waits for the gpu on the event loop.
+    """
+
+    def __init__(self, cosyvoice, max_workers: int = 32, max_queue_size: int = 2, timeout: float = None, output_pcm: bool = False):
+        self.cosyvoice = cosyvoice
+        self.output_pcm = output_pcm
+        self.sample_rate = cosyvoice.sample_rate
+        self.max_queue_size = max_queue_size
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='cosyvoice_infer')
+
+    def list_available_spks(self):
+        return self.cosyvoice.list_available_spks()
+
+    async def add_zero_shot_spk(self, prompt_text, prompt_speech_16k, zero_shot_spk_id):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.cosyvoice.add_zero_shot_spk, prompt_text, prompt_speech_16k, zero_shot_spk_id)
+
+    def inference_sft(self, *args, timeout: float = None, **kwargs) -> AsyncGenerator[dict, None]:
+        return self._stream(self.cosyvoice.inference_sft, args, kwargs, timeout)
+
+    def inference_zero_shot(self, *args, timeout: float = None, **kwargs) -> AsyncGenerator[dict, None]:
+        return self._stream(self.cosyvoice.inference_zero_shot, args, kwargs, timeout)
+
+    def inference_cross_lingual(self, *args, timeout: float = None, **kwargs) -> AsyncGenerator[dict, None]:
+        return self._stream(self.cosyvoice.inference_cross_lingual, args, kwargs, timeout)
+
+    def inference_instruct(self, *args, timeout: float = None, **kwargs) -> AsyncGenerator[dict, None]:
+        return self._stream(self.cosyvoice.inference_instruct, args, kwargs, timeout)
+
+    def inference_instruct2(self, *args, timeout: float = None, **kwargs) -> AsyncGenerator[dict, None]:
+        return self._stream(self.cosyvoice.inference_instruct2, args, kwargs, timeout)
+
+    def inference_vc(self, source_speech_16k, *args, timeout: float = None, **kwargs) -> AsyncGenerator[dict, None]:
+        if hasattr(source_speech_16k, '__aiter__'):
+            # NOTE streaming vc from an async source, the worker thread pulls speech chunks from the event loop
+            return self._stream(self.cosyvoice.inference_vc, args, kwargs, timeout, source=source_speech_16k)
+        return self._stream(self.cosyvoice.inference_vc, (source_speech_16k,) + args, kwargs, timeout)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    async def _stream(self, fn: Callable, args: tuple, kwargs: dict, timeout: float = None, source=None) -> AsyncGenerator[dict, None]:
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        cancel = threading.Event()
+        # NOTE one slot is released by the consumer for every output it takes, this bounds the outputs buffered per request
+        slots = threading.Semaphore(self.max_queue_size)
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else loop.time() + timeout
+        if source is not None:
+            args = (self._iterate(source, loop, cancel, deadline),) + args
+        loop.run_in_executor(self.executor, self._produce, fn, args, kwargs, loop, queue, cancel, slots)
+        try:
+            while True:
+                remain = None if deadline is None else deadline - loop.time()
+                if remain is not None and remain <= 0:
+                    raise asyncio.TimeoutError('inference not finished in {}s'.format(timeout))
+                item, error = await asyncio.wait_for(queue.get(), remain)
+                if error is not None:
+                    raise error
+                if item is _END:
+                    break
+                slots.release()
+                yield item
+        finally:
+            cancel.set()
+
+    def _produce(self, fn, args, kwargs, loop, queue, cancel, slots):
+        if cancel.is_set():
+            return
+        gen = fn(*args, **kwargs)
+        try:
+            for item in gen:
+                while not slots.acquire(timeout=0.1):
+                    if cancel.is_set():
+                        return
+                if cancel.is_set():
+                    return
+                if self.output_pcm is True:
+                    item = dict(item, tts_pcm=speech_to_pcm(item['tts_speech']))
+                self._put(loop, queue, (item, None))
+            self._put(loop, queue, (_END, None))
+        except Exception as e:
+            logging.warning('async inference failed: {}'.format(e))
+            self._put(loop, queue, (None, e))
+        finally:
+            gen.close()
+
+    @staticmethod
+    def _iterate(aiterator, loop, cancel, deadline=None, poll_interval=0.1):
+        # NOTE wait for the next chunk in bounded polls, so a source that stops sending can not pin the worker
+        # after the request is cancelled or timed out, the pending __anext__ is cancelled on exit
+        aiterator = aiterator.__aiter__()
+        while True:
+            future = asyncio.run_coroutine_threadsafe(aiterator.__anext__(), loop)
+            try:
+                while True:
+                    if cancel.is_set() or (deadline is not None and loop.time() > deadline):
+                        return
+                    try:
+                        chunk = future.result(timeout=poll_interval)
+                        break
+                    except FutureTimeoutError:
+                        continue
+            except StopAsyncIteration:
+                return
+            finally:
+                if not future.done():
+                    future.cancel()
+            yield chunk
+
+    @staticmethod
+    def _put(loop, queue, value):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, value)
+        except RuntimeError:
+            # event loop is already closed, nobody is waiting for this request anymore
+            pass
@@ -13,6 +13,10 @@
 # limitations under the License.
 import os
 import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Generator
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
@@ -21,12 +25,14 @@ import torch
 from cosyvoice.cli.frontend import CosyVoiceFrontEnd
 from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model
 from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.audio_output import PCMEncoder, wav_header
 from cosyvoice.utils.class_utils import get_model_type
 
 
 class CosyVoice:
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1, prompt_cache_mb=64, memory_policy=None,
+                 speech_on_device=False, sentence_lookahead=0, frontend_batch_size=1, frontend_threads=0):
         self.instruct = True if '-Instruct' in model_dir else False
         self.model_dir = model_dir
         self.fp16 = fp16
@@ -43,8 +49,16 @@ class CosyVoice:
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v1.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          '{}/spk_store'.format(model_dir),
+                                          frontend_threads)
         self.sample_rate = configs['sample_rate']
+        # NOTE number of following sentences whose llm decoding starts while the current sentence is still in token2wav
+        self.sentence_lookahead = sentence_lookahead
+        if prompt_cache_mb > 0:
+            self.frontend.load_prompt_cache(prompt_cache_mb * 1024 * 1024)
+        if frontend_batch_size > 1:
+            self.frontend.load_micro_batching(frontend_batch_size)
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/fp16 to False')
@@ -61,6 +75,10 @@ class CosyVoice:
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        if memory_policy is not None:
+            self.model.load_memory_policy(memory_policy)
+        if speech_on_device is True:
+            self.model.load_speech_on_device()
         del configs
 
     def list_available_spks(self):
@@ -76,72 +94,134 @@ class CosyVoice:
         return True
 
     def save_spkinfo(self):
-        torch.save(self.frontend.spk2info, '{}/spk2info.pt'.format(self.model_dir))
+        # NOTE add_zero_shot_spk is already persisted and fsynced by the append only speaker store, nothing left to save,
+        # call self.frontend.spk2info.compact() as explicit maintenance to reclaim space of overwritten and deleted speakers
+        return
 
-    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_sft(i, spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver='euler',
+                      cfg_rate=None, cfg_interval=1):
+        model_inputs = ((i, self.frontend.frontend_sft(i, spk_id)) for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)))
+        yield from self.synthesize(model_inputs, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_rate=cfg_rate, cfg_interval=cfg_interval)
 
-    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver='euler',
+                            cfg_rate=None, cfg_interval=1):
         prompt_text = self.frontend.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            if (not isinstance(i, Generator)) and len(i) < 0.5 * len(prompt_text):
-                logging.warning('synthesis text {} too short than prompt text {}, this may lead to bad performance'.format(i, prompt_text))
-            model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
 
-    def inference_cross_lingual(self, tts_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_cross_lingual(i, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+        def model_inputs():
+            for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+                if (not isinstance(i, Generator)) and len(i) < 0.5 * len(prompt_text):
+                    logging.warning('synthesis text {} too short than prompt text {}, this may lead to bad performance'.format(i, prompt_text))
+                yield i, self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
+        yield from self.synthesize(model_inputs(), stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_rate=cfg_rate, cfg_interval=cfg_interval)
+
+    def inference_cross_lingual(self, tts_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver='euler',
+                                cfg_rate=None, cfg_interval=1):
+        model_inputs = ((i, self.frontend.frontend_cross_lingual(i, prompt_speech_16k, self.sample_rate, zero_shot_spk_id))
+                        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)))
+        yield from self.synthesize(model_inputs, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_rate=cfg_rate, cfg_interval=cfg_interval)
 
-    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True):
+    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver='euler',
+                           cfg_rate=None, cfg_interval=1):
         assert isinstance(self.model, CosyVoiceModel), 'inference_instruct is only implemented for CosyVoice!'
         if self.instruct is False:
             raise ValueError('{} do not support instruct inference'.format(self.model_dir))
         instruct_text = self.frontend.text_normalize(instruct_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct(i, spk_id, instruct_text)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+        model_inputs = ((i, self.frontend.frontend_instruct(i, spk_id, instruct_text))
+                        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)))
+        yield from self.synthesize(model_inputs, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_rate=cfg_rate, cfg_interval=cfg_interval)
 
-    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0):
+    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0, n_timesteps=10, solver='euler',
+                     cfg_rate=None, cfg_interval=1):
+        # NOTE source_speech_16k can be a generator of 16k speech chunks, it is tokenized window by window and with stream=True
+        # speech is emitted while the source is still arriving
         model_input = self.frontend.frontend_vc(source_speech_16k, prompt_speech_16k, self.sample_rate)
+        yield from self.log_rtf(self.model.tts(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver,
+                                               cfg_rate=cfg_rate, cfg_interval=cfg_interval))
+
+    def synthesize(self, model_inputs, **kwargs):
+        """Run model.tts for every (text, model_input) sentence and yield outputs in sentence order.
+
+        With sentence_lookahead > 0, up to sentence_lookahead following sentences are started in background threads, so their
+        frontend and llm decoding overlap token2wav of the current sentence. Each started sentence buffers at most one output.
+        """
+        if self.sentence_lookahead == 0:
+            for i, model_input in model_inputs:
+                logging.info('synthesis text {}'.format(i))
+                yield from self.log_rtf(self.model.tts(**model_input, **kwargs))
+            return
+        pending = deque()
+        try:
+            for i, model_input in model_inputs:
+                pending.append((i, self.start_sentence(model_input, kwargs)))
+                if len(pending) > self.sentence_lookahead:
+                    i, (outputs, cancel) = pending.popleft()
+                    logging.info('synthesis text {}'.format(i))
+                    yield from self.log_rtf(self.drain_sentence(outputs, cancel))
+            while len(pending) != 0:
+                i, (outputs, cancel) = pending.popleft()
+                logging.info('synthesis text {}'.format(i))
+                yield from self.log_rtf(self.drain_sentence(outputs, cancel))
+        finally:
+            # consumer is gone or failed, stop sentences started ahead
+            for _, (_, cancel) in pending:
+                cancel.set()
+
+    def log_rtf(self, model_outputs):
         start_time = time.time()
-        for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+        for model_output in model_outputs:
             speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
             logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
             yield model_output
             start_time = time.time()
 
+    def start_sentence(self, model_input, kwargs):
+        outputs, cancel = queue.Queue(maxsize=1), threading.Event()
+        threading.Thread(target=self.produce_sentence, args=(model_input, kwargs, outputs, cancel), daemon=True).start()
+        return outputs, cancel
+
+    def produce_sentence(self, model_input, kwargs, outputs, cancel):
+        # NOTE put blocks while the output is not taken, llm_job of this sentence keeps decoding in its own thread meanwhile
+        model_outputs = self.model.tts(**model_input, **kwargs)
+        try:
+            for model_output in model_outputs:
+                if self.put_output(outputs, (model_output, None), cancel) is False:
+                    return
+            self.put_output(outputs, (None, None), cancel)
+        except Exception as e:
+            logging.warning('sentence synthesis failed: {}'.format(e))
+            self.put_output(outputs, (None, e), cancel)
+        finally:
+            model_outputs.close()
+
+    @staticmethod
+    def put_output(outputs, item, cancel):
+        while cancel.is_set() is False:
+            try:
+                outputs.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def drain_sentence(outputs, cancel):
+        try:
+            while True:
+                model_output, error = outputs.get()
+                if error is not None:
+                    raise error
+                if model_output is None:
+                    return
+                yield model_output
+        finally:
+            cancel.set()
+
 
 class CosyVoice2(CosyVoice):
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, llm_batch_size=1, token2wav_batch_size=1,
+                 prefix_cache_mb=0, incremental_flow=False, prompt_cache_mb=64, memory_policy=None, static_shape=False, streaming_hift=False,
+                 speech_on_device=False, sentence_lookahead=0, frontend_batch_size=1, frontend_threads=0):
         self.instruct = True if '-Instruct' in model_dir else False
         self.model_dir = model_dir
         self.fp16 = fp16
@@ -158,8 +238,16 @@ class CosyVoice2(CosyVoice):
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v2.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          '{}/spk_store'.format(model_dir),
+                                          frontend_threads)
         self.sample_rate = configs['sample_rate']
+        # NOTE number of following sentences whose llm decoding starts while the current sentence is still in token2wav
+        self.sentence_lookahead = sentence_lookahead
+        if prompt_cache_mb > 0:
+            self.frontend.load_prompt_cache(prompt_cache_mb * 1024 * 1024)
+        if frontend_batch_size > 1:
+            self.frontend.load_micro_batching(frontend_batch_size)
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/fp16 to False')
@@ -169,26 +257,99 @@ class CosyVoice2(CosyVoice):
                         '{}/hift.pt'.format(model_dir))
         if load_vllm:
             self.model.load_vllm('{}/vllm'.format(model_dir))
+        elif llm_batch_size > 1:
+            self.model.load_batch_engine(llm_batch_size)
+        if token2wav_batch_size > 1:
+            self.model.load_token2wav_batching(token2wav_batch_size)
+        if prefix_cache_mb > 0 and load_vllm is False:
+            self.model.load_prefix_cache(prefix_cache_mb * 1024 * 1024)
         if load_jit:
             self.model.load_jit('{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
         if load_trt:
-            self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+            # NOTE batched token2wav needs an estimator exported with dynamic batch axis
+            suffix = '.dynamic_batch' if token2wav_batch_size > 1 else ''
+            self.model.load_trt('{}/flow.decoder.estimator.{}{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32', suffix),
+                                '{}/flow.decoder.estimator.fp32{}.onnx'.format(model_dir, suffix),
                                 trt_concurrent,
                                 self.fp16)
+        if incremental_flow:
+            self.model.load_incremental_flow()
+        if static_shape is True and load_trt is False:
+            self.model.load_static_shape()
+        if streaming_hift is True:
+            self.model.load_streaming_hift()
+        if memory_policy is not None:
+            self.model.load_memory_policy(memory_policy)
+        if speech_on_device is True:
+            self.model.load_speech_on_device()
         del configs
 
     def inference_instruct(self, *args, **kwargs):
         raise NotImplementedError('inference_instruct is not implemented for CosyVoice2!')
 
-    def inference_instruct2(self, tts_text, instruct_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+    def inference_instruct2(self, tts_text, instruct_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver='euler',
+                            cfg_rate=None, cfg_interval=1):
         assert isinstance(self.model, CosyVoice2Model), 'inference_instruct2 is only implemented for CosyVoice2!'
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct2(i, instruct_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+        model_inputs = ((i, self.frontend.frontend_instruct2(i, instruct_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id))
+                        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)))
+        yield from self.synthesize(model_inputs, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_rate=cfg_rate, cfg_interval=cfg_interval)
+
+    def synthesize_document(self, tts_text, prompt_text='', prompt_speech_16k=None, zero_shot_spk_id='', spk_id='', silence=0.2, max_parallel=8,
+                            output_path='', speed=1.0, text_frontend=True, n_timesteps=10, solver='euler', cfg_rate=None, cfg_interval=1):
+        """Offline long form synthesis tuned for throughput instead of latency.
+
+        Sentences from text_normalize/split_paragraph are synthesized non-stream with up to max_parallel sessions in flight,
+        so that a batch llm engine (llm_batch_size) and batched token2wav (token2wav_batch_size) see full batches. Sentences are
+        stitched in order with silence seconds between them. Voice is spk_id if given, else zero shot from prompt_text or
+        zero_shot_spk_id, else cross lingual from prompt_speech_16k. Returns the waveform, or writes a 16 bit wav to output_path
+        sentence by sentence and returns output_path.
+        """
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        if spk_id != '':
+            frontend = lambda i: self.frontend.frontend_sft(i, spk_id)
+        elif prompt_text != '' or zero_shot_spk_id != '':
+            prompt_text = self.frontend.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
+            frontend = lambda i: self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
+        else:
+            frontend = lambda i: self.frontend.frontend_cross_lingual(i, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
+        kwargs = {'stream': False, 'speed': speed, 'n_timesteps': n_timesteps, 'solver': solver, 'cfg_rate': cfg_rate, 'cfg_interval': cfg_interval}
+        silence = torch.zeros(1, int(silence * self.sample_rate))
+
+        def sentence_speeches():
+            # NOTE frontend and model of a sentence run in the pool, at most max_parallel sentences are ahead of the writer
+            # and finished ones are yielded in order, so memory does not grow with document length
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='cosyvoice_document') as executor:
+                try:
+                    for text in tqdm(texts):
+                        pending.append(executor.submit(lambda i: [j['tts_speech'] for j in self.model.tts(**frontend(i), **kwargs)], text))
+                        if len(pending) >= max_parallel:
+                            yield pending.popleft().result()
+                    while len(pending) != 0:
+                        yield pending.popleft().result()
+                finally:
+                    for future in pending:
+                        future.cancel()
+
+        start_time, num_sentences, speech_len = time.time(), 0, 0
+        if output_path == '':
+            speeches = []
+            for speech in sentence_speeches():
+                speeches.extend(([silence] if num_sentences != 0 else []) + [i.cpu() for i in speech])
+                num_sentences += 1
+            tts_speech = torch.concat(speeches, dim=1) if len(speeches) != 0 else torch.zeros(1, 0)
+            speech_len = tts_speech.shape[1]
+        else:
+            encoder = PCMEncoder()
+            with open(output_path, 'wb') as f:
+                f.write(wav_header(self.sample_rate))
+                for speech in sentence_speeches():
+                    for i in ([silence] if num_sentences != 0 else []) + speech:
+                        f.write(encoder.encode(i))
+                        speech_len += i.shape[1]
+                    num_sentences += 1
+                f.seek(0)
+                f.write(wav_header(self.sample_rate, speech_len * 2))
+        logging.info('synthesis {} sentences, speech len {}, rtf {}'.format(num_sentences, speech_len / self.sample_rate,
+                                                                            (time.time() - start_time) / max(speech_len / self.sample_rate, 1e-6)))
+        return tts_speech if output_path == '' else output_path
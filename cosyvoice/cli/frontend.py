@@ -16,6 +16,7 @@ from typing import Generator
 import json
 import onnxruntime
 import torch
+import torch.nn.functional as F
 import numpy as np
 import whisper
 from typing import Callable
@@ -33,7 +34,12 @@ except ImportError:
     from wetext import Normalizer as EnNormalizer
     use_ttsfrd = False
 from cosyvoice.utils.file_utils import logging
-from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation
+from cosyvoice.utils.spk_store import SpeakerStore
+from cosyvoice.utils.cache import LRUCache, tensor_hash
+from cosyvoice.utils.metrics import metrics
+from cosyvoice.utils.micro_batch import MicroBatcher, available_cpus
+from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation, \
+    split_speech_windows, merge_window_tokens
 
 
 class CosyVoiceFrontEnd:
@@ -44,22 +50,38 @@ class CosyVoiceFrontEnd:
                  campplus_model: str,
                  speech_tokenizer_model: str,
                  spk2info: str = '',
-                 allowed_special: str = 'all'):
+                 allowed_special: str = 'all',
+                 spk_store: str = '',
+                 onnx_threads: int = 0):
         self.tokenizer = get_tokenizer()
         self.feat_extractor = feat_extractor
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        option = onnxruntime.SessionOptions()
-        option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
-        option.intra_op_num_threads = 1
-        self.campplus_session = onnxruntime.InferenceSession(campplus_model, sess_options=option, providers=["CPUExecutionProvider"])
-        self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=option,
+        # NOTE onnx_threads is the total intra op threads of both onnx sessions, 0 means half of the cpus this process may use,
+        # the other half is left to torch and the concurrent inference threads. The tokenizer only needs one when it runs on cuda.
+        onnx_threads = onnx_threads if onnx_threads > 0 else max(available_cpus() // 2, 1)
+        tokenizer_threads = 1 if torch.cuda.is_available() else max(onnx_threads // 2, 1)
+        options = []
+        for num_threads in [max(onnx_threads - tokenizer_threads, 1), tokenizer_threads]:
+            option = onnxruntime.SessionOptions()
+            option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            option.intra_op_num_threads = num_threads
+            options.append(option)
+        self.campplus_session = onnxruntime.InferenceSession(campplus_model, sess_options=options[0], providers=["CPUExecutionProvider"])
+        self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=options[1],
                                                                      providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
                                                                                 "CPUExecutionProvider"])
-        if os.path.exists(spk2info):
+        if spk_store != '':
+            # NOTE speakers are loaded lazily from the mmap backed store, legacy spk2info.pt is migrated into it once
+            self.spk2info = SpeakerStore(spk_store, self.device)
+            self.spk2info.migrate(spk2info)
+        elif os.path.exists(spk2info):
             self.spk2info = torch.load(spk2info, map_location=self.device)
         else:
             self.spk2info = {}
         self.allowed_special = allowed_special
+        self.prompt_cache = None
+        self.speech_token_batcher = None
+        self.spk_embedding_batcher = None
         self.use_ttsfrd = use_ttsfrd
         if self.use_ttsfrd:
             self.frd = ttsfrd.TtsFrontendEngine()
@@ -71,6 +93,8 @@ class CosyVoiceFrontEnd:
             self.zh_tn_model = ZhNormalizer(remove_erhua=False)
             self.en_tn_model = EnNormalizer()
             self.inflect_parser = inflect.engine()
+        metrics.instrument(self, {'text_normalize': 'text_normalize', '_extract_text_token': 'text_token', '_extract_speech_token': 'speech_tokenizer',
+                                  '_extract_spk_embedding': 'spk_embedding', '_extract_speech_feat': 'speech_feat'})
 
     def _extract_text_token(self, text):
         if isinstance(text, Generator):
@@ -90,16 +114,55 @@ class CosyVoiceFrontEnd:
                 yield text_token[:, i: i + 1]
 
     def _extract_speech_token(self, speech):
-        assert speech.shape[1] / 16000 <= 30, 'do not support extract speech token for audio longer than 30s'
-        feat = whisper.log_mel_spectrogram(speech, n_mels=128)
+        # NOTE audio longer than 30s is tokenized in overlapping windows which run as one batch
+        windows = split_speech_windows(speech.shape[1] // 160)
+        speech_token = merge_window_tokens(windows, self._extract_window_tokens(speech, windows))
+        speech_token = torch.tensor([speech_token], dtype=torch.int32).to(self.device)
+        speech_token_len = torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(self.device)
+        return speech_token, speech_token_len
+
+    def _extract_speech_token_stream(self, speech_generator, window_frames=400, overlap_frames=160):
+        # NOTE source audio arrives in chunks, a window is tokenized as soon as audio beyond its end has arrived,
+        # then its kept tokens are final, so tokens lag the audio by about window_frames - overlap_frames / 2 frames
+        hop = window_frames - overlap_frames
+        buffer, offset, num_windows, factor = torch.zeros(1, 0), 0, 0, None
+        for speech in speech_generator:
+            buffer = torch.concat([buffer, speech.reshape(1, -1).cpu()], dim=1)
+            while offset + buffer.shape[1] // 160 > num_windows * hop + window_frames:
+                start = num_windows * hop
+                window = (start, start + window_frames, start + overlap_frames // 2 if num_windows != 0 else start, start + window_frames - overlap_frames // 2)
+                speech_token = self._extract_window_tokens(buffer[:, :(start + window_frames - offset) * 160], [window], offset)[0]
+                factor = max(round(window_frames / len(speech_token)), 1) if factor is None else factor
+                yield merge_window_tokens([window], [speech_token], factor)
+                num_windows += 1
+                # audio before the next window is not needed anymore
+                buffer, offset = buffer[:, (num_windows * hop - offset) * 160:], num_windows * hop
+        num_frames = offset + buffer.shape[1] // 160
+        windows = split_speech_windows(num_frames, window_frames, overlap_frames)[num_windows:]
+        if num_frames != 0:
+            yield merge_window_tokens(windows, self._extract_window_tokens(buffer, windows, offset), factor)
+
+    def _extract_window_tokens(self, speech, windows, offset=0):
+        # speech starts at frame offset, the last window takes all remaining audio,
+        # whisper log mel is normalized by its own maximum, so every window computes mel from its own audio
+        feats = [whisper.log_mel_spectrogram(speech[:, (start - offset) * 160: (end - offset) * 160 if i != len(windows) - 1 else speech.shape[1]], n_mels=128)
+                 for i, (start, end, _, _) in enumerate(windows)]
+        if len(feats) == 1 and self.speech_token_batcher is not None:
+            return [self.speech_token_batcher.submit(feats[0])]
+        return self._extract_speech_token_batch(feats)
+
+    def _extract_speech_token_batch(self, feats):
+        # feats are (1, 128, T) log mels, right padded into one onnx call, the tokenizer masks frames beyond feats_length
+        feat_lens = [feat.shape[2] for feat in feats]
+        feat = torch.concat([F.pad(feat, (0, max(feat_lens) - feat.shape[2])) for feat in feats], dim=0)
         speech_token = self.speech_tokenizer_session.run(None,
                                                          {self.speech_tokenizer_session.get_inputs()[0].name:
                                                           feat.detach().cpu().numpy(),
                                                           self.speech_tokenizer_session.get_inputs()[1].name:
-                                                          np.array([feat.shape[2]], dtype=np.int32)})[0].flatten().tolist()
-        speech_token = torch.tensor([speech_token], dtype=torch.int32).to(self.device)
-        speech_token_len = torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(self.device)
-        return speech_token, speech_token_len
+                                                          np.array(feat_lens, dtype=np.int32)})[0]
+        # NOTE tokens of the padded tail are dropped, the tokenizer downsamples mel frames by a fixed factor with ceil rounding
+        factor = max(int(round(feat.shape[2] / speech_token.shape[1])), 1)
+        return [speech_token[i, :(feat_lens[i] + factor - 1) // factor].tolist() for i in range(len(feats))]
 
     def _extract_spk_embedding(self, speech):
         feat = kaldi.fbank(speech,
@@ -107,17 +170,59 @@ class CosyVoiceFrontEnd:
                            dither=0,
                            sample_frequency=16000)
         feat = feat - feat.mean(dim=0, keepdim=True)
-        embedding = self.campplus_session.run(None,
-                                              {self.campplus_session.get_inputs()[0].name: feat.unsqueeze(dim=0).cpu().numpy()})[0].flatten().tolist()
+        if self.spk_embedding_batcher is not None:
+            embedding = self.spk_embedding_batcher.submit(feat)
+        else:
+            embedding = self._extract_spk_embedding_batch([feat])[0]
         embedding = torch.tensor([embedding]).to(self.device)
         return embedding
 
+    def _extract_spk_embedding_batch(self, feats):
+        # NOTE campplus has no length input and pools over all frames, padding would change the embedding,
+        # so only prompts with the same number of frames share one onnx call
+        groups = {}
+        for i, feat in enumerate(feats):
+            groups.setdefault(feat.shape[0], []).append(i)
+        embeddings = [None] * len(feats)
+        for index in groups.values():
+            embedding = self.campplus_session.run(None,
+                                                  {self.campplus_session.get_inputs()[0].name: torch.stack([feats[i] for i in index], dim=0).cpu().numpy()})[0]
+            for j, i in enumerate(index):
+                embeddings[i] = embedding[j].flatten().tolist()
+        return embeddings
+
     def _extract_speech_feat(self, speech):
         speech_feat = self.feat_extractor(speech).squeeze(dim=0).transpose(0, 1).to(self.device)
         speech_feat = speech_feat.unsqueeze(dim=0)
         speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
         return speech_feat, speech_feat_len
 
+    def load_prompt_cache(self, max_bytes, ttl=3600):
+        self.prompt_cache = LRUCache(max_bytes, ttl)
+        metrics.register_cache('prompt', self.prompt_cache)
+
+    def load_micro_batching(self, max_batch_size, max_wait_ms=5):
+        # NOTE prompt audios of concurrent requests arriving within max_wait_ms are tokenized in one batched onnx call
+        self.speech_token_batcher = MicroBatcher(self._extract_speech_token_batch, max_batch_size, max_wait_ms / 1000, 'speech_token_batcher')
+        self.spk_embedding_batcher = MicroBatcher(self._extract_spk_embedding_batch, max_batch_size, max_wait_ms / 1000, 'spk_embedding_batcher')
+
+    def _extract_prompt(self, prompt_speech_16k, resample_rate):
+        # NOTE speech_feat/speech_token/embedding only depend on prompt wav, cache them by content hash
+        key = None
+        if self.prompt_cache is not None:
+            key = '{}_{}'.format(tensor_hash(prompt_speech_16k), resample_rate)
+            prompt = self.prompt_cache.get(key)
+            if prompt is not None:
+                return prompt
+        prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
+        speech_feat, _ = self._extract_speech_feat(prompt_speech_resample)
+        speech_token, _ = self._extract_speech_token(prompt_speech_16k)
+        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        prompt = (speech_feat, speech_token, embedding)
+        if key is not None:
+            self.prompt_cache.put(key, prompt)
+        return prompt
+
     def text_normalize(self, text, split=True, text_frontend=True):
         if isinstance(text, Generator):
             logging.info('get tts_text generator, will skip text_normalize!')
@@ -158,15 +263,13 @@ class CosyVoiceFrontEnd:
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
         if zero_shot_spk_id == '':
             prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-            prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
-            speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
-            speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
+            speech_feat, speech_token, embedding = self._extract_prompt(prompt_speech_16k, resample_rate)
             if resample_rate == 24000:
                 # cosyvoice2, force speech_feat % speech_token = 2
                 token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
-                speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
-                speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
-            embedding = self._extract_spk_embedding(prompt_speech_16k)
+                speech_feat, speech_token = speech_feat[:, :2 * token_len], speech_token[:, :token_len]
+            speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
+            speech_token_len = torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(self.device)
             model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
                            'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
                            'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
@@ -203,11 +306,15 @@ class CosyVoiceFrontEnd:
         return model_input
 
     def frontend_vc(self, source_speech_16k, prompt_speech_16k, resample_rate):
-        prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_speech_16k)
-        prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
-        prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
-        embedding = self._extract_spk_embedding(prompt_speech_16k)
-        source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
+        prompt_speech_feat, prompt_speech_token, embedding = self._extract_prompt(prompt_speech_16k, resample_rate)
+        prompt_speech_feat_len = torch.tensor([prompt_speech_feat.shape[1]], dtype=torch.int32).to(self.device)
+        prompt_speech_token_len = torch.tensor([prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device)
+        if isinstance(source_speech_16k, Generator):
+            logging.info('get source speech generator, will return _extract_speech_token_stream!')
+            # NOTE add a dummy source_speech_token_len for compatibility
+            source_speech_token, source_speech_token_len = self._extract_speech_token_stream(source_speech_16k), torch.tensor([0], dtype=torch.int32).to(self.device)
+        else:
+            source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
         model_input = {'source_speech_token': source_speech_token, 'source_speech_token_len': source_speech_token_len,
                        'flow_prompt_speech_token': prompt_speech_token, 'flow_prompt_speech_token_len': prompt_speech_token_len,
                        'prompt_speech_feat': prompt_speech_feat, 'prompt_speech_feat_len': prompt_speech_feat_len,
@@ -13,17 +13,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import time
 from typing import Generator
 import torch
 import numpy as np
 import threading
-import time
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
 from contextlib import nullcontext
 import uuid
 from cosyvoice.utils.common import fade_in_out
 from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
 from cosyvoice.utils.common import TrtContextWrapper
+from cosyvoice.utils.metrics import metrics
+from cosyvoice.cli.session import TTSSession
+from cosyvoice.utils.memory import MemoryPolicy
 
 
 class CosyVoiceModel:
@@ -46,23 +50,26 @@ class CosyVoiceModel:
         self.token_overlap_len = 20
         # mel fade in out
         self.mel_overlap_len = int(self.token_overlap_len / self.flow.input_frame_rate * 22050 / 256)
-        self.mel_window = np.hamming(2 * self.mel_overlap_len)
+        self.mel_window_len = 2 * self.mel_overlap_len
         # hift cache
         self.mel_cache_len = 20
         self.source_cache_len = int(self.mel_cache_len * 256)
         # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
+        self.speech_window_len = 2 * self.source_cache_len
         # rtf and decoding related
         self.stream_scale_factor = 1
         assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
         self.lock = threading.Lock()
         # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.mel_overlap_dict = {}
-        self.flow_cache_dict = {}
-        self.hift_cache_dict = {}
+        self.session_dict = {}
+        self.memory_policy = MemoryPolicy()
+        # NOTE yield speech on the inference device, so that servers convert it to pcm before copying to host
+        self.speech_on_device = False
+        metrics.instrument(self, {'llm_job': 'llm', 'wait_speech_token': 'llm_wait', 'token2wav': 'token2wav'})
+        metrics.instrument(self.flow, {'inference': 'flow', 'inference_chunk': 'flow', 'batch_inference': 'flow'})
+        metrics.instrument(self.hift, {'inference': 'hift'})
+        metrics.register_gauge('active_sessions', lambda: len(self.session_dict))
 
     def load(self, llm_model, flow_model, hift_model):
         self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=True)
@@ -100,141 +107,196 @@ class CosyVoiceModel:
         input_names = ["x", "mask", "mu", "cond"]
         return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
 
+    def load_memory_policy(self, memory_policy):
+        # NOTE with batched token2wav one session computes outputs of others, which is not safe across session streams
+        assert memory_policy.session_stream is False or getattr(self, 'token2wav_batch_size', 1) == 1, 'session_stream do not support token2wav batching!'
+        self.memory_policy = memory_policy
+
+    def load_speech_on_device(self):
+        self.speech_on_device = torch.cuda.is_available()
+
+    def output_speech(self, tts_speech):
+        if self.speech_on_device is False:
+            return tts_speech.cpu()
+        # consumer reads speech on the default stream, make it wait for the session stream on gpu instead of synchronizing host
+        default_stream = torch.cuda.default_stream(tts_speech.device)
+        default_stream.wait_stream(torch.cuda.current_stream(tts_speech.device))
+        tts_speech.record_stream(default_stream)
+        return tts_speech
+
     def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
-        with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
-            if isinstance(text, Generator):
-                assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2 and do not support vllm!'
-                for i in self.llm.inference_bistream(text=text,
-                                                     prompt_text=prompt_text.to(self.device),
-                                                     prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                                     prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                                     prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                     embedding=llm_embedding.to(self.device)):
-                    self.tts_speech_token_dict[uuid].append(i)
-            else:
-                for i in self.llm.inference(text=text.to(self.device),
-                                            text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
-                                            prompt_text=prompt_text.to(self.device),
-                                            prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                            prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                            prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                            embedding=llm_embedding.to(self.device),
-                                            uuid=uuid):
-                    self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
+        session = self.session_dict[uuid]
+        try:
+            with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
+                if isinstance(text, Generator):
+                    assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2 and do not support vllm!'
+                    for i in self.llm.inference_bistream(text=text,
+                                                         prompt_text=prompt_text.to(self.device),
+                                                         prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                         prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                         prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                         embedding=llm_embedding.to(self.device)):
+                        if session.stop is True:
+                            break
+                        self.append_speech_token(session, [i])
+                else:
+                    for i in self.llm.inference(text=text.to(self.device),
+                                                text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                                                prompt_text=prompt_text.to(self.device),
+                                                prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                embedding=llm_embedding.to(self.device),
+                                                uuid=uuid):
+                        # NOTE consumer is gone, stop generating, closing the llm generator also releases its batch engine slot
+                        if session.stop is True:
+                            break
+                        self.append_speech_token(session, [i])
+        finally:
+            # NOTE always mark llm end, otherwise tts will wait forever when llm raises exception
+            session.speech_token.set_end()
 
     def vc_job(self, source_speech_token, uuid):
-        self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
-        self.llm_end_dict[uuid] = True
+        session = self.session_dict[uuid]
+        try:
+            if isinstance(source_speech_token, Generator):
+                # NOTE streaming vc, tokens of the source speech arrive window by window while it is being recorded
+                for i in source_speech_token:
+                    if session.stop is True:
+                        break
+                    if len(i) != 0:
+                        self.append_speech_token(session, i)
+            else:
+                self.append_speech_token(session, source_speech_token.flatten().tolist())
+        finally:
+            session.speech_token.set_end()
+
+    def append_speech_token(self, session, tokens):
+        metrics.count_tokens(len(tokens))
+        session.speech_token.append(tokens)
+
+    def wait_speech_token(self, session, token_len):
+        # block until at least token_len speech tokens are available or llm_job is finished
+        session.speech_token.wait(token_len)
 
     def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
+        session = self.session_dict[uuid]
+        n_timesteps = session.flow_steps(session.num_chunks)
+        session.num_chunks += 1
         with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device),
-                                                                      token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                                                      prompt_token=prompt_token.to(self.device),
-                                                                      prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                                      prompt_feat=prompt_feat.to(self.device),
-                                                                      prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                                                      embedding=embedding.to(self.device),
-                                                                      flow_cache=self.flow_cache_dict[uuid])
+            tts_mel, session.flow_cache = self.flow.inference(token=token.to(self.device),
+                                                              token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                              prompt_token=prompt_token.to(self.device),
+                                                              prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                              prompt_feat=prompt_feat.to(self.device),
+                                                              prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                              embedding=embedding.to(self.device),
+                                                              flow_cache=session.flow_cache,
+                                                              n_timesteps=n_timesteps,
+                                                              solver=session.solver,
+                                                              cfg_rate=session.cfg_rate,
+                                                              cfg_interval=session.cfg_interval)
 
         # mel overlap fade in out
-        if self.mel_overlap_dict[uuid].shape[2] != 0:
-            tts_mel = fade_in_out(tts_mel, self.mel_overlap_dict[uuid], self.mel_window)
+        if session.mel_overlap.shape[2] != 0:
+            tts_mel = fade_in_out(tts_mel, session.mel_overlap, self.mel_window_len)
         # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+        if session.hift_cache is not None:
+            hift_cache_mel, hift_cache_source = session.hift_cache['mel'], session.hift_cache['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
         # keep overlap mel and hift cache
         if finalize is False:
-            self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
+            session.mel_overlap = tts_mel[:, :, -self.mel_overlap_len:]
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
-                                          'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window_len)
+            session.hift_cache = {'mel': tts_mel[:, :, -self.mel_cache_len:],
+                                  'source': tts_source[:, :, -self.source_cache_len:],
+                                  'speech': tts_speech[:, -self.source_cache_len:]}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
+                assert session.hift_cache is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window_len)
         return tts_speech
 
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0,
+            n_timesteps=10, solver='euler', cfg_rate=None, cfg_interval=1, **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
+        session = TTSSession(this_uuid, self.device, mel_overlap=torch.zeros(1, 80, 0), flow_cache=torch.zeros(1, 80, 0, 2), n_timesteps=n_timesteps, solver=solver,
+                             cfg_rate=cfg_rate, cfg_interval=cfg_interval)
+        session.stream = self.memory_policy.acquire_stream()
         with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
-        if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
-        else:
-            p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
-        p.start()
-        if stream is True:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
+            self.session_dict[this_uuid] = session
+        try:
+            if not isinstance(source_speech_token, Generator) and source_speech_token.shape[1] == 0:
+                p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
+            else:
+                p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
+            p.start()
+            if stream is True:
+                token_hop_len, token_offset = self.token_min_hop_len, 0
+                while True:
+                    self.wait_speech_token(session, token_offset + token_hop_len + self.token_overlap_len)
+                    if len(session.speech_token) - token_offset >= token_hop_len + self.token_overlap_len:
+                        with self.memory_policy.stream(session.stream):
+                            this_tts_speech_token = session.speech_token.get(token_offset, token_offset + token_hop_len + self.token_overlap_len)
+                            this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                             prompt_token=flow_prompt_speech_token,
+                                                             prompt_feat=prompt_speech_feat,
+                                                             embedding=flow_embedding,
+                                                             uuid=this_uuid,
+                                                             finalize=False)
+                            this_tts_speech = self.output_speech(this_tts_speech)
+                        yield {'tts_speech': this_tts_speech}
+                        token_offset += token_hop_len
+                        # increase token_hop_len for better speech quality
+                        token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
+                    if session.speech_token.end is True and len(session.speech_token) - token_offset < token_hop_len + self.token_overlap_len:
+                        break
+                p.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                with self.memory_policy.stream(session.stream):
+                    this_tts_speech_token = session.speech_token.get(token_offset)
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
                                                      uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-            self.flow_cache_dict.pop(this_uuid)
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.current_stream().synchronize()
+                                                     finalize=True)
+                    this_tts_speech = self.output_speech(this_tts_speech)
+                yield {'tts_speech': this_tts_speech}
+            else:
+                # deal with all tokens
+                p.join()
+                with self.memory_policy.stream(session.stream):
+                    this_tts_speech_token = session.speech_token.get()
+                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                     prompt_token=flow_prompt_speech_token,
+                                                     prompt_feat=prompt_speech_feat,
+                                                     embedding=flow_embedding,
+                                                     uuid=this_uuid,
+                                                     finalize=True,
+                                                     speed=speed)
+                    this_tts_speech = self.output_speech(this_tts_speech)
+                yield {'tts_speech': this_tts_speech}
+        finally:
+            # NOTE also reached when the generator is closed early (e.g. client disconnect), so the session never leaks
+            session.stop = True
+            with self.lock:
+                self.session_dict.pop(this_uuid)
+            self.memory_policy.release(session.stream)
 
 
 class CosyVoice2Model(CosyVoiceModel):
@@ -258,14 +320,27 @@ class CosyVoice2Model(CosyVoiceModel):
         self.mel_cache_len = 8
         self.source_cache_len = int(self.mel_cache_len * 480)
         # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
+        self.speech_window_len = 2 * self.source_cache_len
         # rtf and decoding related
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
         self.lock = threading.Lock()
         # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.hift_cache_dict = {}
+        self.session_dict = {}
+        self.memory_policy = MemoryPolicy()
+        # NOTE yield speech on the inference device, so that servers convert it to pcm before copying to host
+        self.speech_on_device = False
+        # incremental flow related
+        self.incremental_flow = False
+        # streaming hift related
+        self.streaming_hift = False
+        # token2wav batching related
+        self.token2wav_batch_size = 1
+        self.token2wav_lock = threading.Lock()
+        self.token2wav_queue = []
+        metrics.instrument(self, {'llm_job': 'llm', 'wait_speech_token': 'llm_wait', 'token2wav': 'token2wav'})
+        metrics.instrument(self.flow, {'inference': 'flow', 'inference_chunk': 'flow', 'batch_inference': 'flow'})
+        metrics.instrument(self.hift, {'inference': 'hift', 'inference_stream': 'hift'})
+        metrics.register_gauge('active_sessions', lambda: len(self.session_dict))
 
     def load_jit(self, flow_encoder_model):
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
@@ -282,7 +357,56 @@ class CosyVoice2Model(CosyVoiceModel):
         self.llm.lock = threading.Lock()
         del self.llm.llm.model.model.layers
 
+    def load_batch_engine(self, max_batch_size):
+        from cosyvoice.llm.engine import ContinuousBatchingEngine
+        self.llm.batch_engine = ContinuousBatchingEngine(self.llm, max_batch_size)
+        self.llm.lock = threading.Lock()
+
+    def load_prefix_cache(self, max_bytes):
+        self.llm.load_prefix_cache(max_bytes)
+
+    def load_incremental_flow(self):
+        # NOTE encoder/decoder caches are kept for the whole utterance, which costs a lot of memory for long utterance
+        assert hasattr(self.flow.encoder, 'forward_chunk'), 'incremental flow does not support jit flow encoder'
+        assert isinstance(self.flow.decoder.estimator, torch.nn.Module), 'incremental flow does not support trt flow decoder estimator'
+        self.incremental_flow = True
+
+    def load_static_shape(self, buckets=(256, 512, 768, 1024, 1536, 2048, 3000)):
+        # NOTE cuda graphs of default flow settings are captured now, in the dtype and autocast mode token2wav runs with,
+        # other settings and torch.compile on cpu cost one capture/compile at their first use
+        with torch.cuda.amp.autocast(self.fp16):
+            self.flow.decoder.load_static_shape(buckets, torch.float16 if self.fp16 is True else torch.float32)
+
+    def load_streaming_hift(self):
+        # NOTE hift keeps its conv/phase/overlap add states in session.hift_cache, no mel/source overlap and speech fade in out is needed
+        assert hasattr(self.hift, 'inference_stream'), 'streaming hift only support HiFTGenerator'
+        self.streaming_hift = True
+
+    def load_token2wav_batching(self, max_batch_size):
+        assert self.memory_policy.session_stream is False, 'session_stream do not support token2wav batching!'
+        self.token2wav_batch_size = max_batch_size
+
+    def get_trt_kwargs(self):
+        if self.token2wav_batch_size == 1:
+            return super().get_trt_kwargs()
+        # NOTE cfg doubles the batch size of estimator
+        max_batch_size, opt_batch_size = self.token2wav_batch_size * 2, 2 * 2
+        min_shape = [(2, 80, 4), (2, 1, 4), (2, 80, 4), (2, 80, 4), (2,), (2, 80)]
+        opt_shape = [(opt_batch_size, 80, 500), (opt_batch_size, 1, 500), (opt_batch_size, 80, 500), (opt_batch_size, 80, 500), (opt_batch_size,), (opt_batch_size, 80)]
+        max_shape = [(max_batch_size, 80, 3000), (max_batch_size, 1, 3000), (max_batch_size, 80, 3000), (max_batch_size, 80, 3000), (max_batch_size,), (max_batch_size, 80)]
+        input_names = ["x", "mask", "mu", "cond", "t", "spks"]
+        return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
+
     def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
+        if self.incremental_flow is True and (stream is True or self.session_dict[uuid].flow_cache is not None):
+            return self.token2wav_incremental(token, prompt_token, prompt_feat, embedding, token_offset, uuid, finalize)
+        session = self.session_dict[uuid]
+        n_timesteps = session.flow_steps(session.num_chunks)
+        session.num_chunks += 1
+        if self.token2wav_batch_size > 1:
+            return self.token2wav_batched(token=token, prompt_token=prompt_token, prompt_feat=prompt_feat, embedding=embedding,
+                                          token_offset=token_offset, uuid=uuid, stream=stream, finalize=finalize, speed=speed,
+                                          n_timesteps=n_timesteps, solver=session.solver, cfg_rate=session.cfg_rate, cfg_interval=session.cfg_interval)
         with torch.cuda.amp.autocast(self.fp16):
             tts_mel, _ = self.flow.inference(token=token.to(self.device),
                                              token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
@@ -292,95 +416,222 @@ class CosyVoice2Model(CosyVoiceModel):
                                              prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
                                              embedding=embedding.to(self.device),
                                              streaming=stream,
-                                             finalize=finalize)
+                                             finalize=finalize,
+                                             n_timesteps=n_timesteps,
+                                             solver=session.solver,
+                                             cfg_rate=session.cfg_rate,
+                                             cfg_interval=session.cfg_interval)
         tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+        if self.use_streaming_hift(uuid, finalize):
+            return self.hift_stream(tts_mel, uuid, finalize)
+        tts_mel, hift_cache_source = self.prepare_hift_input(tts_mel, uuid, finalize, speed)
+        tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+        return self.process_hift_output(tts_speech, tts_mel, tts_source, uuid, finalize)
+
+    def token2wav_incremental(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, finalize=False):
+        # only tokens after token_offset are new, flow encoder and decoder states of previous tokens are kept in session.flow_cache
+        session = self.session_dict[uuid]
+        if token.shape[1] == token_offset:
+            tts_mel = torch.zeros(1, self.flow.output_size, 0, device=self.device)
+        else:
+            with torch.cuda.amp.autocast(self.fp16):
+                tts_mel, session.flow_cache = self.flow.inference_chunk(token=token[:, token_offset:].to(self.device),
+                                                                        prompt_token=prompt_token.to(self.device),
+                                                                        prompt_feat=prompt_feat.to(self.device),
+                                                                        embedding=embedding.to(self.device),
+                                                                        finalize=finalize,
+                                                                        cache=session.flow_cache,
+                                                                        # NOTE estimator cache is kept per ode step, so the schedule of first chunk is used for all chunks
+                                                                        n_timesteps=session.flow_steps(0),
+                                                                        solver=session.solver,
+                                                                        cfg_rate=session.cfg_rate,
+                                                                        cfg_interval=session.cfg_interval)
+        if self.use_streaming_hift(uuid, finalize):
+            return self.hift_stream(tts_mel, uuid, finalize)
+        tts_mel, hift_cache_source = self.prepare_hift_input(tts_mel, uuid, finalize)
+        tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+        return self.process_hift_output(tts_speech, tts_mel, tts_source, uuid, finalize)
+
+    def use_streaming_hift(self, uuid, finalize=False):
+        # NOTE non-stream inference is a single finalized call, it keeps offline hift which also supports speed change
+        return self.streaming_hift is True and (finalize is False or self.session_dict[uuid].hift_cache is not None)
+
+    def hift_stream(self, tts_mel, uuid, finalize=False):
+        session = self.session_dict[uuid]
+        tts_speech, session.hift_cache = self.hift.inference_stream(speech_feat=tts_mel, cache=session.hift_cache, finalize=finalize)
+        return tts_speech
+
+    def prepare_hift_input(self, tts_mel, uuid, finalize=False, speed=1.0):
+        session = self.session_dict[uuid]
         # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+        if session.hift_cache is not None:
+            hift_cache_mel, hift_cache_source = session.hift_cache['mel'], session.hift_cache['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
+        if finalize is True and speed != 1.0:
+            assert session.hift_cache is None, 'speed change only support non-stream inference mode'
+            tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
+        return tts_mel, hift_cache_source
+
+    def process_hift_output(self, tts_speech, tts_mel, tts_source, uuid, finalize=False, faded=False):
+        session = self.session_dict[uuid]
+        if session.hift_cache is not None and faded is False:
+            tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window_len)
         # keep overlap mel and hift cache
         if finalize is False:
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
-                                          'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
+            session.hift_cache = {'mel': tts_mel[:, :, -self.mel_cache_len:],
+                                  'source': tts_source[:, :, -self.source_cache_len:],
+                                  'speech': tts_speech[:, -self.source_cache_len:]}
             tts_speech = tts_speech[:, :-self.source_cache_len]
-        else:
-            if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
-                tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
         return tts_speech
 
+    def fade_hift_output(self, tts_speech, uuids):
+        # crossfade all rows in one call when every session already has hift cache, which is the steady state of batched streaming
+        hift_caches = [self.session_dict[uuid].hift_cache for uuid in uuids]
+        if all(hift_cache is not None for hift_cache in hift_caches):
+            return fade_in_out(tts_speech, torch.concat([hift_cache['speech'] for hift_cache in hift_caches], dim=0), self.speech_window_len), True
+        return tts_speech, False
+
+    def token2wav_batched(self, **kwargs):
+        request = kwargs
+        request['enqueue_time'] = time.time()
+        with self.lock:
+            self.token2wav_queue.append(request)
+        # NOTE whoever holds token2wav_lock runs token2wav for all pending requests of all sessions
+        while 'tts_speech' not in request and 'exception' not in request:
+            with self.token2wav_lock:
+                if 'tts_speech' in request or 'exception' in request:
+                    break
+                with self.lock:
+                    batch = self.token2wav_queue[:self.token2wav_batch_size]
+                    del self.token2wav_queue[:self.token2wav_batch_size]
+                for r in batch:
+                    metrics.observe_queue('token2wav', time.time() - r['enqueue_time'])
+                try:
+                    for r, tts_speech in zip(batch, self.token2wav_batch(batch)):
+                        r['tts_speech'] = tts_speech
+                except Exception as e:
+                    for r in batch:
+                        r['exception'] = e
+        if 'exception' in request:
+            raise request['exception']
+        return request['tts_speech']
+
+    def token2wav_batch(self, requests):
+        tts_mels = [None] * len(requests)
+        # 1. flow, streaming flag changes decoder attention mask, so rows are grouped by it and by ode solver settings
+        groups = {}
+        for i, r in enumerate(requests):
+            groups.setdefault((r['stream'], r['n_timesteps'], r['solver'], r['cfg_rate'], r['cfg_interval']), []).append(i)
+        for (stream, n_timesteps, solver, cfg_rate, cfg_interval), index in groups.items():
+            batch = [requests[i] for i in index]
+            with torch.cuda.amp.autocast(self.fp16):
+                this_tts_mels = self.flow.batch_inference(token=pad_sequence([r['token'].squeeze(dim=0) for r in batch], batch_first=True).to(self.device),
+                                                          token_len=torch.tensor([r['token'].shape[1] for r in batch], dtype=torch.int32).to(self.device),
+                                                          prompt_token=pad_sequence([r['prompt_token'].squeeze(dim=0) for r in batch], batch_first=True).to(self.device),
+                                                          prompt_token_len=torch.tensor([r['prompt_token'].shape[1] for r in batch], dtype=torch.int32).to(self.device),
+                                                          prompt_feat=pad_sequence([r['prompt_feat'].squeeze(dim=0) for r in batch], batch_first=True).to(self.device),
+                                                          prompt_feat_len=torch.tensor([r['prompt_feat'].shape[1] for r in batch], dtype=torch.int32).to(self.device),
+                                                          embedding=torch.concat([r['embedding'] for r in batch], dim=0).to(self.device),
+                                                          streaming=stream,
+                                                          finalize=[r['finalize'] for r in batch],
+                                                          n_timesteps=n_timesteps,
+                                                          solver=solver,
+                                                          cfg_rate=cfg_rate,
+                                                          cfg_interval=cfg_interval)
+            for i, tts_mel in zip(index, this_tts_mels):
+                tts_mels[i] = tts_mel[:, :, requests[i]['token_offset'] * self.flow.token_mel_ratio:]
+        # 2. hift, rows with the same mel and cache source length are batched so that each row is computed exactly as batch 1
+        tts_speeches = [None] * len(requests)
+        hift_inputs, groups = {}, {}
+        for i, (r, tts_mel) in enumerate(zip(requests, tts_mels)):
+            if self.use_streaming_hift(r['uuid'], r['finalize']):
+                # streaming hift states differ per session, so these rows run one by one
+                tts_speeches[i] = self.hift_stream(tts_mel, r['uuid'], r['finalize'])
+                continue
+            hift_inputs[i] = self.prepare_hift_input(tts_mel, r['uuid'], r['finalize'], r['speed'])
+            groups.setdefault((hift_inputs[i][0].shape[2], hift_inputs[i][1].shape[2]), []).append(i)
+        for index in groups.values():
+            tts_speech, tts_source = self.hift.inference(speech_feat=torch.concat([hift_inputs[i][0] for i in index], dim=0),
+                                                         cache_source=torch.concat([hift_inputs[i][1] for i in index], dim=0))
+            tts_speech, faded = self.fade_hift_output(tts_speech, [requests[i]['uuid'] for i in index])
+            for j, i in enumerate(index):
+                tts_speeches[i] = self.process_hift_output(tts_speech[j:j + 1], hift_inputs[i][0], tts_source[j:j + 1], requests[i]['uuid'], requests[i]['finalize'], faded)
+        return tts_speeches
+
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0,
+            n_timesteps=10, solver='euler', cfg_rate=None, cfg_interval=1, **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
+        session = TTSSession(this_uuid, self.device, n_timesteps=n_timesteps, solver=solver,
+                             cfg_rate=cfg_rate, cfg_interval=cfg_interval)
+        session.stream = self.memory_policy.acquire_stream()
         with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-        if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
-        else:
-            p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
-        p.start()
-        if stream is True:
-            token_offset = 0
-            prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
-            while True:
-                time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
+            self.session_dict[this_uuid] = session
+        try:
+            if not isinstance(source_speech_token, Generator) and source_speech_token.shape[1] == 0:
+                p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
+            else:
+                p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
+            p.start()
+            if stream is True:
+                token_offset = 0
+                prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
+                while True:
+                    this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
+                    self.wait_speech_token(session, token_offset + this_token_hop_len + self.flow.pre_lookahead_len)
+                    if len(session.speech_token) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
+                        with self.memory_policy.stream(session.stream):
+                            this_tts_speech_token = session.speech_token.get(0, token_offset + this_token_hop_len + self.flow.pre_lookahead_len)
+                            this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                             prompt_token=flow_prompt_speech_token,
+                                                             prompt_feat=prompt_speech_feat,
+                                                             embedding=flow_embedding,
+                                                             token_offset=token_offset,
+                                                             uuid=this_uuid,
+                                                             stream=stream,
+                                                             finalize=False)
+                            token_offset += this_token_hop_len
+                            this_tts_speech = self.output_speech(this_tts_speech)
+                        yield {'tts_speech': this_tts_speech}
+                    if session.speech_token.end is True and len(session.speech_token) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
+                        break
+                p.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                with self.memory_policy.stream(session.stream):
+                    this_tts_speech_token = session.speech_token.get()
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
                                                      token_offset=token_offset,
                                                      uuid=this_uuid,
-                                                     stream=stream,
-                                                     finalize=False)
-                    token_offset += this_token_hop_len
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=token_offset,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=0,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.current_stream().synchronize()
+                                                     finalize=True)
+                    this_tts_speech = self.output_speech(this_tts_speech)
+                yield {'tts_speech': this_tts_speech}
+            else:
+                # deal with all tokens
+                p.join()
+                with self.memory_policy.stream(session.stream):
+                    this_tts_speech_token = session.speech_token.get()
+                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                     prompt_token=flow_prompt_speech_token,
+                                                     prompt_feat=prompt_speech_feat,
+                                                     embedding=flow_embedding,
+                                                     token_offset=0,
+                                                     uuid=this_uuid,
+                                                     finalize=True,
+                                                     speed=speed)
+                    this_tts_speech = self.output_speech(this_tts_speech)
+                yield {'tts_speech': this_tts_speech}
+        finally:
+            # NOTE also reached when the generator is closed early (e.g. client disconnect), so the session never leaks
+            session.stop = True
+            with self.lock:
+                self.session_dict.pop(this_uuid)
+            self.memory_policy.release(session.stream)
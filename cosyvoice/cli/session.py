@@ -0,0 +1,95 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import torch
+
+
+class SpeechTokenBuffer:
+    """Preallocated speech token buffer shared by one producer (llm_job) and one consumer (tts).
+
+    The producer writes tokens beyond the cursor and then publishes the new cursor, the consumer only reads
+    tokens before the cursor, so no lock is needed on the data path. The condition is only used to sleep
+    until enough tokens are published.
+    """
+
+    __slots__ = ('tokens', 'cursor', 'end', 'cond', 'event')
+
+    def __init__(self, device, capacity=1024):
+        self.tokens = torch.zeros(1, capacity, dtype=torch.int32, device=device)
+        self.cursor = 0
+        self.end = False
+        self.cond = threading.Condition()
+        # NOTE producer writes on llm stream, consumer waits for this event before reading on its own stream
+        self.event = torch.cuda.Event() if self.tokens.is_cuda else None
+
+    def __len__(self):
+        return self.cursor
+
+    def append(self, tokens):
+        cursor = self.cursor + len(tokens)
+        if cursor > self.tokens.shape[1]:
+            tokens_new = torch.zeros(1, max(cursor, 2 * self.tokens.shape[1]), dtype=self.tokens.dtype, device=self.tokens.device)
+            tokens_new[:, :self.cursor] = self.tokens[:, :self.cursor]
+            self.tokens = tokens_new
+        self.tokens[0, self.cursor:cursor] = torch.tensor(tokens, dtype=self.tokens.dtype)
+        if self.event is not None:
+            self.event.record()
+        with self.cond:
+            self.cursor = cursor
+            self.cond.notify_all()
+
+    def set_end(self):
+        with self.cond:
+            self.end = True
+            self.cond.notify_all()
+
+    def wait(self, token_len):
+        # block until at least token_len tokens are published or producer is finished
+        with self.cond:
+            self.cond.wait_for(lambda: self.cursor >= token_len or self.end is True)
+
+    def get(self, start=0, end=None):
+        end = self.cursor if end is None else min(end, self.cursor)
+        if self.event is not None:
+            torch.cuda.current_stream().wait_event(self.event)
+        return self.tokens[:, start:end]
+
+
+class TTSSession:
+    """All state of one tts call, created and removed by CosyVoiceModel.tts."""
+
+    __slots__ = ('uuid', 'speech_token', 'mel_overlap', 'flow_cache', 'hift_cache', 'stop', 'stream', 'n_timesteps', 'solver', 'cfg_rate', 'cfg_interval', 'num_chunks')
+
+    def __init__(self, uuid, device, mel_overlap=None, flow_cache=None, n_timesteps=10, solver='euler', cfg_rate=None, cfg_interval=1):
+        self.uuid = uuid
+        self.speech_token = SpeechTokenBuffer(device)
+        self.mel_overlap = mel_overlap
+        self.flow_cache = flow_cache
+        self.hift_cache = None
+        # NOTE set when the consumer is gone, llm_job checks it to stop generating tokens nobody will read
+        self.stop = False
+        # NOTE cuda stream owned by this session, None means the default stream
+        self.stream = None
+        # flow ode steps, an int or a per chunk schedule like [4, 10] whose last value is used for the remaining chunks
+        self.n_timesteps = n_timesteps
+        self.solver = solver
+        # classifier free guidance, cfg_rate None means the model default, 0 skips the unconditional branch
+        self.cfg_rate = cfg_rate
+        self.cfg_interval = cfg_interval
+        self.num_chunks = 0
+
+    def flow_steps(self, chunk_index):
+        if isinstance(self.n_timesteps, int):
+            return self.n_timesteps
+        return self.n_timesteps[min(chunk_index, len(self.n_timesteps) - 1)]
@@ -17,7 +17,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from einops import pack, rearrange, repeat
 from cosyvoice.utils.common import mask_to_bias
-from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import add_optional_chunk_mask, subsequent_chunk_mask_with_cache
 from matcha.models.components.decoder import SinusoidalPosEmb, Block1D, ResnetBlock1D, Downsample1D, TimestepEmbedding, Upsample1D
 from matcha.models.components.transformer import BasicTransformerBlock
 
@@ -61,6 +61,15 @@ class CausalConv1d(torch.nn.Conv1d):
         x = super(CausalConv1d, self).forward(x)
         return x
 
+    def forward_chunk(self, x: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        # cache is the last causal_padding input frames of previous chunk
+        if cache.size(2) != 0:
+            x = torch.concat([cache, x], dim=2)
+        x = F.pad(x, (self.causal_padding - cache.size(2), 0), value=0.0)
+        cache = x[:, :, x.size(2) - self.causal_padding:]
+        x = super(CausalConv1d, self).forward(x)
+        return x, cache
+
 
 class CausalBlock1D(Block1D):
     def __init__(self, dim: int, dim_out: int):
@@ -77,6 +86,11 @@ class CausalBlock1D(Block1D):
         output = self.block(x * mask)
         return output * mask
 
+    def forward_chunk(self, x: torch.Tensor, mask: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        output, cache = self.block[0].forward_chunk(x * mask, cache)
+        output = self.block[1:](output)
+        return output * mask, cache
+
 
 class CausalResnetBlock1D(ResnetBlock1D):
     def __init__(self, dim: int, dim_out: int, time_emb_dim: int, groups: int = 8):
@@ -84,6 +98,41 @@ class CausalResnetBlock1D(ResnetBlock1D):
         self.block1 = CausalBlock1D(dim, dim_out)
         self.block2 = CausalBlock1D(dim_out, dim_out)
 
+    def forward_chunk(self, x: torch.Tensor, mask: torch.Tensor, time_emb: torch.Tensor, cache: dict) -> torch.Tensor:
+        h, cache['block1'] = self.block1.forward_chunk(x, mask, cache.get('block1', torch.zeros(0, 0, 0)))
+        h += self.mlp(time_emb).unsqueeze(-1)
+        h, cache['block2'] = self.block2.forward_chunk(h, mask, cache.get('block2', torch.zeros(0, 0, 0)))
+        output = h + self.res_conv(x * mask)
+        return output
+
+
+def transformer_block_forward_chunk(block: BasicTransformerBlock, hidden_states: torch.Tensor, attention_mask: torch.Tensor, cache: dict) -> torch.Tensor:
+    """Same as BasicTransformerBlock.forward without cross attention, but keeps key/value of previous chunks in cache.
+
+    Args:
+        hidden_states: (batch, time, channels) of new frames
+        attention_mask: (batch, time, cache_time + time) attention bias
+        cache: dict, key/value of previous frames are read from and written to it
+    """
+    attn = block.attn1
+    norm_hidden_states = block.norm1(hidden_states)
+    batch_size = norm_hidden_states.size(0)
+    query, key, value = attn.to_q(norm_hidden_states), attn.to_k(norm_hidden_states), attn.to_v(norm_hidden_states)
+    head_dim = key.size(-1) // attn.heads
+    query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    if 'key' in cache:
+        key, value = torch.concat([cache['key'], key], dim=2), torch.concat([cache['value'], value], dim=2)
+    cache['key'], cache['value'] = key, value
+    attn_output = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask.unsqueeze(1), dropout_p=0.0, is_causal=False)
+    attn_output = attn_output.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim).to(query.dtype)
+    attn_output = attn.to_out[1](attn.to_out[0](attn_output))
+    hidden_states = attn_output + hidden_states
+    norm_hidden_states = block.norm3(hidden_states)
+    hidden_states = block.ff(norm_hidden_states) + hidden_states
+    return hidden_states
+
 
 class ConditionalDecoder(nn.Module):
     def __init__(
@@ -492,3 +541,63 @@ class CausalConditionalDecoder(ConditionalDecoder):
         x = self.final_block(x, mask_up)
         output = self.final_proj(x * mask_up)
         return output * mask
+
+    @torch.inference_mode()
+    def forward_chunk(self, x, mask, mu, t, spks=None, cond=None, offset=0, cache=None):
+        """Incremental streaming forward, only compute the new frames.
+
+        Args:
+            x, mask, mu, cond (torch.Tensor): new frames, shape (batch_size, *, time)
+            t (torch.Tensor): shape (batch_size)
+            spks (torch.Tensor, optional): shape: (batch_size, condition_channels)
+            offset (int): number of frames computed in previous chunks
+            cache (dict): conv and key/value cache of previous chunks of the same ode step, updated in place
+
+        Returns:
+            output of new frames, shape (batch_size, out_channels, time)
+        """
+        # NOTE Downsample1D/Upsample1D are not causal, only single level unet (len(channels) == 1) can run incrementally
+        assert len(self.down_blocks) == 1, 'forward_chunk only supports decoder with len(channels) == 1'
+        t = self.time_embeddings(t).to(t.dtype)
+        t = self.time_mlp(t)
+
+        x = pack([x, mu], "b * t")[0]
+
+        if spks is not None:
+            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
+            x = pack([x, spks], "b * t")[0]
+        if cond is not None:
+            x = pack([x, cond], "b * t")[0]
+
+        attn_mask = subsequent_chunk_mask_with_cache(x.size(2), offset, self.static_chunk_size, x.device).unsqueeze(0)
+        attn_mask = mask_to_bias(attn_mask, x.dtype)
+
+        hiddens = []
+        for i, (resnet, transformer_blocks, downsample) in enumerate(self.down_blocks):
+            x = resnet.forward_chunk(x, mask, t, cache.setdefault('down_{}_resnet'.format(i), {}))
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for j, transformer_block in enumerate(transformer_blocks):
+                x = transformer_block_forward_chunk(transformer_block, x, attn_mask, cache.setdefault('down_{}_transformer_{}'.format(i, j), {}))
+            x = rearrange(x, "b t c -> b c t").contiguous()
+            hiddens.append(x)  # Save hidden states for skip connections
+            x, cache['down_{}_downsample'.format(i)] = downsample.forward_chunk(x * mask, cache.get('down_{}_downsample'.format(i), torch.zeros(0, 0, 0)))
+
+        for i, (resnet, transformer_blocks) in enumerate(self.mid_blocks):
+            x = resnet.forward_chunk(x, mask, t, cache.setdefault('mid_{}_resnet'.format(i), {}))
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for j, transformer_block in enumerate(transformer_blocks):
+                x = transformer_block_forward_chunk(transformer_block, x, attn_mask, cache.setdefault('mid_{}_transformer_{}'.format(i, j), {}))
+            x = rearrange(x, "b t c -> b c t").contiguous()
+
+        for i, (resnet, transformer_blocks, upsample) in enumerate(self.up_blocks):
+            skip = hiddens.pop()
+            x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
+            x = resnet.forward_chunk(x, mask, t, cache.setdefault('up_{}_resnet'.format(i), {}))
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for j, transformer_block in enumerate(transformer_blocks):
+                x = transformer_block_forward_chunk(transformer_block, x, attn_mask, cache.setdefault('up_{}_transformer_{}'.format(i, j), {}))
+            x = rearrange(x, "b t c -> b c t").contiguous()
+            x, cache['up_{}_upsample'.format(i)] = upsample.forward_chunk(x * mask, cache.get('up_{}_upsample'.format(i), torch.zeros(0, 0, 0)))
+        x, cache['final_block'] = self.final_block.forward_chunk(x, mask, cache.get('final_block', torch.zeros(0, 0, 0)))
+        output = self.final_proj(x * mask)
+        return output * mask
@@ -110,7 +110,11 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=10,
+                  solver='euler',
+                  cfg_rate=None,
+                  cfg_interval=1):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -139,9 +143,12 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
-            cache=flow_cache
+            cache=flow_cache,
+            solver=solver,
+            cfg_rate=cfg_rate,
+            cfg_interval=cfg_interval
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
@@ -242,7 +249,11 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  n_timesteps=10,
+                  solver='euler',
+                  cfg_rate=None,
+                  cfg_interval=1):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -250,7 +261,8 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
 
         # concat text and prompt_text
         token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
-        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+        # NOTE pass max_len as python int, lengths.max().item() would synchronize the gpu
+        mask = (~make_pad_mask(token_len, token.shape[1])).unsqueeze(-1).to(embedding)
         token = self.input_embedding(torch.clamp(token, min=0)) * mask
 
         # text encode
@@ -267,15 +279,141 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         conds[:, :mel_len1] = prompt_feat
         conds = conds.transpose(1, 2)
 
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
+        mask = torch.ones([1, mel_len1 + mel_len2], device=h.device, dtype=h.dtype)
         feat, _ = self.decoder(
             mu=h.transpose(1, 2).contiguous(),
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver,
+            cfg_rate=cfg_rate,
+            cfg_interval=cfg_interval
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat.float(), None
+
+    @torch.inference_mode()
+    def inference_chunk(self,
+                        token,
+                        prompt_token,
+                        prompt_feat,
+                        embedding,
+                        finalize,
+                        cache=None,
+                        n_timesteps=10,
+                        solver='euler',
+                        cfg_rate=None,
+                        cfg_interval=1):
+        """Incremental streaming inference, only the new tokens are passed and only their mel is computed.
+
+        Args:
+            token: new tokens (1, T), the last pre_lookahead_len tokens are used as context if finalize is False
+            prompt_token, prompt_feat: only used for first chunk, prompt_token + first chunk must be multiple of chunk size
+            cache: cache returned by previous call, None for first chunk
+            n_timesteps, solver, cfg_rate, cfg_interval: must be the same for all chunks of one utterance
+        Returns:
+            feat: mel of new tokens (1, 80, T * token_mel_ratio)
+            cache: new cache
+        """
+        assert token.shape[0] == 1
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        if cache is None:
+            token = torch.concat([prompt_token, token], dim=1)
+            cache = {'encoder': None, 'decoder': None, 'offset': 0}
+            mel_len1 = prompt_feat.shape[1]
+        else:
+            mel_len1 = 0
+        token = self.input_embedding(torch.clamp(token, min=0))
+
+        # text encode
+        if finalize is True:
+            h, cache['encoder'] = self.encoder.forward_chunk(token, cache=cache['encoder'])
+        else:
+            token, context = token[:, :-self.pre_lookahead_len], token[:, -self.pre_lookahead_len:]
+            h, cache['encoder'] = self.encoder.forward_chunk(token, context=context, cache=cache['encoder'])
+        h = self.encoder_proj(h)
+
+        # get conditions
+        conds = torch.zeros([1, h.shape[1], self.output_size], device=token.device).to(h.dtype)
+        if mel_len1 != 0:
+            conds[:, :mel_len1] = prompt_feat
+        conds = conds.transpose(1, 2)
+
+        feat, cache['decoder'] = self.decoder.forward_chunk(
+            mu=h.transpose(1, 2).contiguous(),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            offset=cache['offset'],
+            cache=cache['decoder'],
+            solver=solver,
+            cfg_rate=cfg_rate,
+            cfg_interval=cfg_interval
+        )
+        cache['offset'] += h.shape[1]
+        feat = feat[:, :, mel_len1:]
+        return feat.float(), cache
+
+    @torch.inference_mode()
+    def batch_inference(self,
+                        token,
+                        token_len,
+                        prompt_token,
+                        prompt_token_len,
+                        prompt_feat,
+                        prompt_feat_len,
+                        embedding,
+                        streaming,
+                        finalize,
+                        n_timesteps=10,
+                        solver='euler',
+                        cfg_rate=None,
+                        cfg_interval=1):
+        # NOTE token/prompt_token/prompt_feat are right padded, finalize is a list of bool for each row,
+        # encoder runs row by row as pre lookahead context differs, decoder runs once over the padded batch
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        h_list, mel_len1, mel_len2 = [], [], []
+        for i in range(token.shape[0]):
+            this_token = torch.concat([prompt_token[i:i + 1, :prompt_token_len[i]], token[i:i + 1, :token_len[i]]], dim=1)
+            this_token_len = prompt_token_len[i:i + 1] + token_len[i:i + 1]
+            this_token = self.input_embedding(torch.clamp(this_token, min=0))
+            # text encode
+            if finalize[i] is True:
+                h, h_lengths = self.encoder(this_token, this_token_len, streaming=streaming)
+            else:
+                this_token, context = this_token[:, :-self.pre_lookahead_len], this_token[:, -self.pre_lookahead_len:]
+                h, h_lengths = self.encoder(this_token, this_token_len, context=context, streaming=streaming)
+            mel_len1.append(int(prompt_feat_len[i]))
+            mel_len2.append(h.shape[1] - int(prompt_feat_len[i]))
+            h_list.append(self.encoder_proj(h).squeeze(dim=0))
+        h_lengths = torch.tensor([h.shape[0] for h in h_list], device=token.device)
+        h = nn.utils.rnn.pad_sequence(h_list, batch_first=True)
+
+        # get conditions
+        conds = torch.zeros([token.shape[0], h.shape[1], self.output_size], device=token.device).to(h.dtype)
+        for i in range(token.shape[0]):
+            conds[i, :mel_len1[i]] = prompt_feat[i, :mel_len1[i]]
+        conds = conds.transpose(1, 2)
+
+        mask = (~make_pad_mask(h_lengths, h.shape[1])).to(h)
+        feat, _ = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask.unsqueeze(1),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver,
+            cfg_rate=cfg_rate,
+            cfg_interval=cfg_interval
+        )
+        return [feat[i:i + 1, :, mel_len1[i]:mel_len1[i] + mel_len2[i]].float() for i in range(token.shape[0])]
@@ -12,10 +12,32 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import itertools
+import math
+import threading
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
+from cosyvoice.flow.decoder import CausalConditionalDecoder
 from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.file_utils import logging
+
+SOLVERS = ('euler', 'midpoint', 'heun', 'multistep')
+# NOTE upper bound of client supplied flow steps, every step is one or two full estimator calls
+MAX_TIMESTEPS = 50
+
+
+def check_flow_settings(n_timesteps, solver='euler', cfg_rate=None, cfg_interval=1, max_timesteps=MAX_TIMESTEPS):
+    # validate flow settings taken from requests before inference starts, raises ValueError with the reason
+    schedule = n_timesteps if isinstance(n_timesteps, (list, tuple)) else [n_timesteps]
+    if len(schedule) == 0 or any(not isinstance(i, int) or not 1 <= i <= max_timesteps for i in schedule):
+        raise ValueError('n_timesteps must be integers in [1, {}], got {}'.format(max_timesteps, n_timesteps))
+    if solver not in SOLVERS:
+        raise ValueError('solver must be one of {}, got {}'.format(SOLVERS, solver))
+    if cfg_rate is not None and not (math.isfinite(cfg_rate) and cfg_rate >= 0):
+        raise ValueError('cfg_rate must be a non negative number, got {}'.format(cfg_rate))
+    if not isinstance(cfg_interval, int) or not 1 <= cfg_interval <= max_timesteps:
+        raise ValueError('cfg_interval must be an integer in [1, {}], got {}'.format(max_timesteps, cfg_interval))
 
 
 class ConditionalCFM(BASECFM):
@@ -32,9 +54,14 @@ class ConditionalCFM(BASECFM):
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
+        # static shape related, see load_static_shape
+        self.shape_buckets = None
+        self.graphs = {}
+        self.graph_lock = threading.Lock()
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2), solver='euler',
+                cfg_rate=None, cfg_interval=1):
         """Forward diffusion
 
         Args:
@@ -47,6 +74,8 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str): ode solver, one of SOLVERS
+            cfg_rate, cfg_interval: classifier free guidance settings, see solve_ode
 
         Returns:
             sample: generated mel-spectrogram
@@ -66,11 +95,11 @@ class ConditionalCFM(BASECFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), cache
+        return self.solve_ode(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver, cfg_rate=cfg_rate, cfg_interval=cfg_interval), cache
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False):
+    def solve_ode(self, x, t_span, mu, mask, spks, cond, streaming=False, solver='euler', cfg_rate=None, cfg_interval=1):
         """
-        Fixed euler solver for ODEs.
+        Fixed step solver for ODEs.
         Args:
             x (torch.Tensor): random noise
             t_span (torch.Tensor): n_timesteps interpolated
@@ -82,45 +111,179 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str): one of SOLVERS, see integrate
+            cfg_rate (float): classifier free guidance rate, None for inference_cfg_rate, 0 disables the unconditional branch
+            cfg_interval (int): compute the unconditional branch every cfg_interval estimator calls and reuse it in between
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
-
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
+        assert cfg_interval >= 1, 'cfg_interval must be positive'
+        mel_len = x.size(2)
+        bucket = self.get_shape_bucket(mel_len)
+        if bucket is None:
+            return self.ode_steps(x, t_span, mu, mask, spks, cond, streaming, solver, cfg_rate, cfg_interval)
+        # NOTE padded frames have zero mask, attention ignores them and CausalBlock1D normalizes per frame,
+        # so estimator output of valid frames is not affected, see load_static_shape
+        x, mu, mask, cond = [F.pad(i, (0, bucket - mel_len)) for i in [x, mu, mask, cond]]
+        if x.is_cuda:
+            return self.ode_steps_graph(x, t_span, mu, mask, spks, cond, streaming, solver, cfg_rate, cfg_interval)[:, :, :mel_len]
+        return self.ode_steps(x, t_span, mu, mask, spks, cond, streaming, solver, cfg_rate, cfg_interval)[:, :, :mel_len]
 
+    def ode_steps(self, x, t_span, mu, mask, spks, cond, streaming=False, solver='euler', cfg_rate=None, cfg_interval=1):
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        for step in range(1, len(t_span)):
+        # NOTE first half of the batch is conditional, second half is unconditional
+        B = x.size(0)
+        x_in = torch.zeros([2 * B, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in = torch.zeros([2 * B, 1, x.size(2)], device=x.device, dtype=x.dtype)
+        mu_in = torch.zeros([2 * B, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        t_in = torch.zeros([2 * B], device=x.device, dtype=x.dtype)
+        spks_in = torch.zeros([2 * B, 80], device=x.device, dtype=x.dtype)
+        cond_in = torch.zeros([2 * B, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in[:B], mask_in[B:] = mask, mask
+        mu_in[:B] = mu
+        spks_in[:B] = spks
+        cond_in[:B] = cond
+
+        cfg_rate = self.inference_cfg_rate if cfg_rate is None else cfg_rate
+        # NOTE cfg_rate is a 0-d tensor when it is an input of a cuda graph, guidance is never off then
+        cfg_off = not isinstance(cfg_rate, torch.Tensor) and cfg_rate == 0
+        # NOTE trt engine is built with min batch size 2, so it always runs the unconditional half
+        skip_uncond = isinstance(self.estimator, torch.nn.Module)
+        calls, uncond = itertools.count(), {}
+
+        def velocity(x, t):
             # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in,
-                streaming
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
+            # NOTE trt estimator writes its output into x_in, so x_in is refilled for every call
+            i = next(calls)
+            x_in[:B], x_in[B:] = x, x
+            t_in[:] = t
+            if skip_uncond is True and (cfg_off is True or i % cfg_interval != 0):
+                dphi_dt = self.forward_estimator(x_in[:B], mask_in[:B], mu_in[:B], t_in[:B], spks_in[:B], cond_in[:B], streaming)
+                if cfg_off is True:
+                    return dphi_dt
+                cfg_dphi_dt = uncond['dphi_dt']
+            else:
+                dphi_dt = self.forward_estimator(
+                    x_in, mask_in,
+                    mu_in, t_in,
+                    spks_in,
+                    cond_in,
+                    streaming
+                )
+                dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [B, B], dim=0)
+                uncond['dphi_dt'] = cfg_dphi_dt
+            return (1.0 + cfg_rate) * dphi_dt - cfg_rate * cfg_dphi_dt
+
+        return self.integrate(x, t_span, velocity, solver).float()
+
+    def integrate(self, x, t_span, velocity, solver='euler'):
+        """Integrate dx/dt = velocity(x, t) over t_span.
+
+        euler       1 estimator call per step, the reference solver used in training recipes
+        midpoint    2 estimator calls per step, second order
+        heun        2 estimator calls per step, second order
+        multistep   1 estimator call per step, second order adams-bashforth reusing the velocity of previous step,
+                    which is the velocity form of dpm-solver++(2m) style multistep solvers
+        """
+        assert solver in SOLVERS, 'unknown ode solver {}'.format(solver)
+        t = t_span[0].unsqueeze(dim=0)
+        v_prev, dt_prev = None, None
+        for step in range(1, len(t_span)):
+            dt = t_span[step] - t
+            if solver == 'euler':
+                x = x + dt * velocity(x, t)
+            elif solver == 'midpoint':
+                x = x + dt * velocity(x + 0.5 * dt * velocity(x, t), t + 0.5 * dt)
+            elif solver == 'heun':
+                v = velocity(x, t)
+                x = x + 0.5 * dt * (v + velocity(x + dt * v, t + dt))
+            else:
+                v = velocity(x, t)
+                if v_prev is None:
+                    x = x + dt * v
+                else:
+                    ratio = dt / (2 * dt_prev)
+                    x = x + dt * ((1 + ratio) * v - ratio * v_prev)
+                v_prev, dt_prev = v, dt
             t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
+        return x
+
+    def load_static_shape(self, buckets, dtype=torch.float32, n_timesteps=10, solver='euler'):
+        """Pad mel length up to the nearest bucket, so that every bucket is captured as one cuda graph of the whole
+        euler loop on gpu, or compiled once by torch.compile on cpu. Lengths beyond the largest bucket run eagerly.
+        Graphs of n_timesteps/solver with default cfg are captured here, other settings at their first use.
+
+        Only CausalConditionalDecoder (CosyVoice2) is supported, GroupNorm in ConditionalDecoder (CosyVoice) takes its
+        statistics over time, so padded frames would change the output of valid frames."""
+        assert isinstance(self.estimator, CausalConditionalDecoder), 'static shape only supports torch CausalConditionalDecoder estimator'
+        self.shape_buckets = sorted(buckets)
+        if torch.cuda.is_available():
+            self.graph_pool = torch.cuda.graph_pool_handle()
+            self.graph_event = None
+            # NOTE capture while no request is running cuda work in other threads
+            self.capture_buckets(dtype, n_timesteps, solver)
+        else:
+            # NOTE one compiled graph per bucket, batch size and streaming mode
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 4 * len(self.shape_buckets))
+            self.estimator = torch.compile(self.estimator, dynamic=False)
+
+    def get_shape_bucket(self, mel_len):
+        if self.shape_buckets is None:
+            return None
+        for bucket in self.shape_buckets:
+            if bucket >= mel_len:
+                return bucket
+        return None
+
+    @torch.inference_mode()
+    def capture_buckets(self, dtype, n_timesteps=10, solver='euler'):
+        device = next(self.estimator.parameters()).device
+        t_span = torch.linspace(0, 1, n_timesteps + 1, device=device, dtype=dtype)
+        if self.t_scheduler == 'cosine':
+            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+        for bucket in self.shape_buckets:
+            for streaming in [False, True]:
+                x, mu, cond = [torch.randn(1, 80, bucket, device=device, dtype=dtype) for _ in range(3)]
+                mask, spks = torch.ones(1, 1, bucket, device=device, dtype=dtype), torch.randn(1, 80, device=device, dtype=dtype)
+                self.ode_steps_graph(x, t_span, mu, mask, spks, cond, streaming, solver)
+        torch.cuda.synchronize()
 
-        return sol[-1].float()
+    def capture_graph(self, fn):
+        # NOTE warmup on a side stream before capture, autocast weight cache can not be used inside a graph
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), torch.cuda.amp.autocast(torch.is_autocast_enabled(), cache_enabled=False):
+            for _ in range(3):
+                fn()
+        torch.cuda.current_stream().wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        # NOTE thread_local only forbids unsafe cuda calls of this thread, other sessions may still run cuda work during a lazy capture
+        with torch.cuda.graph(graph, pool=self.graph_pool, capture_error_mode='thread_local'), torch.cuda.amp.autocast(torch.is_autocast_enabled(), cache_enabled=False):
+            output = fn()
+        return graph, output
+
+    def ode_steps_graph(self, x, t_span, mu, mask, spks, cond, streaming=False, solver='euler', cfg_rate=None, cfg_interval=1):
+        cfg_rate = self.inference_cfg_rate if cfg_rate is None else cfg_rate
+        # NOTE cfg_rate comes from requests, so it is filled into the graph like t_span instead of being part of the key,
+        # only whether guidance is off changes the captured graph
+        key = (tuple(x.shape), len(t_span), x.dtype, torch.is_autocast_enabled(), streaming, solver, cfg_rate == 0, cfg_interval)
+        # NOTE all graphs share one memory pool, so replays must be serialized
+        with self.graph_lock:
+            if self.graph_event is not None:
+                torch.cuda.current_stream().wait_event(self.graph_event)
+            if key not in self.graphs:
+                inputs = [i.clone() for i in [x, t_span, mu, mask, spks, cond]] + [torch.zeros([], device=x.device, dtype=x.dtype)]
+                graph_cfg_rate = 0 if cfg_rate == 0 else inputs[6]
+                graph, output = self.capture_graph(lambda: self.ode_steps(*inputs[:6], streaming, solver, graph_cfg_rate, cfg_interval))
+                self.graphs[key] = (graph, inputs, output)
+                logging.info('capture flow cuda graph {}'.format(key))
+            graph, inputs, output = self.graphs[key]
+            for i, j in zip(inputs, [x, t_span, mu, mask, spks, cond]):
+                i.copy_(j)
+            inputs[6].fill_(cfg_rate)
+            graph.replay()
+            output = output.clone()
+            self.graph_event = torch.cuda.Event()
+            self.graph_event.record()
+        return output
 
     def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False):
         if isinstance(self.estimator, torch.nn.Module):
@@ -130,12 +293,12 @@ class ConditionalCFM(BASECFM):
             # NOTE need to synchronize when switching stream
             torch.cuda.current_stream().synchronize()
             with stream:
-                estimator.set_input_shape('x', (2, 80, x.size(2)))
-                estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                estimator.set_input_shape('t', (2,))
-                estimator.set_input_shape('spks', (2, 80))
-                estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+                estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('t', (x.size(0),))
+                estimator.set_input_shape('spks', (x.size(0), 80))
+                estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
                 data_ptrs = [x.contiguous().data_ptr(),
                              mask.contiguous().data_ptr(),
                              mu.contiguous().data_ptr(),
@@ -200,7 +363,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False, solver='euler', cfg_rate=None, cfg_interval=1):
         """Forward diffusion
 
         Args:
@@ -213,15 +376,70 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str): ode solver, one of SOLVERS
+            cfg_rate, cfg_interval: classifier free guidance settings, see solve_ode
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        z = self.rand_noise[:, :, :mu.size(2)].repeat(mu.size(0), 1, 1).to(mu.device).to(mu.dtype) * temperature
         # fix prompt and overlap part mu and z
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming), None
+        return self.solve_ode(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, solver=solver,
+                              cfg_rate=cfg_rate, cfg_interval=cfg_interval), None
+
+    @torch.inference_mode()
+    def forward_chunk(self, mu, n_timesteps, temperature=1.0, spks=None, cond=None, offset=0, cache=None, solver='euler', cfg_rate=None, cfg_interval=1):
+        """Incremental streaming forward diffusion, only compute the new frames.
+
+        Args:
+            mu (torch.Tensor): output of encoder of new frames
+                shape: (1, n_feats, mel_timesteps)
+            n_timesteps (int): number of diffusion steps
+            offset (int): number of frames computed in previous chunks
+            cache (list): estimator cache of each estimator call, None for first chunk,
+                n_timesteps, solver and cfg settings must not change between chunks of the same utterance
+
+        Returns:
+            sample: generated mel-spectrogram of new frames
+                shape: (1, n_feats, mel_timesteps)
+            cache: new cache
+        """
+        assert isinstance(self.estimator, torch.nn.Module), 'incremental inference only supports torch estimator'
+        assert cfg_interval >= 1, 'cfg_interval must be positive'
+        if cache is None:
+            cache = []
+        z = self.rand_noise[:, :, offset:offset + mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
+        if self.t_scheduler == 'cosine':
+            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+        mask = torch.ones([2, 1, z.size(2)], device=z.device, dtype=z.dtype)
+        # first row is conditional, second row is unconditional
+        mu_in = torch.concat([mu, torch.zeros_like(mu)], dim=0)
+        spks_in = torch.concat([spks, torch.zeros_like(spks)], dim=0)
+        cond_in = torch.concat([cond, torch.zeros_like(cond)], dim=0)
+        cfg_rate = self.inference_cfg_rate if cfg_rate is None else cfg_rate
+        # NOTE the i-th estimator call of every chunk is evaluated at the same t with the same batch size, so it owns the i-th cache
+        calls, uncond = itertools.count(), {}
+
+        def velocity(x, t):
+            i = next(calls)
+            if i == len(cache):
+                cache.append({})
+            if cfg_rate == 0 or i % cfg_interval != 0:
+                dphi_dt = self.estimator.forward_chunk(x, mask[:1], mu, t, spks, cond, offset=offset, cache=cache[i])
+                if cfg_rate == 0:
+                    return dphi_dt
+                cfg_dphi_dt = uncond['dphi_dt']
+            else:
+                dphi_dt = self.estimator.forward_chunk(x.repeat(2, 1, 1), mask, mu_in, t.repeat(2), spks_in, cond_in, offset=offset, cache=cache[i])
+                dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
+                uncond['dphi_dt'] = cfg_dphi_dt
+            return (1.0 + cfg_rate) * dphi_dt - cfg_rate * cfg_dphi_dt
+
+        x = self.integrate(z, t_span, velocity, solver)
+        return x.float(), cache
@@ -13,6 +13,7 @@
 # limitations under the License.
 import torch
 import torch.nn as nn
+from cosyvoice.hifigan.streaming import stream_conv1d
 try:
     from torch.nn.utils.parametrizations import weight_norm
 except ImportError:
@@ -56,3 +57,9 @@ class ConvRNNF0Predictor(nn.Module):
         x = self.condnet(x)
         x = x.transpose(1, 2)
         return torch.abs(self.classifier(x).squeeze(-1))
+
+    def forward_stream(self, x: torch.Tensor, cache: dict, finalize: bool = False) -> torch.Tensor:
+        for i, layer in enumerate(self.condnet):
+            x = stream_conv1d(layer, x, cache.setdefault(i, {}), finalize) if isinstance(layer, nn.Conv1d) else layer(x)
+        x = x.transpose(1, 2)
+        return torch.abs(self.classifier(x).squeeze(-1))
@@ -29,6 +29,7 @@ except ImportError:
     from torch.nn.utils import weight_norm
 from torch.distributions.uniform import Uniform
 
+from cosyvoice.hifigan.streaming import stream_conv1d, stream_conv_transpose1d, stream_reflection_pad_left, stream_align, stream_stft, stream_istft
 from cosyvoice.transformer.activation import Snake
 from cosyvoice.utils.common import get_padding
 from cosyvoice.utils.common import init_weights
@@ -100,6 +101,17 @@ class ResBlock(torch.nn.Module):
             x = xt + x
         return x
 
+    def forward_stream(self, x: torch.Tensor, cache: dict, finalize: bool = False) -> torch.Tensor:
+        for idx in range(len(self.convs1)):
+            xt = self.activations1[idx](x)
+            xt = stream_conv1d(self.convs1[idx], xt, cache.setdefault('convs1_{}'.format(idx), {}), finalize)
+            xt = self.activations2[idx](xt)
+            xt = stream_conv1d(self.convs2[idx], xt, cache.setdefault('convs2_{}'.format(idx), {}), finalize)
+            # NOTE residual x is ahead of xt by the lookahead of the two convs
+            xt, x = stream_align([xt, x], cache.setdefault('residual_{}'.format(idx), {}))
+            x = xt + x
+        return x
+
     def remove_weight_norm(self):
         for idx in range(len(self.convs1)):
             remove_weight_norm(self.convs1[idx])
@@ -170,6 +182,30 @@ class SineGen(torch.nn.Module):
         sine_waves = sine_waves * uv + noise
         return sine_waves, uv, noise
 
+    @torch.no_grad()
+    def forward_stream(self, f0, cache, finalize=False):
+        """
+        :param f0: [B, 1, sample_len], Hz, new samples only
+        :return: [B, 1, sample_len]
+        """
+        # NOTE phase is carried across calls and random initial phase is sampled once per utterance
+        if len(cache) == 0:
+            u_dist = Uniform(low=-np.pi, high=np.pi)
+            cache['phase_vec'] = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(f0.device)
+            cache['phase_vec'][:, 0, :] = 0
+            cache['cumsum'] = torch.zeros(f0.size(0), self.harmonic_num + 1, 1, device=f0.device)
+        F_mat = f0 * torch.arange(1, self.harmonic_num + 2, device=f0.device)[None, :, None] / self.sampling_rate
+        cumsum = torch.cumsum(F_mat, dim=-1) + cache['cumsum']
+        if cumsum.shape[2] != 0:
+            cache['cumsum'] = cumsum[:, :, -1:]
+        theta_mat = 2 * np.pi * (cumsum % 1)
+        sine_waves = self.sine_amp * torch.sin(theta_mat + cache['phase_vec'])
+        uv = self._f02uv(f0)
+        noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
+        noise = noise_amp * torch.randn_like(sine_waves)
+        sine_waves = sine_waves * uv + noise
+        return sine_waves, uv, noise
+
 
 class SourceModuleHnNSF(torch.nn.Module):
     """ SourceModule for hn-nsf
@@ -195,6 +231,7 @@ class SourceModuleHnNSF(torch.nn.Module):
 
         self.sine_amp = sine_amp
         self.noise_std = add_noise_std
+        self.upsample_scale = int(upsample_scale)
 
         # to produce sine waveforms
         self.l_sin_gen = SineGen(sampling_rate, harmonic_num,
@@ -222,6 +259,19 @@ class SourceModuleHnNSF(torch.nn.Module):
         noise = torch.randn_like(uv) * self.sine_amp / 3
         return sine_merge, noise, uv
 
+    def forward_stream(self, f0, cache, finalize=False):
+        """
+        f0 (batchsize, frame_len) of new frames, upsampled here as f0_upsamp does
+        Sine_source (batchsize, length, 1)
+        """
+        with torch.no_grad():
+            sine_wavs, uv, _ = self.l_sin_gen.forward_stream(f0.repeat_interleave(self.upsample_scale, dim=1)[:, None], cache, finalize)
+            sine_wavs = sine_wavs.transpose(1, 2)
+            uv = uv.transpose(1, 2)
+        sine_merge = self.l_tanh(self.l_linear(sine_wavs))
+        noise = torch.randn_like(uv) * self.sine_amp / 3
+        return sine_merge, noise, uv
+
 
 class SineGen2(torch.nn.Module):
     """ Definition of sine generator
@@ -338,6 +388,44 @@ class SineGen2(torch.nn.Module):
         sine_waves = sine_waves * uv + noise
         return sine_waves, uv, noise
 
+    @torch.no_grad()
+    def forward_stream(self, f0, cache, finalize=False):
+        """ sine_tensor, uv = forward_stream(f0, cache, finalize)
+        input F0: tensor(batchsize, frame_len) of new frames, not upsampled
+        output sine_tensor: tensor(batchsize, length, dim)
+        output uv: tensor(batchsize, length, 1)
+        """
+        # NOTE f0 is constant inside a frame, so the linear downsample of forward gives exactly the frame level rad values,
+        # and the random initial phase is never sampled by it. The linear upsample of the frame level phase needs one frame
+        # lookahead for the second half of every frame, which is kept in cache until the next frame or finalize arrives.
+        if len(cache) == 0:
+            cache.update({'phase': f0.new_zeros(f0.shape[0], self.dim, 0), 'uv': f0.new_zeros(f0.shape[0], 1, 0),
+                          'cumsum': f0.new_zeros(f0.shape[0], self.dim, 1), 'start': 0, 'num_samples': 0})
+        scale = int(self.upsample_scale)
+        fn = f0[:, None] * torch.arange(1, self.harmonic_num + 2, device=f0.device)[None, :, None]
+        cumsum = torch.cumsum((fn / self.sampling_rate) % 1, dim=2) + cache['cumsum']
+        if cumsum.shape[2] != 0:
+            cache['cumsum'] = cumsum[:, :, -1:]
+        phase = torch.concat([cache['phase'], cumsum * 2 * np.pi * scale], dim=2)
+        frame_uv = torch.concat([cache['uv'], self._f02uv(f0[:, None])], dim=2)
+        start, n0 = cache['start'], cache['num_samples']
+        num_frames = start + phase.shape[2]
+        n1 = num_frames * scale if finalize is True else max(num_frames * scale - scale // 2, n0)
+        n = torch.arange(n0, n1, device=f0.device, dtype=torch.float64)
+        src = ((n + 0.5) / scale - 0.5).clamp(min=0)
+        idx0 = src.floor().long()
+        idx1 = (idx0 + 1).clamp(max=num_frames - 1)
+        weight = (src - idx0).to(phase.dtype)
+        sine_waves = torch.sin(phase[:, :, idx0 - start] * (1 - weight) + phase[:, :, idx1 - start] * weight) * self.sine_amp
+        uv = frame_uv[:, :, n.long() // scale - start]
+        noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
+        noise = noise_amp * torch.randn_like(sine_waves)
+        sine_waves = sine_waves * uv + noise
+        # frames before the one preceding sample n1 are never used again
+        keep = max(n1 // scale - 1 - start, 0)
+        cache.update({'phase': phase[:, :, keep:], 'uv': frame_uv[:, :, keep:], 'start': start + keep, 'num_samples': n1})
+        return sine_waves.transpose(1, 2), uv.transpose(1, 2), noise.transpose(1, 2)
+
 
 class SourceModuleHnNSF2(torch.nn.Module):
     """ SourceModule for hn-nsf
@@ -388,6 +476,17 @@ class SourceModuleHnNSF2(torch.nn.Module):
         noise = torch.randn_like(uv) * self.sine_amp / 3
         return sine_merge, noise, uv
 
+    def forward_stream(self, f0, cache, finalize=False):
+        """
+        f0 (batchsize, frame_len) of new frames, not upsampled
+        Sine_source (batchsize, length, 1)
+        """
+        with torch.no_grad():
+            sine_wavs, uv, _ = self.l_sin_gen.forward_stream(f0, cache, finalize)
+        sine_merge = self.l_tanh(self.l_linear(sine_wavs))
+        noise = torch.randn_like(uv) * self.sine_amp / 3
+        return sine_merge, noise, uv
+
 
 class HiFTGenerator(nn.Module):
     """
@@ -551,6 +650,41 @@ class HiFTGenerator(nn.Module):
         x = torch.clamp(x, -self.audio_limit, self.audio_limit)
         return x
 
+    def decode_stream(self, x: torch.Tensor, s: torch.Tensor, cache: dict, finalize: bool = False) -> torch.Tensor:
+        n_fft, hop_len = self.istft_params["n_fft"], self.istft_params["hop_len"]
+        window = self.stft_window.to(x.device)
+        s_stft = stream_stft(s.squeeze(1), n_fft, hop_len, window, cache.setdefault('stft', {}), finalize)
+        s_stft = torch.cat([s_stft.real, s_stft.imag], dim=1)
+
+        x = stream_conv1d(self.conv_pre, x, cache.setdefault('conv_pre', {}), finalize)
+        for i in range(self.num_upsamples):
+            x = F.leaky_relu(x, self.lrelu_slope)
+            x = stream_conv_transpose1d(self.ups[i], x, cache.setdefault('ups_{}'.format(i), {}), finalize)
+
+            if i == self.num_upsamples - 1:
+                x = stream_reflection_pad_left(x, cache.setdefault('reflection_pad', {}), finalize)
+
+            # fusion
+            si = stream_conv1d(self.source_downs[i], s_stft, cache.setdefault('source_downs_{}'.format(i), {}), finalize)
+            si = self.source_resblocks[i].forward_stream(si, cache.setdefault('source_resblocks_{}'.format(i), {}), finalize)
+            x, si = stream_align([x, si], cache.setdefault('fusion_{}'.format(i), {}))
+            x = x + si
+
+            xs = [self.resblocks[i * self.num_kernels + j].forward_stream(x, cache.setdefault('resblocks_{}'.format(i * self.num_kernels + j), {}), finalize)
+                  for j in range(self.num_kernels)]
+            xs = stream_align(xs, cache.setdefault('resblocks_align_{}'.format(i), {}))
+            x = sum(xs) / self.num_kernels
+
+        x = F.leaky_relu(x)
+        x = stream_conv1d(self.conv_post, x, cache.setdefault('conv_post', {}), finalize)
+        magnitude = torch.clip(torch.exp(x[:, :n_fft // 2 + 1, :]), max=1e2)
+        phase = torch.sin(x[:, n_fft // 2 + 1:, :])  # actually, sin is redundancy
+
+        x = stream_istft(torch.complex(magnitude * torch.cos(phase), magnitude * torch.sin(phase)), n_fft, hop_len, window,
+                         cache.setdefault('istft', {}), finalize)
+        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
+        return x
+
     def forward(
             self,
             batch: dict,
@@ -580,3 +714,20 @@ class HiFTGenerator(nn.Module):
             s[:, :, :cache_source.shape[2]] = cache_source
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
+
+    @torch.inference_mode()
+    def inference_stream(self, speech_feat: torch.Tensor, cache: dict = None, finalize: bool = False):
+        """Stateful streaming inference, speech_feat only contains new mel frames.
+
+        Conv left context, transposed conv and istft overlap add tails, sine phase and the lookahead frames are kept in cache,
+        so every sample is computed once and the concatenated output equals inference on the whole mel, except for the random noise.
+        """
+        if cache is None:
+            cache = {}
+        # mel->f0
+        f0 = self.f0_predictor.forward_stream(speech_feat, cache.setdefault('f0_predictor', {}), finalize)
+        # f0->source
+        s, _, _ = self.m_source.forward_stream(f0, cache.setdefault('m_source', {}), finalize)
+        s = s.transpose(1, 2)
+        generated_speech = self.decode_stream(x=speech_feat, s=s, cache=cache, finalize=finalize)
+        return generated_speech, cache
@@ -0,0 +1,127 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Stateful streaming versions of the non causal ops used by HiFTGenerator.
+
+Every op takes the new samples of a (B, C, T) stream and a state dict owned by the caller, and returns the outputs
+that are final, i.e. whose whole receptive field has been seen. Concatenating the outputs of all calls, the last one
+with finalize=True, gives the same result as the offline op on the concatenated input, so no sample is computed twice.
+"""
+import torch
+import torch.nn.functional as F
+
+
+def stream_conv1d(conv: torch.nn.Conv1d, x: torch.Tensor, state: dict, finalize: bool = False) -> torch.Tensor:
+    # NOTE the zero padding of offline conv becomes p leading zeros and p trailing zeros appended at finalize
+    k, s, d, p = conv.kernel_size[0], conv.stride[0], conv.dilation[0], conv.padding[0]
+    receptive = (k - 1) * d + 1
+    if 'buf' not in state:
+        state['buf'] = x.new_zeros(x.shape[0], x.shape[1], p)
+    x = torch.concat([state['buf'], x], dim=2)
+    if finalize is True:
+        x = F.pad(x, (0, p))
+    n = (x.shape[2] - receptive) // s + 1 if x.shape[2] >= receptive else 0
+    state['buf'] = x[:, :, n * s:]
+    if n == 0:
+        return x.new_zeros(x.shape[0], conv.out_channels, 0)
+    return F.conv1d(x[:, :, :(n - 1) * s + receptive], conv.weight, conv.bias, s, 0, d, conv.groups)
+
+
+def stream_conv_transpose1d(conv: torch.nn.ConvTranspose1d, x: torch.Tensor, state: dict, finalize: bool = False) -> torch.Tensor:
+    # NOTE outputs of one input chunk overlap the next chunk by k - u samples, the overlap is kept and added later
+    k, u, p = conv.kernel_size[0], conv.stride[0], conv.padding[0]
+    if x.shape[2] != 0:
+        y = F.conv_transpose1d(x, conv.weight, None, u, 0, 0, conv.groups)
+    else:
+        y = x.new_zeros(x.shape[0], conv.out_channels, k - u)
+    if 'tail' in state:
+        y[:, :, :state['tail'].shape[2]] += state['tail']
+    if finalize is False:
+        y, state['tail'] = y[:, :, :x.shape[2] * u], y[:, :, x.shape[2] * u:]
+    else:
+        y = y[:, :, :y.shape[2] - p]
+    # drop the first p outputs of the whole stream, as offline padding does
+    skip = state.get('skip', p)
+    state['skip'] = max(skip - y.shape[2], 0)
+    y = y[:, :, skip:]
+    if conv.bias is not None:
+        y = y + conv.bias[None, :, None]
+    return y
+
+
+def stream_reflection_pad_left(x: torch.Tensor, state: dict, finalize: bool = False) -> torch.Tensor:
+    # ReflectionPad1d((1, 0)), only the very first sample of the stream is added
+    if state.get('done', False) is True:
+        return x
+    if 'buf' in state:
+        x = torch.concat([state.pop('buf'), x], dim=2)
+    if x.shape[2] < 2 and finalize is False:
+        state['buf'] = x
+        return x[:, :, :0]
+    state['done'] = True
+    return F.pad(x, (1, 0), mode='reflect')
+
+
+def stream_align(xs: list, state: dict) -> list:
+    # cut streams of the same rate but different latency to a common length, the rest waits for the next call
+    bufs = state.get('bufs', [None] * len(xs))
+    xs = [x if buf is None else torch.concat([buf, x], dim=2) for buf, x in zip(bufs, xs)]
+    n = min(x.shape[2] for x in xs)
+    state['bufs'] = [x[:, :, n:] for x in xs]
+    return [x[:, :, :n] for x in xs]
+
+
+def stream_stft(x: torch.Tensor, n_fft: int, hop_len: int, window: torch.Tensor, state: dict, finalize: bool = False):
+    # torch.stft with center=True and reflect padding, x is (B, T), returns complex (B, n_fft // 2 + 1, T')
+    pad = n_fft // 2
+    if 'buf' in state:
+        x = torch.concat([state['buf'], x], dim=1)
+    empty = torch.complex(x.new_zeros(x.shape[0], n_fft // 2 + 1, 0), x.new_zeros(x.shape[0], n_fft // 2 + 1, 0))
+    if state.get('started', False) is False:
+        # reflect padding needs pad + 1 samples
+        if x.shape[1] <= pad and finalize is False:
+            state['buf'] = x
+            return empty
+        x = F.pad(x[:, None], (pad, 0), mode='reflect')[:, 0]
+        state['started'] = True
+    if finalize is True:
+        x = F.pad(x[:, None], (0, pad), mode='reflect')[:, 0]
+    n = (x.shape[1] - n_fft) // hop_len + 1 if x.shape[1] >= n_fft else 0
+    state['buf'] = x[:, n * hop_len:]
+    if n == 0:
+        return empty
+    return torch.stft(x[:, :(n - 1) * hop_len + n_fft], n_fft, hop_len, n_fft, window=window, center=False, return_complex=True)
+
+
+def stream_istft(spec: torch.Tensor, n_fft: int, hop_len: int, window: torch.Tensor, state: dict, finalize: bool = False) -> torch.Tensor:
+    # torch.istft with center=True, spec is complex (B, n_fft // 2 + 1, T)
+    pad = n_fft // 2
+    frames = torch.fft.irfft(spec, n=n_fft, dim=1) * window[None, :, None]
+    length = (frames.shape[2] - 1) * hop_len + n_fft if frames.shape[2] != 0 else n_fft - hop_len
+    if frames.shape[2] != 0:
+        y = F.fold(frames, output_size=(1, length), kernel_size=(1, n_fft), stride=(1, hop_len))[:, 0, 0]
+        envelope = F.fold(window.pow(2)[None, :, None].expand(1, n_fft, frames.shape[2]), output_size=(1, length),
+                          kernel_size=(1, n_fft), stride=(1, hop_len))[:, 0, 0]
+    else:
+        y, envelope = frames.new_zeros(frames.shape[0], length), frames.new_zeros(1, length)
+    if 'tail' in state:
+        y[:, :n_fft - hop_len] += state['tail']
+        envelope[:, :n_fft - hop_len] += state['envelope']
+    if finalize is False:
+        y, state['tail'] = y[:, :frames.shape[2] * hop_len], y[:, frames.shape[2] * hop_len:]
+        envelope, state['envelope'] = envelope[:, :frames.shape[2] * hop_len], envelope[:, frames.shape[2] * hop_len:]
+    else:
+        y, envelope = y[:, :y.shape[1] - pad], envelope[:, :envelope.shape[1] - pad]
+    skip = state.get('skip', pad)
+    state['skip'] = max(skip - y.shape[1], 0)
+    return y[:, skip:] / envelope[:, skip:]
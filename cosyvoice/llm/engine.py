@@ -0,0 +1,127 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from collections import deque
+from typing import List, Tuple
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+from cosyvoice.utils.common import TokenRingBuffer
+from cosyvoice.utils.metrics import metrics
+
+
+class ContinuousBatchingEngine:
+    """Merge the decode steps of all running Qwen2LM requests into one batched forward_one_step.
+
+    The kv cache of running requests is kept left padded in one batched cache, new requests
+    are prefilled alone and merged into the batch, finished requests are removed between steps.
+    """
+
+    def __init__(self, llm: torch.nn.Module, max_batch_size: int = 16):
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.waiting = deque()
+        self.running = []
+        self.cache = None
+        self.attention_mask = None
+
+    def add_request(self, uuid: str, lm_input: torch.Tensor, sampling: int, min_len: int, max_len: int, prefix_key: str = None, prefix_len: int = 0):
+        self.waiting.append({'uuid': uuid, 'lm_input': lm_input, 'sampling': sampling, 'min_len': min_len, 'max_len': max_len,
+                             'prefix_key': prefix_key, 'prefix_len': prefix_len, 'out_tokens': TokenRingBuffer(device=lm_input.device), 'num_steps': 0, 'next_input': None,
+                             'enqueue_time': time.time()})
+
+    def abort_request(self, uuid: str):
+        self.waiting = deque([r for r in self.waiting if r['uuid'] != uuid])
+        self._remove([uuid])
+
+    def has_unfinished_requests(self) -> bool:
+        return len(self.waiting) != 0 or len(self.running) != 0
+
+    @torch.inference_mode()
+    def step(self) -> List[Tuple[str, int]]:
+        requests, logps = [], []
+        # 1. one batched decode step for all running requests
+        if len(self.running) != 0:
+            xs = torch.concat([r['next_input'] for r in self.running], dim=0)
+            self.attention_mask = F.pad(self.attention_mask, (0, 1), value=True)
+            position_ids = self.attention_mask.long().sum(dim=1, keepdim=True) - 1
+            y_pred, self.cache = self.llm.llm.forward_one_step(xs, masks=self.attention_mask.unsqueeze(dim=1), cache=self.cache, position_ids=position_ids)
+            logps.append(self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1))
+            requests += self.running
+        # 2. prefill waiting requests and merge them into the running batch
+        while len(self.waiting) != 0 and len(self.running) < self.max_batch_size:
+            request = self.waiting.popleft()
+            metrics.observe_queue('llm', time.time() - request['enqueue_time'])
+            lm_input = request.pop('lm_input')
+            y_pred, cache = self.llm.forward_prefill(lm_input, prefix_key=request['prefix_key'], prefix_len=request['prefix_len'])
+            logps.append(self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1))
+            # NOTE if a special token is sampled right after prefill, the last prompt embedding is fed again
+            request['next_input'] = lm_input[:, -1:]
+            self._merge(request, cache)
+            requests.append(request)
+        if len(requests) == 0:
+            return []
+        # 3. per row sampling
+        logp = torch.concat(logps, dim=0)
+        outputs, finished = [], []
+        for i, request in enumerate(requests):
+            top_ids = self.llm.sampling_ids(logp[i], request['out_tokens'], request['sampling'],
+                                            ignore_eos=True if request['num_steps'] < request['min_len'] else False).item()
+            request['num_steps'] += 1
+            if top_ids == self.llm.speech_token_size:
+                finished.append(request['uuid'])
+            elif top_ids < self.llm.speech_token_size:
+                outputs.append((request['uuid'], top_ids))
+                request['out_tokens'].append(top_ids)
+                request['next_input'] = self.llm.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+            if request['num_steps'] == request['max_len'] and request['uuid'] not in finished:
+                finished.append(request['uuid'])
+        for uuid in finished:
+            outputs.append((uuid, self.llm.speech_token_size))
+        self._remove(finished)
+        return outputs
+
+    def _merge(self, request: dict, cache: DynamicCache):
+        cache = cache.to_legacy_cache()
+        attention_mask = torch.ones((1, cache[0][0].size(2)), dtype=torch.bool, device=cache[0][0].device)
+        if self.cache is None:
+            self.cache, self.attention_mask = DynamicCache.from_legacy_cache(cache), attention_mask
+        else:
+            batch_cache = self.cache.to_legacy_cache()
+            batch_len, this_len = self.attention_mask.size(1), attention_mask.size(1)
+            max_len = max(batch_len, this_len)
+            # left pad both the batch and the new request to the same length
+            self.cache = DynamicCache.from_legacy_cache(tuple(
+                (torch.concat([F.pad(bk, (0, 0, max_len - batch_len, 0)), F.pad(k, (0, 0, max_len - this_len, 0))], dim=0),
+                 torch.concat([F.pad(bv, (0, 0, max_len - batch_len, 0)), F.pad(v, (0, 0, max_len - this_len, 0))], dim=0))
+                for (bk, bv), (k, v) in zip(batch_cache, cache)))
+            self.attention_mask = torch.concat([F.pad(self.attention_mask, (max_len - batch_len, 0), value=False),
+                                                F.pad(attention_mask, (max_len - this_len, 0), value=False)], dim=0)
+        self.running.append(request)
+
+    def _remove(self, uuids: List[str]):
+        keep = [i for i, r in enumerate(self.running) if r['uuid'] not in uuids]
+        if len(keep) == len(self.running):
+            return
+        self.running = [self.running[i] for i in keep]
+        if len(keep) == 0:
+            self.cache, self.attention_mask = None, None
+            return
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # drop the left padding columns shared by all remaining requests
+        num_pad = int((~attention_mask).long().cumprod(dim=1).sum(dim=1).min())
+        self.cache = DynamicCache.from_legacy_cache(tuple(
+            (k.index_select(0, index)[:, :, num_pad:], v.index_select(0, index)[:, :, num_pad:]) for k, v in self.cache.to_legacy_cache()))
+        self.attention_mask = attention_mask[:, num_pad:]
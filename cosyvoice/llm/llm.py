@@ -20,11 +20,13 @@ from typing import Dict, Optional, Callable, List, Generator
 import torch
 from torch import nn
 import torch.nn.functional as F
-from transformers import Qwen2ForCausalLM
+from transformers import Qwen2ForCausalLM, DynamicCache
 from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from cosyvoice.utils.common import IGNORE_ID
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
-from cosyvoice.utils.common import th_accuracy
+from cosyvoice.utils.common import th_accuracy, TokenRingBuffer
+from cosyvoice.utils.cache import LRUCache, tensor_hash
+from cosyvoice.utils.metrics import metrics
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.mask import make_pad_mask
 
@@ -151,14 +153,12 @@ class TransformerLM(torch.nn.Module):
             sampling: int,
             ignore_eos: bool = True,
     ):
-        num_trials, max_trials = 0, 100
-        while True:
-            top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
-            if (not ignore_eos) or (self.speech_token_size not in top_ids):
-                break
-            num_trials += 1
-            if num_trials > max_trials:
-                raise RuntimeError('sampling reaches max_trials {} and still get eos when ignore_eos is True, check your input!'.format(max_trials))
+        top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
+        if ignore_eos is True:
+            # NOTE resample eos with eos masked out and select on device, instead of a host side retry loop
+            masked_scores = weighted_scores.clone()
+            masked_scores[..., self.speech_token_size] = -float('inf')
+            top_ids = torch.where(top_ids == self.speech_token_size, self.sampling(masked_scores, decoded_tokens, sampling), top_ids)
         return top_ids
 
     @torch.inference_mode()
@@ -244,11 +244,12 @@ class Qwen2Encoder(torch.nn.Module):
         )
         return outs.hidden_states[-1], masks.unsqueeze(1)
 
-    def forward_one_step(self, xs, masks, cache=None):
+    def forward_one_step(self, xs, masks, cache=None, position_ids=None):
         input_masks = masks[:, -1, :]
         outs = self.model(
             inputs_embeds=xs,
             attention_mask=input_masks,
+            position_ids=position_ids,
             output_hidden_states=True,
             return_dict=True,
             use_cache=True,
@@ -301,6 +302,35 @@ class Qwen2LM(TransformerLM):
         self.stop_token_ids = [speech_token_size + i for i in range(3)]
         self.vllm_output_queue = {}
 
+        # 6. continuous batching related
+        self.batch_engine_output_queue = {}
+
+        # 7. prompt prefix kv cache related
+        self.prefix_cache = None
+
+    def load_prefix_cache(self, max_bytes):
+        self.prefix_cache = LRUCache(max_bytes)
+        metrics.register_cache('prefix', self.prefix_cache)
+
+    def forward_prefill(self, lm_input, prefix_key=None, prefix_len=0):
+        # NOTE restore kv cache of lm_input[:, :prefix_len] if possible, then only prefill the rest
+        if self.prefix_cache is None or prefix_key is None or prefix_len == 0:
+            return self.llm.forward_one_step(lm_input,
+                                             masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
+                                             cache=None)
+        prefix_cache = self.prefix_cache.get(prefix_key)
+        if prefix_cache is None:
+            _, cache = self.llm.forward_one_step(lm_input[:, :prefix_len],
+                                                 masks=torch.tril(torch.ones((1, prefix_len, prefix_len), device=lm_input.device)).to(torch.bool),
+                                                 cache=None)
+            prefix_cache = cache.to_legacy_cache()
+            self.prefix_cache.put(prefix_key, prefix_cache)
+        # DynamicCache.update concats into new tensors, so the cached prefix is never modified
+        cache = DynamicCache.from_legacy_cache(prefix_cache)
+        return self.llm.forward_one_step(lm_input[:, prefix_len:],
+                                         masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
+                                         cache=cache)
+
     def prepare_lm_input_target(self, text_token, text_token_emb, text_token_len, speech_token, speech_token_emb, speech_token_len):
         lm_target, lm_input = [], []
         text_token = unpad_sequence(text_token, text_token_len.cpu(), batch_first=True)
@@ -457,12 +487,16 @@ class Qwen2LM(TransformerLM):
         min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
+        # NOTE [sos, prompt_text] is the only request independent prefix of lm_input
+        prefix_key = tensor_hash(prompt_text) if self.prefix_cache is not None and prompt_text.shape[1] != 0 else None
+        prefix_len = 1 + prompt_text.shape[1]
+
         # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid, prefix_key=prefix_key, prefix_len=prefix_len):
             yield token
 
     @torch.inference_mode()
-    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid):
+    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid, prefix_key=None, prefix_len=0):
         if hasattr(self, 'vllm'):
             from vllm import SamplingParams, RequestOutput
             sampling_params = SamplingParams(top_k=sampling,
@@ -492,13 +526,37 @@ class Qwen2LM(TransformerLM):
                 time.sleep(0.001)
             with self.lock:
                 self.vllm_output_queue.pop(uuid)
+        elif hasattr(self, 'batch_engine'):
+            with self.lock:
+                self.batch_engine.add_request(uuid, lm_input, sampling, min_len, max_len, prefix_key=prefix_key, prefix_len=prefix_len)
+                self.batch_engine_output_queue[uuid] = queue.Queue()
+            try:
+                while True:
+                    # NOTE whoever holds the lock runs one batched step for all running requests
+                    with self.lock:
+                        if self.batch_engine_output_queue[uuid].empty() is True:
+                            for request_id, top_ids in self.batch_engine.step():
+                                self.batch_engine_output_queue[request_id].put(top_ids)
+                    if self.batch_engine_output_queue[uuid].empty() is False:
+                        top_ids = self.batch_engine_output_queue[uuid].get()
+                        if top_ids == self.speech_token_size:
+                            break
+                        # in stream mode, yield token one by one
+                        yield top_ids
+            finally:
+                with self.lock:
+                    self.batch_engine.abort_request(uuid)
+                    self.batch_engine_output_queue.pop(uuid)
         else:
-            out_tokens = []
+            out_tokens = TokenRingBuffer(device=lm_input.device)
             cache = None
             for i in range(max_len):
-                y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                          masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
-                                                          cache=cache)
+                if cache is None:
+                    y_pred, cache = self.forward_prefill(lm_input, prefix_key=prefix_key, prefix_len=prefix_len)
+                else:
+                    y_pred, cache = self.llm.forward_one_step(lm_input,
+                                                              masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
+                                                              cache=cache)
                 logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
                 top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
                 if top_ids == self.speech_token_size:
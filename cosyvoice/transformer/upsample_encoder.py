@@ -32,6 +32,7 @@ from cosyvoice.utils.class_utils import (
 )
 from cosyvoice.utils.mask import make_pad_mask
 from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import subsequent_chunk_mask_with_cache
 
 
 class Upsample1D(nn.Module):
@@ -62,6 +63,18 @@ class Upsample1D(nn.Module):
         outputs = self.conv(outputs)
         return outputs, input_lengths * self.stride
 
+    def forward_chunk(self, inputs: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        cache: last stride * 2 interpolated frames of previous chunk, (0, 0, 0) for first chunk
+        """
+        outputs = F.interpolate(inputs, scale_factor=float(self.stride), mode="nearest")
+        if cache.size(2) != 0:
+            outputs = torch.concat([cache, outputs], dim=2)
+        outputs = F.pad(outputs, (self.stride * 2 - cache.size(2), 0), value=0.0)
+        new_cache = outputs[:, :, -self.stride * 2:]
+        outputs = self.conv(outputs)
+        return outputs, new_cache
+
 
 class PreLookaheadLayer(nn.Module):
     def __init__(self, channels: int, pre_lookahead_len: int = 1):
@@ -101,6 +114,29 @@ class PreLookaheadLayer(nn.Module):
         outputs = outputs + inputs
         return outputs
 
+    def forward_chunk(self, inputs: torch.Tensor, context: torch.Tensor = torch.zeros(0, 0, 0),
+                      cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: (batch_size, seq_len, channels)
+        cache: last conv2.kernel_size - 1 conv1 outputs of previous chunk, (0, 0, 0) for first chunk
+        """
+        outputs = inputs.transpose(1, 2).contiguous()
+        context = context.transpose(1, 2).contiguous()
+        # look ahead
+        outputs = F.pad(torch.concat([outputs, context], dim=2), (0, self.pre_lookahead_len - context.size(2)), mode='constant', value=0.0)
+        outputs = F.leaky_relu(self.conv1(outputs))
+        # outputs
+        if cache.size(2) != 0:
+            outputs = torch.concat([cache, outputs], dim=2)
+        outputs = F.pad(outputs, (self.conv2.kernel_size[0] - 1 - cache.size(2), 0), mode='constant', value=0.0)
+        new_cache = outputs[:, :, -(self.conv2.kernel_size[0] - 1):]
+        outputs = self.conv2(outputs)
+        outputs = outputs.transpose(1, 2).contiguous()
+
+        # residual connection
+        outputs = outputs + inputs
+        return outputs, new_cache
+
 
 class UpsampleConformerEncoder(torch.nn.Module):
 
@@ -199,7 +235,7 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # convolution module definition
         convolution_layer_args = (output_size, cnn_module_kernel, activation,
                                   cnn_module_norm, causal)
-        self.pre_lookahead_layer = PreLookaheadLayer(channels=512, pre_lookahead_len=3)
+        self.pre_lookahead_layer = PreLookaheadLayer(channels=output_size, pre_lookahead_len=3)
         self.encoders = torch.nn.ModuleList([
             ConformerEncoderLayer(
                 output_size,
@@ -214,7 +250,7 @@ class UpsampleConformerEncoder(torch.nn.Module):
                 normalize_before,
             ) for _ in range(num_blocks)
         ])
-        self.up_layer = Upsample1D(channels=512, out_channels=512, stride=2)
+        self.up_layer = Upsample1D(channels=output_size, out_channels=output_size, stride=2)
         self.up_embed = COSYVOICE_SUBSAMPLE_CLASSES[input_layer](
             input_size,
             output_size,
@@ -305,6 +341,62 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # for cross attention with decoder later
         return xs, masks
 
+    @torch.jit.unused
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        context: torch.Tensor = torch.zeros(0, 0, 0),
+        cache: dict = None,
+    ) -> Tuple[torch.Tensor, dict]:
+        """ Incremental streaming inference, only encode the new tokens.
+
+        Args:
+            xs: new input tensor (1, T, D), chunk boundaries of the whole sequence
+                must be kept, i.e. all previous chunks have been passed as full chunks
+            context: pre lookahead context (1, pre_lookahead_len, D), empty for last chunk
+            cache: cache returned by previous call, None for first chunk
+        Returns:
+            xs: output tensor of new tokens (1, T * up_layer.stride, D)
+            cache: new cache
+        """
+        if cache is None:
+            cache = {'offset': 0, 'pre_lookahead_cache': torch.zeros(0, 0, 0), 'up_cache': torch.zeros(0, 0, 0),
+                     'att_cache': [torch.zeros(0, 0, 0, 0)] * len(self.encoders),
+                     'up_att_cache': [torch.zeros(0, 0, 0, 0)] * len(self.up_encoders)}
+        offset, up_offset, num_tokens = cache['offset'], cache['offset'] * self.up_layer.stride, xs.size(1)
+        masks = torch.ones(1, 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, pos_emb, masks = self.embed(xs, masks, offset=offset)
+        if context.size(1) != 0:
+            context_masks = torch.ones(1, 1, context.size(1)).to(masks)
+            context, _, _ = self.embed(context, context_masks, offset=offset + xs.size(1))
+        chunk_masks = subsequent_chunk_mask_with_cache(xs.size(1), offset, self.static_chunk_size, xs.device).unsqueeze(0)
+        # lookahead + conformer encoder
+        xs, pre_lookahead_cache = self.pre_lookahead_layer.forward_chunk(xs, context=context, cache=cache['pre_lookahead_cache'])
+        att_cache = []
+        for i, layer in enumerate(self.encoders):
+            xs, _, new_att_cache, _ = layer(xs, chunk_masks, pos_emb, att_cache=cache['att_cache'][i])
+            att_cache.append(new_att_cache)
+
+        # upsample + conformer encoder
+        xs = xs.transpose(1, 2).contiguous()
+        xs, up_cache = self.up_layer.forward_chunk(xs, cache=cache['up_cache'])
+        xs = xs.transpose(1, 2).contiguous()
+        masks = torch.ones(1, 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        xs, pos_emb, masks = self.up_embed(xs, masks, offset=up_offset)
+        chunk_masks = subsequent_chunk_mask_with_cache(xs.size(1), up_offset, self.static_chunk_size * self.up_layer.stride, xs.device).unsqueeze(0)
+        up_att_cache = []
+        for i, layer in enumerate(self.up_encoders):
+            xs, _, new_att_cache, _ = layer(xs, chunk_masks, pos_emb, att_cache=cache['up_att_cache'][i])
+            up_att_cache.append(new_att_cache)
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        cache = {'offset': offset + num_tokens, 'pre_lookahead_cache': pre_lookahead_cache, 'up_cache': up_cache,
+                 'att_cache': att_cache, 'up_att_cache': up_att_cache}
+        return xs, cache
+
     def forward_layers(self, xs: torch.Tensor, chunk_masks: torch.Tensor,
                        pos_emb: torch.Tensor,
                        mask_pad: torch.Tensor) -> torch.Tensor:
@@ -0,0 +1,76 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import struct
+import torch
+
+AUDIO_FORMATS = ('pcm', 'wav')
+# NOTE riff and data chunk sizes used when the total length is unknown, players read until the stream ends
+WAV_UNKNOWN_SIZE = 0xFFFFFFFF
+
+
+class PCMEncoder:
+    """Float speech in [-1, 1] to 16 bit little endian pcm for transports.
+
+    Scaling and casting run on the device of the speech tensor, so only int16 samples leave the gpu, copied into a
+    reusable pinned host buffer. encode returns a memoryview of that buffer which is only valid until the next encode
+    call, so a transport must send or copy it before encoding the next chunk.
+    """
+
+    def __init__(self):
+        self.buffer = None
+
+    def encode(self, speech: torch.Tensor) -> memoryview:
+        pcm = (speech.flatten() * (2 ** 15)).clamp_(-2 ** 15, 2 ** 15 - 1).to(torch.int16)
+        if pcm.is_cuda is True:
+            if self.buffer is None or self.buffer.shape[0] < pcm.shape[0]:
+                self.buffer = torch.empty(max(pcm.shape[0], 2 * (self.buffer.shape[0] if self.buffer is not None else 0)), dtype=torch.int16, pin_memory=True)
+            pcm = self.buffer[:pcm.shape[0]].copy_(pcm)
+        # cpu speech is already a fresh tensor, hand out its memory directly
+        return memoryview(pcm.numpy()).cast('B')
+
+
+def speech_to_pcm(speech: torch.Tensor) -> torch.Tensor:
+    # float speech in [-1, 1] to a fresh host int16 tensor, scaling runs on the device of speech and the copy blocks the caller,
+    # so call it in the thread that produces speech, not in an event loop
+    return (speech.flatten() * (2 ** 15)).clamp_(-2 ** 15, 2 ** 15 - 1).to(torch.int16).cpu()
+
+
+def wav_header(sample_rate: int, data_size: int = None, num_channels: int = 1, bits_per_sample: int = 16) -> bytes:
+    # data_size None writes a streaming header of unknown length
+    byte_rate = sample_rate * num_channels * bits_per_sample // 8
+    block_align = num_channels * bits_per_sample // 8
+    riff_size = data_size + 36 if data_size is not None else WAV_UNKNOWN_SIZE
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', riff_size, b'WAVE', b'fmt ', 16, 1, num_channels, sample_rate, byte_rate,
+                       block_align, bits_per_sample, b'data', data_size if data_size is not None else WAV_UNKNOWN_SIZE)
+
+
+def stream_audio(model_output, sample_rate: int, audio_format: str = 'pcm'):
+    # NOTE chunks are memoryviews of the reused PCMEncoder buffer, the transport must send or copy a chunk before pulling the next
+    assert audio_format in AUDIO_FORMATS, 'unknown audio format {}'.format(audio_format)
+    encoder = PCMEncoder()
+    if audio_format == 'wav':
+        yield wav_header(sample_rate)
+    for i in model_output:
+        yield encoder.encode(i['tts_speech'])
+
+
+async def astream_audio(model_output, sample_rate: int, audio_format: str = 'pcm'):
+    # NOTE model_output should come from AsyncCosyVoice with output_pcm=True, then every chunk is a fresh host tensor and nothing
+    # here waits for the gpu, otherwise encoding falls back to PCMEncoder on the event loop with the same rules as stream_audio
+    assert audio_format in AUDIO_FORMATS, 'unknown audio format {}'.format(audio_format)
+    encoder = PCMEncoder()
+    if audio_format == 'wav':
+        yield wav_header(sample_rate)
+    async for i in model_output:
+        yield memoryview(i['tts_pcm'].numpy()).cast('B') if 'tts_pcm' in i else encoder.encode(i['tts_speech'])
@@ -0,0 +1,107 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import torch
+
+
+def tensor_nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(tensor_nbytes(v) for v in value.values())
+    return 0
+
+
+def tensor_hash(*tensors):
+    md5 = hashlib.md5()
+    for t in tensors:
+        md5.update(str(t.dtype).encode())
+        md5.update(str(tuple(t.shape)).encode())
+        md5.update(t.detach().cpu().contiguous().numpy().tobytes())
+    return md5.hexdigest()
+
+
+class LRUCache:
+    """Thread safe lru cache bounded by the total bytes of its tensor values.
+
+    Entries older than ttl seconds are dropped on access, hit/miss/eviction counters are exposed by stats().
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions, self.expirations = 0, 0, 0, 0
+
+    def _expired(self, key):
+        return self.ttl is not None and time.time() - self.data[key][2] > self.ttl
+
+    def get(self, key):
+        with self.lock:
+            if key in self.data and self._expired(key):
+                self.nbytes -= self.data.pop(key)[1]
+                self.expirations += 1
+            if key not in self.data:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key][0]
+
+    def put(self, key, value):
+        nbytes = tensor_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.data:
+                self.nbytes -= self.data.pop(key)[1]
+            self.data[key] = (value, nbytes, time.time())
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evict_nbytes, _) = self.data.popitem(last=False)
+                self.nbytes -= evict_nbytes
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            if key in self.data:
+                value, nbytes, _ = self.data.pop(key)
+                self.nbytes -= nbytes
+                return value
+            return None
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.data), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expirations': self.expirations}
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data and not self._expired(key)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.data)
@@ -18,6 +18,7 @@
 
 import queue
 import random
+from functools import lru_cache
 from typing import List
 
 import numpy as np
@@ -109,45 +110,90 @@ def init_weights(m, mean=0.0, std=0.01):
 
 # Repetition Aware Sampling in VALL-E 2
 def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
-    top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
-    if rep_num >= win_size * tau_r:
-        top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
+    sorted_value, sorted_idx = weighted_scores.softmax(dim=-1).sort(dim=-1, descending=True, stable=True)
+    # NOTE nucleus draw and random fallback are inverse cdf samples of the sorted probs with two independent uniforms,
+    # so the fallback needs no extra softmax or multinomial, and the rng consumption of a step does not depend on repetition
+    u = torch.rand(2, *sorted_value.shape[:-1], 1, device=sorted_value.device)
+    top_ids = sorted_idx.gather(-1, inverse_cdf_sampling(nucleus_prob(sorted_value, top_p, top_k), u[0]))
+    if isinstance(decoded_tokens, TokenRingBuffer):
+        window = decoded_tokens.last(win_size)
+    else:
+        window = torch.tensor(decoded_tokens[-win_size:], dtype=torch.long, device=weighted_scores.device)
+    window = window.reshape(*top_ids.shape[:-1], window.shape[-1])
+    rep_num = (window == top_ids).sum(dim=-1, keepdim=True)
+    # NOTE select by torch.where instead of python if, so no host sync is needed
+    top_ids = torch.where(rep_num >= win_size * tau_r, sorted_idx.gather(-1, inverse_cdf_sampling(sorted_value, u[1])), top_ids)
     return top_ids
 
 
+def nucleus_prob(sorted_value, top_p=0.8, top_k=25):
+    # sampling both top-p and numbers, keep token i if cumulative prob before i is less than top_p
+    sorted_value = sorted_value[..., :top_k]
+    mask = (sorted_value.cumsum(dim=-1) - sorted_value) < top_p
+    return sorted_value.masked_fill(~mask, 0)
+
+
+def inverse_cdf_sampling(prob, u):
+    # index of the first cumulative prob reaching u of the total, prob needs not be normalized
+    cdf = prob.float().cumsum(dim=-1)
+    return (cdf < u * cdf[..., -1:]).sum(dim=-1, keepdim=True).clamp_(max=prob.shape[-1] - 1)
+
+
 def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)]
+    sorted_value, sorted_idx = weighted_scores.softmax(dim=-1).sort(dim=-1, descending=True, stable=True)
+    prob = nucleus_prob(sorted_value, top_p, top_k)
+    top_ids = sorted_idx[..., :top_k].gather(-1, prob.multinomial(1, replacement=True))
     return top_ids
 
 
 def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
+    top_ids = weighted_scores.softmax(dim=-1).multinomial(1, replacement=True)
     return top_ids
 
 
+class TokenRingBuffer:
+    """Device resident buffer of the latest decoded tokens, used as repetition window of ras_sampling."""
+
+    def __init__(self, capacity=64, batch_size=1, device='cpu'):
+        self.capacity = capacity
+        self.buffer = torch.full((batch_size, capacity), -1, dtype=torch.long, device=device)
+        self.num_tokens = 0
+
+    def append(self, tokens):
+        # tokens can be int or tensor of shape (batch_size,) or (batch_size, 1)
+        if isinstance(tokens, torch.Tensor):
+            tokens = tokens.view(-1)
+        self.buffer[:, self.num_tokens % self.capacity] = tokens
+        self.num_tokens += 1
+
+    def last(self, n):
+        n = min(n, self.num_tokens, self.capacity)
+        index = torch.arange(self.num_tokens - n, self.num_tokens, device=self.buffer.device) % self.capacity
+        return self.buffer[:, index]
+
+    def __len__(self):
+        return self.num_tokens
+
+
+@lru_cache(maxsize=64)
+def hamming_window(window_len, device, dtype):
+    # same as np.hamming, cached so that fade in out never copies a window from host
+    return torch.hamming_window(window_len, periodic=False, device=device, dtype=dtype)
+
+
 def fade_in_out(fade_in_mel, fade_out_mel, window):
-    device = fade_in_mel.device
-    fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
+    """Crossfade the head of fade_in_mel with the tail of fade_out_mel on their own device.
+
+    Works on any leading dims, so rows of different sessions can be crossfaded in one call. window is the length
+    of a hamming window, a numpy or torch window is also accepted.
+    """
+    if isinstance(window, int):
+        window = hamming_window(window, fade_in_mel.device, fade_in_mel.dtype)
+    else:
+        window = torch.as_tensor(window).to(fade_in_mel.device, fade_in_mel.dtype)
     mel_overlap_len = int(window.shape[0] / 2)
-    if fade_in_mel.device == torch.device('cpu'):
-        fade_in_mel = fade_in_mel.clone()
-    fade_in_mel[..., :mel_overlap_len] = fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + \
-        fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
-    return fade_in_mel.to(device)
+    fade_in_head = fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
+    return torch.concat([fade_in_head, fade_in_mel[..., mel_overlap_len:]], dim=-1)
 
 
 def set_all_random_seed(seed):
@@ -134,3 +134,32 @@ def is_only_punctuation(text):
     # Regular expression: Match strings that consist only of punctuation marks or are empty.
     punctuation_pattern = r'^[\p{P}\p{S}]*$'
     return bool(regex.fullmatch(punctuation_pattern, text))
+
+
+# split mel frames of long audio into overlapping windows the speech tokenizer accepts (at most 30s of 100Hz frames)
+# every window keeps the tokens of [keep_start, keep_end), neighbouring windows split their overlap in the middle,
+# hop and half overlap are multiples of 4, the downsampling of every speech tokenizer, so kept tokens line up exactly
+def split_speech_windows(num_frames: int, window_frames: int = 3000, overlap_frames: int = 400):
+    assert window_frames > overlap_frames and (window_frames - overlap_frames) % 4 == 0 and overlap_frames % 8 == 0
+    hop = window_frames - overlap_frames
+    num_windows = 1 + (max(num_frames - window_frames, 0) + hop - 1) // hop
+    windows = []
+    for i in range(num_windows):
+        start, end = i * hop, min(i * hop + window_frames, num_frames)
+        keep_start = start + overlap_frames // 2 if i != 0 else start
+        keep_end = end - overlap_frames // 2 if i != num_windows - 1 else end
+        windows.append((start, end, keep_start, keep_end))
+    return windows
+
+
+def merge_window_tokens(windows, window_tokens, factor=None):
+    # factor is the downsampling of the tokenizer, by default taken from the first window, which is full when there are several
+    if factor is None:
+        if len(windows) == 1:
+            return list(window_tokens[0])
+        factor = max(round((windows[0][1] - windows[0][0]) / len(window_tokens[0])), 1)
+    # padded tokens of the last window are cut here
+    speech_token = []
+    for (start, _end, keep_start, keep_end), token in zip(windows, window_tokens):
+        speech_token.extend(token[(keep_start - start) // factor: (keep_end - start + factor - 1) // factor])
+    return speech_token
@@ -158,6 +158,36 @@ def subsequent_chunk_mask(
     return ret
 
 
+def subsequent_chunk_mask_with_cache(
+        size: int,
+        cache_size: int,
+        chunk_size: int,
+        device: torch.device = torch.device("cpu"),
+) -> torch.Tensor:
+    """Create mask (size, cache_size + size) for the last size steps of
+       subsequent_chunk_mask(cache_size + size, chunk_size), this is for
+       incremental inference with cached left context
+
+    Args:
+        size (int): size of new steps
+        cache_size (int): size of cached steps
+        chunk_size (int): size of chunk
+        device (torch.device): "cpu" or "cuda" or torch.Tensor.device
+
+    Returns:
+        torch.Tensor: mask
+
+    Examples:
+        >>> subsequent_chunk_mask_with_cache(2, 2, 2)
+        [[1, 1, 1, 1],
+         [1, 1, 1, 1]]
+    """
+    pos_idx = torch.arange(cache_size + size, device=device)
+    block_value = (torch.div(pos_idx[cache_size:], chunk_size, rounding_mode='trunc') + 1) * chunk_size
+    ret = pos_idx.unsqueeze(0) < block_value.unsqueeze(1)
+    return ret
+
+
 def add_optional_chunk_mask(xs: torch.Tensor,
                             masks: torch.Tensor,
                             use_dynamic_chunk: bool,
@@ -230,9 +260,9 @@ def add_optional_chunk_mask(xs: torch.Tensor,
     else:
         chunk_masks = masks
     assert chunk_masks.dtype == torch.bool
-    if (chunk_masks.sum(dim=-1) == 0).sum().item() != 0:
-        print('get chunk_masks all false at some timestep, force set to true, make sure they are masked in futuer computation!')
-        chunk_masks[chunk_masks.sum(dim=-1) == 0] = True
+    # NOTE force rows that are all false to true, make sure they are masked in future computation,
+    # done on device without checking first, so no host sync is needed and it is safe during cuda graph capture
+    chunk_masks = chunk_masks | (chunk_masks.sum(dim=-1, keepdim=True) == 0)
     return chunk_masks
 
 
@@ -0,0 +1,78 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+from contextlib import nullcontext
+import torch
+from cosyvoice.utils.file_utils import logging
+
+
+class MemoryPolicy:
+    """Cuda memory management of tts sessions.
+
+    empty_cache decides when cached blocks are returned to the driver after a session finishes:
+        always      legacy behaviour, synchronize and empty cache after every session
+        never       keep everything in the caching allocator
+        threshold   empty cache only when reserved memory exceeds threshold * budget
+        periodic    empty cache every period finished sessions
+    memory_budget_mb caps the caching allocator of this process, 0 means the whole device.
+    session_stream gives every session its own cuda stream, so finishing one session only waits for its own kernels.
+    """
+
+    def __init__(self, empty_cache='threshold', threshold=0.9, period=100, memory_budget_mb=0, session_stream=False):
+        assert empty_cache in ['always', 'never', 'threshold', 'periodic'], 'unknown empty_cache policy {}'.format(empty_cache)
+        self.empty_cache = empty_cache
+        self.threshold = threshold
+        self.period = period
+        self.memory_budget_mb = memory_budget_mb
+        self.session_stream = session_stream and torch.cuda.is_available()
+        self.lock = threading.Lock()
+        self.num_finished = 0
+        self.streams = []
+        self.budget = 0
+        if torch.cuda.is_available():
+            total = torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory
+            self.budget = min(memory_budget_mb * 1024 * 1024, total) if memory_budget_mb > 0 else total
+            if memory_budget_mb > 0:
+                torch.cuda.set_per_process_memory_fraction(self.budget / total)
+                logging.info('limit cuda caching allocator to {} MB'.format(memory_budget_mb))
+
+    def acquire_stream(self):
+        if self.session_stream is False:
+            return None
+        with self.lock:
+            return self.streams.pop() if len(self.streams) != 0 else torch.cuda.Stream()
+
+    def stream(self, stream):
+        return torch.cuda.stream(stream) if stream is not None else nullcontext()
+
+    def release(self, stream):
+        if torch.cuda.is_available() is False:
+            return
+        if stream is not None:
+            # NOTE only wait for kernels of this session, other sessions keep running
+            stream.synchronize()
+            with self.lock:
+                self.streams.append(stream)
+        with self.lock:
+            self.num_finished += 1
+            num_finished = self.num_finished
+        if self.empty_cache == 'always':
+            torch.cuda.empty_cache()
+            torch.cuda.current_stream().synchronize()
+        elif self.empty_cache == 'threshold':
+            if torch.cuda.memory_reserved() > self.threshold * self.budget:
+                torch.cuda.empty_cache()
+        elif self.empty_cache == 'periodic':
+            if num_finished % self.period == 0:
+                torch.cuda.empty_cache()
@@ -0,0 +1,149 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import functools
+import threading
+from contextlib import contextmanager, nullcontext
+import torch
+try:
+    import prometheus_client
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+from cosyvoice.utils.file_utils import logging
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metrics:
+    """Process wide instrumentation of the inference pipeline.
+
+    Modules declare their stages with instrument() at construction time, nothing is wrapped until enable() is called,
+    so the disabled path has no overhead. Session counts and cache statistics are read lazily at scrape time.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.cuda_sync = False
+        self.tracing = False
+        self.lock = threading.Lock()
+        self.targets = []
+        self.gauges = {}
+        self.caches = {}
+
+    def enable(self, cuda_sync=False):
+        assert prometheus_client is not None, 'please install prometheus_client to enable metrics'
+        with self.lock:
+            if self.enabled is True:
+                return
+            # NOTE cuda kernels are asynchronous, sync at the end of each stage to attribute gpu time correctly
+            self.cuda_sync = cuda_sync and torch.cuda.is_available()
+            self.registry = prometheus_client.CollectorRegistry()
+            self.stage_seconds = prometheus_client.Histogram('cosyvoice_stage_seconds', 'wall time of each inference stage', ['stage'],
+                                                             buckets=STAGE_BUCKETS, registry=self.registry)
+            self.queue_seconds = prometheus_client.Histogram('cosyvoice_queue_wait_seconds', 'time a request waits in a batching queue', ['queue'],
+                                                             buckets=STAGE_BUCKETS, registry=self.registry)
+            self.speech_tokens = prometheus_client.Counter('cosyvoice_speech_tokens', 'speech tokens generated by llm', registry=self.registry)
+            self.registry.register(_LazyCollector(self))
+            for obj, name, stage in self.targets:
+                self._wrap(obj, name, stage)
+            self.enabled = True
+
+    def instrument(self, obj, stages):
+        """Time obj.<method> as stage for every {method: stage} in stages, methods obj does not have are ignored."""
+        with self.lock:
+            for name, stage in stages.items():
+                if not hasattr(obj, name):
+                    continue
+                self.targets.append((obj, name, stage))
+                if self.enabled is True:
+                    self._wrap(obj, name, stage)
+
+    def register_gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def register_cache(self, name, cache):
+        self.caches[name] = cache
+
+    def observe_queue(self, queue, seconds):
+        if self.enabled is True:
+            self.queue_seconds.labels(queue).observe(seconds)
+
+    def count_tokens(self, n):
+        if self.enabled is True:
+            self.speech_tokens.inc(n)
+
+    def generate_latest(self):
+        assert self.enabled is True, 'metrics is not enabled'
+        return prometheus_client.generate_latest(self.registry)
+
+    @property
+    def content_type(self):
+        return prometheus_client.CONTENT_TYPE_LATEST
+
+    @contextmanager
+    def trace(self, trace_path):
+        """Record a torch profiler trace with stage annotations, exported as chrome trace to trace_path."""
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.tracing = True
+        try:
+            with torch.profiler.profile(activities=activities) as prof:
+                yield prof
+        finally:
+            self.tracing = False
+        prof.export_chrome_trace(trace_path)
+        logging.info('export torch profiler trace to {}'.format(trace_path))
+
+    def _wrap(self, obj, name, stage):
+        fn = getattr(obj, name)
+        histogram = self.stage_seconds.labels(stage)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start_time = time.time()
+            with torch.profiler.record_function(stage) if self.tracing is True else nullcontext():
+                result = fn(*args, **kwargs)
+                if self.cuda_sync is True:
+                    torch.cuda.current_stream().synchronize()
+            histogram.observe(time.time() - start_time)
+            return result
+        setattr(obj, name, wrapper)
+
+
+class _LazyCollector:
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def collect(self):
+        for name, fn in list(self.metrics.gauges.items()):
+            yield GaugeMetricFamily('cosyvoice_{}'.format(name), name.replace('_', ' '), value=fn())
+        hits = CounterMetricFamily('cosyvoice_cache_hits', 'cache hits', labels=['cache'])
+        misses = CounterMetricFamily('cosyvoice_cache_misses', 'cache misses', labels=['cache'])
+        evictions = CounterMetricFamily('cosyvoice_cache_evictions', 'cache evictions by size or ttl', labels=['cache'])
+        nbytes = GaugeMetricFamily('cosyvoice_cache_bytes', 'bytes held by cache', labels=['cache'])
+        hit_rate = GaugeMetricFamily('cosyvoice_cache_hit_rate', 'cache hit rate since start', labels=['cache'])
+        for name, cache in list(self.metrics.caches.items()):
+            stats = cache.stats()
+            hits.add_metric([name], stats['hits'])
+            misses.add_metric([name], stats['misses'])
+            evictions.add_metric([name], stats['evictions'] + stats['expirations'])
+            nbytes.add_metric([name], stats['bytes'])
+            hit_rate.add_metric([name], stats['hits'] / max(stats['hits'] + stats['misses'], 1))
+        yield from [hits, misses, evictions, nbytes, hit_rate]
+
+
+metrics = Metrics()
@@ -0,0 +1,80 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import queue
+import threading
+import time
+from typing import Callable
+
+
+def available_cpus() -> int:
+    # cpus this process may actually run on, honouring cpu affinity and the cgroup v2 quota of containers
+    try:
+        num_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        num_cpus = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            num_cpus = min(num_cpus, max(int(quota) // int(period), 1))
+    except (OSError, ValueError):
+        pass
+    return num_cpus
+
+
+class MicroBatcher:
+    """Merge calls from many request threads into one batched call of fn.
+
+    fn takes a list of inputs and returns the list of outputs in the same order. The first request of a batch waits
+    at most max_wait seconds for others to join, a batch is run at once when it reaches max_batch_size.
+    """
+
+    def __init__(self, fn: Callable, max_batch_size: int = 8, max_wait: float = 0.005, name: str = 'micro_batcher'):
+        assert max_batch_size >= 1
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, x):
+        request = {'input': x, 'done': threading.Event()}
+        self.queue.put(request)
+        request['done'].wait()
+        if 'exception' in request:
+            raise request['exception']
+        return request['output']
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                outputs = self.fn([request['input'] for request in batch])
+                assert len(outputs) == len(batch)
+                for request, output in zip(batch, outputs):
+                    request['output'] = output
+            except Exception as e:
+                # NOTE the whole batch fails together, every waiting request re-raises the error in its own thread
+                for request in batch:
+                    request['exception'] = e
+            for request in batch:
+                request['done'].set()
@@ -0,0 +1,242 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import json
+import mmap
+import threading
+import torch
+from cosyvoice.utils.cache import LRUCache
+from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.metrics import metrics
+
+
+class SpeakerStore:
+    """Persistent speaker prompt store, a drop-in replacement of the spk2info dict.
+
+    Layout of store_dir:
+        index.jsonl     one json line per write, {spk_id: {key: {shard, offset, dtype, shape} or {value}}}, later lines win
+        shard_{k}.bin   raw tensor bytes, append only, read back through mmap
+        migrated.json   completion marker of migrate, the spk2info.pt it imported with its mtime and size
+
+    Speakers are loaded lazily on first access and kept in a device lru cache bounded by cache_bytes.
+    """
+
+    def __init__(self, store_dir, device, cache_bytes=256 * 1024 * 1024, shard_bytes=256 * 1024 * 1024):
+        self.store_dir = store_dir
+        self.device = device
+        self.shard_bytes = shard_bytes
+        self.cache = LRUCache(cache_bytes)
+        metrics.register_cache('speaker', self.cache)
+        self.lock = threading.Lock()
+        self.index = {}
+        self.mmaps = {}
+        os.makedirs(store_dir, exist_ok=True)
+        self.index_path = os.path.join(store_dir, 'index.jsonl')
+        self.marker_path = os.path.join(store_dir, 'migrated.json')
+        # NOTE temporary files are only left by a crash during compact or migrate, they are never referenced
+        for i in os.listdir(store_dir):
+            if i.endswith('.tmp'):
+                os.remove(os.path.join(store_dir, i))
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf8') as f:
+                for line in f:
+                    if line.strip() == '':
+                        continue
+                    for spk_id, entry in json.loads(line).items():
+                        if entry is None:
+                            self.index.pop(spk_id, None)
+                        else:
+                            self.index[spk_id] = entry
+        # NOTE compact writes new shards after the existing ones, so the first shard id is not always 0
+        self.shard_id = max(self._shard_ids(), default=0)
+
+    def _shard_path(self, shard_id):
+        return os.path.join(self.store_dir, 'shard_{}.bin'.format(shard_id))
+
+    def _shard_ids(self):
+        return [int(i[len('shard_'):-len('.bin')]) for i in os.listdir(self.store_dir) if i.startswith('shard_') and i.endswith('.bin')]
+
+    def _read(self, shard_id, offset, nbytes):
+        with self.lock:
+            return self._read_unlocked(shard_id, offset, nbytes)
+
+    def _read_unlocked(self, shard_id, offset, nbytes):
+        mm = self.mmaps.get(shard_id)
+        # NOTE remap when the shard has grown after it was mapped
+        if mm is None or offset + nbytes > len(mm):
+            if mm is not None:
+                mm.close()
+            with open(self._shard_path(shard_id), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mmaps[shard_id] = mm
+        return bytearray(mm[offset: offset + nbytes])
+
+    @staticmethod
+    def _nbytes(v):
+        return v['numel'] * torch.tensor([], dtype=getattr(torch, v['dtype'])).element_size()
+
+    def _load(self, spk_id):
+        info = {}
+        for k, v in self.index[spk_id].items():
+            if 'value' in v:
+                info[k] = v['value']
+                continue
+            dtype = getattr(torch, v['dtype'])
+            nbytes = self._nbytes(v)
+            if nbytes == 0:
+                info[k] = torch.zeros(v['shape'], dtype=dtype, device=self.device)
+            else:
+                info[k] = torch.frombuffer(self._read(v['shard'], v['offset'], nbytes), dtype=dtype).reshape(v['shape']).to(self.device)
+        return info
+
+    def __getitem__(self, spk_id):
+        if spk_id not in self.index:
+            raise KeyError(spk_id)
+        info = self.cache.get(spk_id)
+        if info is None:
+            info = self._load(spk_id)
+            self.cache.put(spk_id, info)
+        # NOTE return a shallow copy, frontend adds/deletes keys on the returned dict
+        return dict(info)
+
+    def __setitem__(self, spk_id, info):
+        entry = {}
+        with self.lock:
+            shard_path = self._shard_path(self.shard_id)
+            if os.path.exists(shard_path) and os.path.getsize(shard_path) >= self.shard_bytes:
+                self.shard_id += 1
+                shard_path = self._shard_path(self.shard_id)
+            with open(shard_path, 'ab') as f:
+                for k, v in info.items():
+                    if isinstance(v, torch.Tensor):
+                        v = v.detach().cpu().contiguous()
+                        entry[k] = {'shard': self.shard_id, 'offset': f.tell(), 'dtype': str(v.dtype).split('.')[-1],
+                                    'shape': list(v.shape), 'numel': v.numel()}
+                        f.write(v.reshape(-1).view(torch.uint8).numpy().tobytes())
+                    else:
+                        entry[k] = {'value': v}
+                f.flush()
+                os.fsync(f.fileno())
+            # NOTE index line is written after the tensor bytes, a crash in between only leaves unreferenced bytes
+            with open(self.index_path, 'a', encoding='utf8') as f:
+                f.write(json.dumps({spk_id: entry}, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.index[spk_id] = entry
+        self.cache.pop(spk_id)
+
+    def __delitem__(self, spk_id):
+        with self.lock:
+            if spk_id not in self.index:
+                raise KeyError(spk_id)
+            with open(self.index_path, 'a', encoding='utf8') as f:
+                f.write(json.dumps({spk_id: None}, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.index.pop(spk_id)
+        self.cache.pop(spk_id)
+
+    def __contains__(self, spk_id):
+        return spk_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(list(self.index.keys()))
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def compact(self):
+        """Explicit maintenance, copy live speakers into new shards and swap in a new index to drop stale entries.
+
+        New shards and index are written under temporary names and moved in place with os.replace, old shards are only
+        removed once the new index is in place, so a crash at any point leaves a readable store. Readers and writers
+        wait on the lock while compacting.
+        """
+        with self.lock:
+            old_shard_ids = self._shard_ids()
+            index, new_shards, f = {}, [], None
+            try:
+                for spk_id, entry in self.index.items():
+                    index[spk_id] = {}
+                    for k, v in entry.items():
+                        if 'value' in v:
+                            index[spk_id][k] = v
+                            continue
+                        if f is None or f.tell() >= self.shard_bytes:
+                            if f is not None:
+                                f.flush()
+                                os.fsync(f.fileno())
+                                f.close()
+                            new_shards.append(max(old_shard_ids + new_shards, default=-1) + 1)
+                            f = open(self._shard_path(new_shards[-1]) + '.tmp', 'wb')
+                        nbytes = self._nbytes(v)
+                        index[spk_id][k] = dict(v, shard=new_shards[-1], offset=f.tell())
+                        if nbytes != 0:
+                            f.write(self._read_unlocked(v['shard'], v['offset'], nbytes))
+                if f is not None:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    f.close()
+                with open(self.index_path + '.tmp', 'w', encoding='utf8') as f:
+                    for spk_id, entry in index.items():
+                        f.write(json.dumps({spk_id: entry}, ensure_ascii=False) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+            except BaseException:
+                if f is not None:
+                    f.close()
+                for shard_id in new_shards:
+                    if os.path.exists(self._shard_path(shard_id) + '.tmp'):
+                        os.remove(self._shard_path(shard_id) + '.tmp')
+                if os.path.exists(self.index_path + '.tmp'):
+                    os.remove(self.index_path + '.tmp')
+                raise
+            # NOTE new shards are unreferenced until the index is replaced, old shards are unreferenced after it
+            for shard_id in new_shards:
+                os.replace(self._shard_path(shard_id) + '.tmp', self._shard_path(shard_id))
+            os.replace(self.index_path + '.tmp', self.index_path)
+            for shard_id in old_shard_ids:
+                mm = self.mmaps.pop(shard_id, None)
+                if mm is not None:
+                    mm.close()
+                os.remove(self._shard_path(shard_id))
+            self.index = index
+            self.shard_id = new_shards[-1] if len(new_shards) != 0 else max(old_shard_ids, default=-1) + 1
+        # NOTE cached speakers are unchanged, only their location on disk moved
+
+    def migrate(self, spk2info_path):
+        """One shot import of a monolithic spk2info.pt, skipped once a completion marker for this exact file exists.
+
+        The marker is written only after every speaker is in the store, a crash during migrate leaves no marker so the
+        next start imports again, speakers written twice only leave stale bytes which compact drops.
+        """
+        if not os.path.exists(spk2info_path):
+            return
+        source = {'spk2info': os.path.abspath(spk2info_path), 'mtime': os.path.getmtime(spk2info_path), 'size': os.path.getsize(spk2info_path)}
+        if os.path.exists(self.marker_path):
+            with open(self.marker_path, 'r', encoding='utf8') as f:
+                if json.load(f) == source:
+                    return
+        spk2info = torch.load(spk2info_path, map_location='cpu')
+        logging.info('migrate {} speakers from {} to {}'.format(len(spk2info), spk2info_path, self.store_dir))
+        for spk_id, info in spk2info.items():
+            self[spk_id] = info
+        with open(self.marker_path + '.tmp', 'w', encoding='utf8') as f:
+            json.dump(source, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.marker_path + '.tmp', self.marker_path)
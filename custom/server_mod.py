@@ -1,22 +1,23 @@
-import numpy as np
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
-from fastapi import FastAPI, Query, Response, UploadFile, Form, File
-from fastapi import FastAPI, Query, Response
+from starlette.background import BackgroundTask
+from fastapi import FastAPI, Query, Response, UploadFile, File
+import asyncio
 import traceback
 import io
 import os
 import sys
 import argparse
 import logging
-import uuid
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/..'.format(ROOT_DIR))
 sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.utils.file_utils import load_wav
+from cosyvoice.utils.audio_output import PCMEncoder, astream_audio, wav_header
 from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+from cosyvoice.cli.async_cosyvoice import AsyncCosyVoice
 
 app = FastAPI()
 # set cross region allowance
@@ -32,86 +33,94 @@ logger = logging.getLogger("cosyvoice_api")
 logging.basicConfig(level=logging.INFO)
 
 
-def generate_data(model_output):
-    for i in model_output:
-        tts_audio = (i['tts_speech'].numpy() * (2 ** 15)
-                     ).astype(np.int16).tobytes()
-        yield tts_audio
+async def process_model_output(model_output, wav=False):
+    """收集所有音频数据到一个缓冲区中，wav为True时在开头预留并回填WAV文件头"""
+    buffer = io.BytesIO()
+    encoder = PCMEncoder()
+    if wav is True:
+        buffer.write(wav_header(cosyvoice.sample_rate, 0))
+    async for item in model_output:
+        # PCM 16位有符号整数，范围是 [-32768, 32767]，推理线程中已转换并拷贝到内存，不会阻塞事件循环
+        buffer.write(memoryview(item['tts_pcm'].numpy()).cast('B') if 'tts_pcm' in item else encoder.encode(item['tts_speech']))
 
+    # 回填数据大小，直接返回缓冲区的视图，避免拼接bytes带来的拷贝
+    audio_data = buffer.getbuffer()
+    if wav is True:
+        audio_data[:44] = wav_header(cosyvoice.sample_rate, len(audio_data) - 44)
+    return audio_data
 
-def process_model_output(model_output):
-    """收集所有音频数据到一个字节数组中"""
-    buffer = io.BytesIO()
 
-    # 处理生成器类型的输出
-    if hasattr(model_output, '__iter__') and not isinstance(model_output, (list, dict, bytes, bytearray)):
-        for item in model_output:
-            if isinstance(item, dict) and 'tts_speech' in item:
-                speech_data = item['tts_speech']
-                if hasattr(speech_data, 'numpy'):
-                    # PCM 16位有符号整数，范围是 [-32768, 32767]
-                    tts_audio = (speech_data.numpy() * (2 ** 15)
-                                 ).astype(np.int16).tobytes()
-                    buffer.write(tts_audio)
-            elif hasattr(item, 'numpy'):
-                tts_audio = (item.numpy() * (2 ** 15)
-                             ).astype(np.int16).tobytes()
-                buffer.write(tts_audio)
-            elif isinstance(item, (bytes, bytearray)):
-                buffer.write(item)
-    else:
-        # 处理非生成器类型
-        if isinstance(model_output, dict) and 'tts_speech' in model_output:
-            speech_data = model_output['tts_speech']
-            if hasattr(speech_data, 'numpy'):
-                tts_audio = (speech_data.numpy() * (2 ** 15)
-                             ).astype(np.int16).tobytes()
-                buffer.write(tts_audio)
-        elif hasattr(model_output, 'numpy'):
-            tts_audio = (model_output.numpy() * (2 ** 15)
-                         ).astype(np.int16).tobytes()
-            buffer.write(tts_audio)
-        elif isinstance(model_output, (bytes, bytearray)):
-            buffer.write(model_output)
+class ConcurrencySlot:
+    """一个已获取的并发名额，只释放一次。
 
-    # 将指针移回开始位置
-    buffer.seek(0)
-    return buffer.read()
+    流式响应的生成器可能从未被迭代(例如发送响应头前客户端已断开)，不能只依赖生成器的finally，
+    因此响应结束时由BackgroundTask释放，对象被回收时也会释放，保证名额不会泄漏。
+    """
 
+    def __init__(self):
+        self.released = False
 
-def add_wav_header(pcm_data, num_channels=1, bits_per_sample=16):
-    """为PCM数据添加WAV文件头"""
-    # 计算数据大小
-    data_size = len(pcm_data)
+    def release(self):
+        if self.released is False:
+            self.released = True
+            semaphore.release()
 
-    # WAV文件头
-    header = bytearray()
+    def __del__(self):
+        self.release()
 
-    sample_rate = cosyvoice.sample_rate
 
-    # RIFF header
-    header.extend(b'RIFF')
-    header.extend((data_size + 36).to_bytes(4, 'little'))  # 文件大小 - 8
-    header.extend(b'WAVE')
+async def stream_model_output(model_output, slot, wav=False):
+    """边合成边返回，结束、出错或客户端断开时释放并发名额"""
+    audio_stream = astream_audio(model_output, cosyvoice.sample_rate, 'wav' if wav is True else 'pcm')
+    try:
+        async for chunk in audio_stream:
+            yield chunk
+    except Exception as e:
+        # 响应头已经发出，只能记录错误并提前结束
+        logger.error(f"流式返回时发生错误: {str(e)}")
+    finally:
+        # 关闭生成器会通知推理线程停止，会话随之释放
+        await audio_stream.aclose()
+        slot.release()
 
-    # fmt chunk
-    header.extend(b'fmt ')
-    header.extend((16).to_bytes(4, 'little'))  # fmt chunk大小
-    header.extend((1).to_bytes(2, 'little'))   # 音频格式 (1 = PCM)
-    header.extend(num_channels.to_bytes(2, 'little'))  # 通道数
-    header.extend(sample_rate.to_bytes(4, 'little'))  # 采样率
-    bytes_per_second = sample_rate * num_channels * bits_per_sample // 8
-    header.extend(bytes_per_second.to_bytes(4, 'little'))  # 每秒字节数
-    block_align = num_channels * bits_per_sample // 8
-    header.extend(block_align.to_bytes(2, 'little'))  # 块对齐
-    header.extend(bits_per_sample.to_bytes(2, 'little'))  # 每个样本的位数
 
-    # data chunk
-    header.extend(b'data')
-    header.extend(data_size.to_bytes(4, 'little'))  # 数据大小
+async def synthesize(name, model_output, format, stream):
+    """统一处理并发限制、超时和响应格式，model_output在第一次迭代时才开始推理"""
+    try:
+        await asyncio.wait_for(semaphore.acquire(), args.queue_timeout)
+    except asyncio.TimeoutError:
+        await model_output.aclose()
+        return Response(content="服务繁忙，请稍后重试".encode('utf-8'), status_code=503, media_type="text/plain")
+
+    wav = format.lower() == "wav"
+    # 确定正确的Content-Type
+    content_type = "audio/wav" if wav else f"audio/{format}"
+    headers = {
+        "Content-Disposition": f"inline; filename=\"speech.{format}\"",
+        "Access-Control-Allow-Origin": "*",
+        "Cache-Control": "no-cache"
+    }
+    if stream is True:
+        # chunked传输，不设置Content-Length，WAV使用长度未知的文件头
+        slot = ConcurrencySlot()
+        return StreamingResponse(stream_model_output(model_output, slot, wav), headers=headers, media_type=content_type,
+                                 background=BackgroundTask(slot.release))
 
-    # 合并头和数据，返回bytes类型而不是bytearray
-    return bytes(header) + pcm_data
+    try:
+        # 处理模型输出，合并所有音频数据，如果是WAV格式，需要添加WAV文件头
+        audio_data = await process_model_output(model_output, wav)
+        headers.update({"Content-Length": str(len(audio_data)), "Accept-Ranges": "bytes"})
+        return Response(content=audio_data, headers=headers, media_type=content_type)
+    except asyncio.TimeoutError:
+        logger.error(f"处理{name}请求超时")
+        return Response(content=f"处理{name}请求超时".encode('utf-8'), status_code=504, media_type="text/plain")
+    except Exception as e:
+        logger.error(f"处理{name}请求时发生错误: {str(e)}")
+        logger.error(traceback.format_exc())
+        return Response(content=f"处理{name}请求时发生错误: {str(e)}".encode('utf-8'), status_code=500, media_type="text/plain")
+    finally:
+        await model_output.aclose()
+        semaphore.release()
 
 
 @app.get("/inference_sft")
@@ -119,55 +128,13 @@ def add_wav_header(pcm_data, num_channels=1, bits_per_sample=16):
 async def inference_sft(
     tts_text: str = Query(..., description="要转换为语音的文本"),
     spk_id: str = Query(..., description="说话人ID"),
-    format: str = Query("wav", description="音频格式，如wav, mp3等")
+    format: str = Query("wav", description="音频格式，wav或pcm"),
+    stream: bool = Query(False, description="是否流式返回")
 ):
-    try:
-        print(
-            f"Received TTS request: tts_text={tts_text}, spk_id={spk_id}, format={format}")
-        # 调用模型生成音频
-        model_output = cosyvoice.inference_sft(
-            tts_text, spk_id, stream=False, speed=1, text_frontend=True)
-
-        # 处理模型输出，合并所有音频数据
-        audio_bytes = process_model_output(model_output)
-
-        # 如果是WAV格式，需要添加WAV文件头
-        if format.lower() == "wav":
-            audio_data = add_wav_header(audio_bytes)
-        else:
-            audio_data = audio_bytes
-
-        # 确定正确的Content-Type
-        content_type = "audio/wav" if format.lower(
-        ) == "wav" else f"audio/{format}"
-
-        # 构建响应头
-        headers = {
-            "Content-Disposition": f"inline; filename=\"speech.{format}\"",
-            "Content-Length": str(len(audio_data)),
-            "Access-Control-Allow-Origin": "*",
-            "Accept-Ranges": "bytes",
-            "Cache-Control": "no-cache"
-        }
-
-        # 明确转换为bytes类型，因为FastAPI的Response期望字节而不是bytearray
-        if isinstance(audio_data, bytearray):
-            audio_data = bytes(audio_data)
-
-        # 返回音频数据
-        return Response(
-            content=audio_data,
-            headers=headers,
-            media_type=content_type
-        )
-    except Exception as e:
-        logger.error(f"处理TTS请求时发生错误: {str(e)}")
-        logger.error(traceback.format_exc())
-        return Response(
-            content=f"处理TTS请求时发生错误: {str(e)}".encode('utf-8'),
-            status_code=500,
-            media_type="text/plain"
-        )
+    print(f"Received TTS request: tts_text={tts_text}, spk_id={spk_id}, format={format}, stream={stream}")
+    # 调用模型生成音频
+    model_output = cosyvoice.inference_sft(tts_text, spk_id, stream=stream, speed=1, text_frontend=True)
+    return await synthesize("TTS", model_output, format, stream)
 
 
 @app.get("/inference_zero_shot")
@@ -176,58 +143,15 @@ async def inference_zero_shot(
     tts_text: str = Query(..., description="要转换为语音的文本"),
     prompt_text: str = Query(..., description="提示文本"),
     prompt_wav: UploadFile = File(..., description="提示音频文件"),
-    format: str = Query("wav", description="音频格式，如wav, mp3等")
+    format: str = Query("wav", description="音频格式，wav或pcm"),
+    stream: bool = Query(False, description="是否流式返回")
 ):
-    try:
-        print(
-            f"Received Zero-shot TTS request: tts_text={tts_text}, prompt_text={prompt_text}, format={format}")
-        # 加载提示音频
-        prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-
-        # 调用模型生成音频
-        model_output = cosyvoice.inference_zero_shot(
-            tts_text, prompt_text, prompt_speech_16k)
-
-        # 处理模型输出，合并所有音频数据
-        audio_bytes = process_model_output(model_output)
-
-        # 如果是WAV格式，需要添加WAV文件头
-        if format.lower() == "wav":
-            audio_data = add_wav_header(audio_bytes)
-        else:
-            audio_data = audio_bytes
-
-        # 确定正确的Content-Type
-        content_type = "audio/wav" if format.lower(
-        ) == "wav" else f"audio/{format}"
-
-        # 构建响应头
-        headers = {
-            "Content-Disposition": f"inline; filename=\"speech.{format}\"",
-            "Content-Length": str(len(audio_data)),
-            "Access-Control-Allow-Origin": "*",
-            "Accept-Ranges": "bytes",
-            "Cache-Control": "no-cache"
-        }
-
-        # 明确转换为bytes类型
-        if isinstance(audio_data, bytearray):
-            audio_data = bytes(audio_data)
-
-        # 返回音频数据
-        return Response(
-            content=audio_data,
-            headers=headers,
-            media_type=content_type
-        )
-    except Exception as e:
-        logger.error(f"处理Zero-shot TTS请求时发生错误: {str(e)}")
-        logger.error(traceback.format_exc())
-        return Response(
-            content=f"处理Zero-shot TTS请求时发生错误: {str(e)}".encode('utf-8'),
-            status_code=500,
-            media_type="text/plain"
-        )
+    print(f"Received Zero-shot TTS request: tts_text={tts_text}, prompt_text={prompt_text}, format={format}, stream={stream}")
+    # 加载提示音频
+    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
+    # 调用模型生成音频
+    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k, stream=stream)
+    return await synthesize("Zero-shot TTS", model_output, format, stream)
 
 
 @app.get("/inference_cross_lingual")
@@ -235,58 +159,15 @@ async def inference_zero_shot(
 async def inference_cross_lingual(
     tts_text: str = Query(..., description="要转换为语音的文本"),
     prompt_wav: UploadFile = File(..., description="提示音频文件"),
-    format: str = Query("wav", description="音频格式，如wav, mp3等")
+    format: str = Query("wav", description="音频格式，wav或pcm"),
+    stream: bool = Query(False, description="是否流式返回")
 ):
-    try:
-        print(
-            f"Received Cross-lingual TTS request: tts_text={tts_text}, format={format}")
-        # 加载提示音频
-        prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-
-        # 调用模型生成音频
-        model_output = cosyvoice.inference_cross_lingual(
-            tts_text, prompt_speech_16k)
-
-        # 处理模型输出，合并所有音频数据
-        audio_bytes = process_model_output(model_output)
-
-        # 如果是WAV格式，需要添加WAV文件头
-        if format.lower() == "wav":
-            audio_data = add_wav_header(audio_bytes)
-        else:
-            audio_data = audio_bytes
-
-        # 确定正确的Content-Type
-        content_type = "audio/wav" if format.lower(
-        ) == "wav" else f"audio/{format}"
-
-        # 构建响应头
-        headers = {
-            "Content-Disposition": f"inline; filename=\"speech.{format}\"",
-            "Content-Length": str(len(audio_data)),
-            "Access-Control-Allow-Origin": "*",
-            "Accept-Ranges": "bytes",
-            "Cache-Control": "no-cache"
-        }
-
-        # 明确转换为bytes类型
-        if isinstance(audio_data, bytearray):
-            audio_data = bytes(audio_data)
-
-        # 返回音频数据
-        return Response(
-            content=audio_data,
-            headers=headers,
-            media_type=content_type
-        )
-    except Exception as e:
-        logger.error(f"处理Cross-lingual TTS请求时发生错误: {str(e)}")
-        logger.error(traceback.format_exc())
-        return Response(
-            content=f"处理Cross-lingual TTS请求时发生错误: {str(e)}".encode('utf-8'),
-            status_code=500,
-            media_type="text/plain"
-        )
+    print(f"Received Cross-lingual TTS request: tts_text={tts_text}, format={format}, stream={stream}")
+    # 加载提示音频
+    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
+    # 调用模型生成音频
+    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k, stream=stream)
+    return await synthesize("Cross-lingual TTS", model_output, format, stream)
 
 
 @app.get("/inference_instruct2")
@@ -295,58 +176,17 @@ async def inference_instruct2(
     tts_text: str = Query(..., description="要转换为语音的文本"),
     instruct_text: str = Query(..., description="指令文本"),
     prompt_wav: UploadFile = File(..., description="提示音频文件"),
-    format: str = Query("wav", description="音频格式，如wav, mp3等")
+    format: str = Query("wav", description="音频格式，wav或pcm"),
+    stream: bool = Query(False, description="是否流式返回")
 ):
-    try:
-        print(
-            f"Received Instruct2 TTS request: tts_text={tts_text}, instruct_text={instruct_text}, format={format}")
-        # 加载提示音频
-        prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-
-        # 调用模型生成音频
-        model_output = cosyvoice.inference_instruct2(
-            tts_text, instruct_text, prompt_speech_16k)
-
-        # 处理模型输出，合并所有音频数据
-        audio_bytes = process_model_output(model_output)
-
-        # 如果是WAV格式，需要添加WAV文件头
-        if format.lower() == "wav":
-            audio_data = add_wav_header(audio_bytes)
-        else:
-            audio_data = audio_bytes
+    print(f"Received Instruct2 TTS request: tts_text={tts_text}, instruct_text={instruct_text}, format={format}, stream={stream}")
+    # 加载提示音频
+    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
+    # 调用模型生成音频
+    model_output = cosyvoice.inference_instruct2(tts_text, instruct_text, prompt_speech_16k, stream=stream)
+    return await synthesize("Instruct2 TTS", model_output, format, stream)
 
-        # 确定正确的Content-Type
-        content_type = "audio/wav" if format.lower(
-        ) == "wav" else f"audio/{format}"
 
-        # 构建响应头
-        headers = {
-            "Content-Disposition": f"inline; filename=\"speech.{format}\"",
-            "Content-Length": str(len(audio_data)),
-            "Access-Control-Allow-Origin": "*",
-            "Accept-Ranges": "bytes",
-            "Cache-Control": "no-cache"
-        }
-
-        # 明确转换为bytes类型
-        if isinstance(audio_data, bytearray):
-            audio_data = bytes(audio_data)
-
-        # 返回音频数据
-        return Response(
-            content=audio_data,
-            headers=headers,
-            media_type=content_type
-        )
-    except Exception as e:
-        logger.error(f"处理Instruct2 TTS请求时发生错误: {str(e)}")
-        logger.error(traceback.format_exc())
-        return Response(
-            content=f"处理Instruct2 TTS请求时发生错误: {str(e)}".encode('utf-8'),
-            status_code=500,
-            media_type="text/plain"
-        )
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--port',
@@ -356,13 +196,28 @@ if __name__ == '__main__':
                         type=str,
                         default='/home/seele/Dev/DeepLearning/CosyVoice/pretrained_models/CosyVoice2-0.5B',
                         help='local path or modelscope repo id')
+    parser.add_argument('--max_concurrency',
+                        type=int,
+                        default=4,
+                        help='同时合成的最大请求数')
+    parser.add_argument('--queue_timeout',
+                        type=float,
+                        default=30,
+                        help='等待并发名额的最长秒数，超时返回503')
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=None,
+                        help='单个请求合成的最长秒数')
     args = parser.parse_args()
     try:
-        cosyvoice = CosyVoice(args.model_dir)
+        cosyvoice = CosyVoice(args.model_dir, speech_on_device=True, frontend_batch_size=args.max_concurrency)
     except Exception:
         try:
             cosyvoice = CosyVoice2(
-                args.model_dir, load_jit=False, load_trt=False, fp16=False)
+                args.model_dir, load_jit=False, load_trt=False, fp16=False, speech_on_device=True, frontend_batch_size=args.max_concurrency)
         except Exception:
             raise TypeError('no valid model_type!')
+    # 推理在线程池中进行，不阻塞事件循环
+    cosyvoice = AsyncCosyVoice(cosyvoice, max_workers=args.max_concurrency, timeout=args.timeout, output_pcm=True)
+    semaphore = asyncio.Semaphore(args.max_concurrency)
     uvicorn.run(app, host="0.0.0.0", port=args.port)
@@ -16,16 +16,19 @@ import sys
 import argparse
 import logging
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
-from fastapi import FastAPI, UploadFile, Form, File
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, UploadFile, Form, File, Depends, HTTPException
+from fastapi.responses import StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-import numpy as np
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+from cosyvoice.cli.async_cosyvoice import AsyncCosyVoice
+from cosyvoice.flow.flow_matching import check_flow_settings
+from cosyvoice.utils.audio_output import astream_audio
 from cosyvoice.utils.file_utils import load_wav
+from cosyvoice.utils.metrics import metrics
 
 app = FastAPI()
 # set cross region allowance
@@ -38,49 +41,68 @@ app.add_middleware(
 
 
 def generate_data(model_output):
-    for i in model_output:
-        tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-        yield tts_audio
+    # NOTE samples are converted to host int16 in the inference thread, see AsyncCosyVoice output_pcm
+    return astream_audio(model_output, cosyvoice.sample_rate)
+
+
+def get_flow_kwargs(n_timesteps: str = Form('10'), solver: str = Form('euler'), cfg_rate: float = Form(-1.0), cfg_interval: int = Form(1)):
+    # NOTE n_timesteps is an int or a comma separated per chunk schedule like 4,10, negative cfg_rate means model default
+    # settings are validated here, an error inside the inference thread would break the streaming response mid body
+    try:
+        n_timesteps = [int(i) for i in n_timesteps.split(',')]
+        flow_kwargs = {'n_timesteps': n_timesteps[0] if len(n_timesteps) == 1 else n_timesteps, 'solver': solver,
+                       'cfg_rate': cfg_rate if cfg_rate >= 0 else None, 'cfg_interval': cfg_interval}
+        check_flow_settings(**flow_kwargs)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return flow_kwargs
 
 
 @app.get("/inference_sft")
 @app.post("/inference_sft")
-async def inference_sft(tts_text: str = Form(), spk_id: str = Form()):
-    model_output = cosyvoice.inference_sft(tts_text, spk_id)
+async def inference_sft(tts_text: str = Form(), spk_id: str = Form(), flow_kwargs: dict = Depends(get_flow_kwargs)):
+    model_output = cosyvoice.inference_sft(tts_text, spk_id, **flow_kwargs)
     return StreamingResponse(generate_data(model_output))
 
 
 @app.get("/inference_zero_shot")
 @app.post("/inference_zero_shot")
-async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
+async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File(), flow_kwargs: dict = Depends(get_flow_kwargs)):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k)
+    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k, **flow_kwargs)
     return StreamingResponse(generate_data(model_output))
 
 
 @app.get("/inference_cross_lingual")
 @app.post("/inference_cross_lingual")
-async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File()):
+async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File(), flow_kwargs: dict = Depends(get_flow_kwargs)):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k)
+    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k, **flow_kwargs)
     return StreamingResponse(generate_data(model_output))
 
 
 @app.get("/inference_instruct")
 @app.post("/inference_instruct")
-async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form()):
-    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text)
+async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form(), flow_kwargs: dict = Depends(get_flow_kwargs)):
+    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text, **flow_kwargs)
     return StreamingResponse(generate_data(model_output))
 
 
 @app.get("/inference_instruct2")
 @app.post("/inference_instruct2")
-async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File()):
+async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File(), flow_kwargs: dict = Depends(get_flow_kwargs)):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_instruct2(tts_text, instruct_text, prompt_speech_16k)
+    model_output = cosyvoice.inference_instruct2(tts_text, instruct_text, prompt_speech_16k, **flow_kwargs)
     return StreamingResponse(generate_data(model_output))
 
 
+@app.get("/metrics")
+async def get_metrics():
+    if metrics.enabled is False:
+        return Response(content='metrics is not enabled, start server with --metrics', status_code=404)
+    return Response(content=metrics.generate_latest(), media_type=metrics.content_type)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--port',
@@ -90,12 +112,27 @@ if __name__ == '__main__':
                         type=str,
                         default='iic/CosyVoice-300M',
                         help='local path or modelscope repo id')
+    parser.add_argument('--max_workers',
+                        type=int,
+                        default=32,
+                        help='number of inference executor threads')
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=None,
+                        help='per request timeout in seconds')
+    parser.add_argument('--metrics',
+                        action='store_true',
+                        default=False,
+                        help='expose prometheus metrics on /metrics')
     args = parser.parse_args()
+    if args.metrics is True:
+        metrics.enable()
     try:
-        cosyvoice = CosyVoice(args.model_dir)
+        cosyvoice = CosyVoice(args.model_dir, speech_on_device=True)
     except Exception:
         try:
-            cosyvoice = CosyVoice2(args.model_dir)
+            cosyvoice = CosyVoice2(args.model_dir, speech_on_device=True)
         except Exception:
             raise TypeError('no valid model_type!')
+    cosyvoice = AsyncCosyVoice(cosyvoice, max_workers=args.max_workers, timeout=args.timeout, output_pcm=True)
     uvicorn.run(app, host="0.0.0.0", port=args.port)
@@ -26,6 +26,8 @@ ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+from cosyvoice.flow.flow_matching import check_flow_settings
+from cosyvoice.utils.audio_output import stream_audio
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s')
@@ -34,40 +36,52 @@ logging.basicConfig(level=logging.DEBUG,
 class CosyVoiceServiceImpl(cosyvoice_pb2_grpc.CosyVoiceServicer):
     def __init__(self, args):
         try:
-            self.cosyvoice = CosyVoice(args.model_dir, trt_concurrent=args.max_conc)
+            self.cosyvoice = CosyVoice(args.model_dir, trt_concurrent=args.max_conc, speech_on_device=True)
         except Exception:
             try:
-                self.cosyvoice = CosyVoice2(args.model_dir, trt_concurrent=args.max_conc)
+                self.cosyvoice = CosyVoice2(args.model_dir, trt_concurrent=args.max_conc, speech_on_device=True)
             except Exception:
                 raise TypeError('no valid model_type!')
         logging.info('grpc service initialized')
 
     def Inference(self, request, context):
+        n_timesteps = list(request.n_timesteps) if len(request.n_timesteps) != 0 else [10]
+        flow_kwargs = {'n_timesteps': n_timesteps[0] if len(n_timesteps) == 1 else n_timesteps,
+                       'solver': request.solver if request.solver != '' else 'euler',
+                       'cfg_rate': request.cfg_rate if request.HasField('cfg_rate') else None,
+                       'cfg_interval': request.cfg_interval if request.cfg_interval != 0 else 1}
+        try:
+            check_flow_settings(**flow_kwargs)
+        except ValueError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
         if request.HasField('sft_request'):
             logging.info('get sft inference request')
-            model_output = self.cosyvoice.inference_sft(request.sft_request.tts_text, request.sft_request.spk_id)
+            model_output = self.cosyvoice.inference_sft(request.sft_request.tts_text, request.sft_request.spk_id, **flow_kwargs)
         elif request.HasField('zero_shot_request'):
             logging.info('get zero_shot inference request')
             prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.zero_shot_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
             prompt_speech_16k = prompt_speech_16k.float() / (2**15)
             model_output = self.cosyvoice.inference_zero_shot(request.zero_shot_request.tts_text,
                                                               request.zero_shot_request.prompt_text,
-                                                              prompt_speech_16k)
+                                                              prompt_speech_16k,
+                                                              **flow_kwargs)
         elif request.HasField('cross_lingual_request'):
             logging.info('get cross_lingual inference request')
             prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.cross_lingual_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
             prompt_speech_16k = prompt_speech_16k.float() / (2**15)
-            model_output = self.cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text, prompt_speech_16k)
+            model_output = self.cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text, prompt_speech_16k, **flow_kwargs)
         else:
             logging.info('get instruct inference request')
             model_output = self.cosyvoice.inference_instruct(request.instruct_request.tts_text,
                                                              request.instruct_request.spk_id,
-                                                             request.instruct_request.instruct_text)
+                                                             request.instruct_request.instruct_text,
+                                                             **flow_kwargs)
 
         logging.info('send inference response')
-        for i in model_output:
+        for tts_audio in stream_audio(model_output, self.cosyvoice.sample_rate):
             response = cosyvoice_pb2.Response()
-            response.tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
+            # NOTE protobuf bytes field owns its data, this is the only host copy
+            response.tts_audio = bytes(tts_audio)
             yield response
 
 
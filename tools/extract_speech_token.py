@@ -14,13 +14,14 @@
 # limitations under the License.
 import argparse
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import logging
 import torch
+import torch.nn.functional as F
 from tqdm import tqdm
 import onnxruntime
 import numpy as np
 import torchaudio
 import whisper
+from cosyvoice.utils.frontend_utils import split_speech_windows, merge_window_tokens
 
 
 def single_job(utt):
@@ -30,13 +31,15 @@ def single_job(utt):
     # Convert audio to mono
     if audio.shape[0] > 1:
         audio = audio.mean(dim=0, keepdim=True)
-    if audio.shape[1] / 16000 > 30:
-        logging.warning('do not support extract speech token for audio longer than 30s')
-        speech_token = []
-    else:
-        feat = whisper.log_mel_spectrogram(audio, n_mels=128)
-        speech_token = ort_session.run(None, {ort_session.get_inputs()[0].name: feat.detach().cpu().numpy(),
-                                              ort_session.get_inputs()[1].name: np.array([feat.shape[2]], dtype=np.int32)})[0].flatten().tolist()
+    # NOTE audio longer than 30s is tokenized in overlapping windows which run as one batch
+    windows = split_speech_windows(audio.shape[1] // 160)
+    feats = [whisper.log_mel_spectrogram(audio[:, start * 160: end * 160 if i != len(windows) - 1 else audio.shape[1]], n_mels=128)
+             for i, (start, end, _, _) in enumerate(windows)]
+    feat_lens = [feat.shape[2] for feat in feats]
+    feat = torch.concat([F.pad(feat, (0, max(feat_lens) - feat.shape[2])) for feat in feats], dim=0)
+    speech_token = ort_session.run(None, {ort_session.get_inputs()[0].name: feat.detach().cpu().numpy(),
+                                          ort_session.get_inputs()[1].name: np.array(feat_lens, dtype=np.int32)})[0]
+    speech_token = merge_window_tokens(windows, [speech_token[i].tolist() for i in range(len(feats))])
     return utt, speech_token
 
 